@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Measures the cold start time of the ``jman`` sub-commands.
+
+Each command is executed several times in a new python interpreter, using a temporary database with a few local jobs.
+The commands that do not need the database are expected to take at most the given budget longer than starting an empty python interpreter; the script fails otherwise.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import time
+import argparse
+
+# the commands and whether they need to access the database
+COMMANDS = (
+  (['--version'], False),
+  (['--help'], False),
+  (['list', '--help'], False),
+  (['list'], True),
+  (['report'], True),
+  (['submit', '--dry-run', 'true'], True),
+  (['run-job'], True),
+)
+
+
+def _measure(command, environ, repetitions):
+  times = []
+  for _ in range(repetitions):
+    start = time.time()
+    with open(os.devnull, 'w') as devnull:
+      subprocess.call(command, env=environ, stdout=devnull, stderr=devnull)
+    times.append(time.time() - start)
+  return sorted(times)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('-r', '--repetitions', type=int, default=5, help='The number of times that each command is executed')
+  parser.add_argument('-b', '--budget', type=float, default=0.1, help='The maximum (median) time in seconds that the commands that do not access the database may take longer than an empty python interpreter')
+  args = parser.parse_args()
+
+  temp_dir = tempfile.mkdtemp(prefix='gridtk_startup')
+  try:
+    database = os.path.join(temp_dir, 'database.sql3')
+    from gridtk.local import JobManagerLocal
+    job_manager = JobManagerLocal(database=database, wrapper_script=sys.argv[0])
+    job_id = job_manager.submit(['true'], log_dir=os.path.join(temp_dir, 'logs'))
+    for _ in range(9):
+      job_manager.submit(['true'], dependencies=[job_id])
+    del job_manager
+
+    environ = dict(os.environ, JOB_ID=str(job_id), SGE_TASK_ID='undefined')
+    jman = [sys.executable, '-c', 'import sys; from gridtk.script.jman import main; sys.exit(main())']
+
+    failed = False
+    times = _measure([sys.executable, '-c', 'pass'], environ, args.repetitions)
+    baseline = times[len(times) // 2]
+    print("%-30s %10s %10s" % ("command", "min [ms]", "median [ms]"))
+    print("%-30s %10.1f %10.1f" % ("(python interpreter)", times[0] * 1000, baseline * 1000))
+    for command, database_access in COMMANDS:
+      times = _measure(jman + ['--local', '--database', database] + command, environ, args.repetitions)
+      median = times[len(times) // 2]
+      over_budget = not database_access and median - baseline > args.budget
+      failed = failed or over_budget
+      print("%-30s %10.1f %10.1f%s" % (" ".join(command), times[0] * 1000, median * 1000, "  (over budget)" if over_budget else ""))
+  finally:
+    shutil.rmtree(temp_dir)
+
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
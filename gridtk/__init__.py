@@ -1,7 +1,19 @@
-from . import setshell
-from . import tools
-from . import manager
-from . import local
-from . import sge
-from . import easy
-from . import tests
+import sys
+
+# the sub-modules are only imported when they are used, so that the command line tools start fast
+_submodules = ('setshell', 'tools', 'manager', 'local', 'sge', 'easy', 'tests')
+
+if sys.version_info >= (3, 7):
+  def __getattr__(name):
+    if name in _submodules:
+      import importlib
+      return importlib.import_module('.' + name, __name__)
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+else:
+  from . import setshell
+  from . import tools
+  from . import manager
+  from . import local
+  from . import sge
+  from . import easy
+  from . import tests
@@ -5,4 +5,9 @@
 
 """Returns the currently compiled version number"""
 
-__version__ = __import__('pkg_resources').get_distribution('gridtk').version
+try:
+  # much faster than pkg_resources, but only available in python 3.8 and later
+  from importlib.metadata import version as _version
+  __version__ = _version('gridtk')
+except ImportError:
+  __version__ = __import__('pkg_resources').get_distribution('gridtk').version
@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Analysis of the dependency graph of the jobs: cycle detection, topological
+levels and the critical path.
+
+All algorithms work on plain dictionaries of job ids and run in linear time
+in the number of jobs and dependencies, so that graphs of hundreds of
+thousands of jobs can be analyzed within seconds.
+"""
+
+from __future__ import print_function
+
+import collections
+import time
+
+# The information about a job that is needed for the analysis
+JobNode = collections.namedtuple('JobNode', ('unique', 'name', 'status', 'start_time', 'finish_time'))
+
+
+def _adjacency(dependencies):
+  """Returns the dictionary of the jobs that each job waits for, given the list of (waiting job, waited for job) pairs."""
+  waits_for = collections.defaultdict(list)
+  for waiting, waited_for in dependencies:
+    waits_for[waiting].append(waited_for)
+    waits_for.setdefault(waited_for, [])
+  return waits_for
+
+
+def topological_sort(waits_for):
+  """Sorts the given jobs topologically using Kahn's algorithm, so that each job comes after all jobs that it waits for.
+  ``waits_for`` is a dictionary that contains the list of jobs that each job waits for; all of these jobs need to be keys of the dictionary as well.
+  Returns the sorted jobs and the jobs that could not be sorted since they are part of, or wait for, a cycle."""
+  waiting_for_us = dict((job, []) for job in waits_for)
+  count = {}
+  for job, dependencies in waits_for.items():
+    count[job] = len(dependencies)
+    for dependency in dependencies:
+      waiting_for_us[dependency].append(job)
+  ready = collections.deque(sorted(job for job, c in count.items() if c == 0))
+  order = []
+  while ready:
+    job = ready.popleft()
+    order.append(job)
+    for waiting in waiting_for_us[job]:
+      count[waiting] -= 1
+      if count[waiting] == 0:
+        ready.append(waiting)
+  return order, [job for job, c in count.items() if c > 0]
+
+
+def _cycle(waits_for, remaining):
+  """Returns a cycle among the given remaining jobs of :py:func:`topological_sort`, each of which waits for at least one other remaining job."""
+  remaining = set(remaining)
+  job, visited, path = min(remaining), {}, []
+  while job not in visited:
+    visited[job] = len(path)
+    path.append(job)
+    job = min(d for d in waits_for[job] if d in remaining)
+  return path[visited[job]:] + [job]
+
+
+def find_cycle(dependencies):
+  """Returns a list of job ids that form a cycle in the given list of (waiting job, waited for job) pairs, where each job waits for the next one; or None if there is no cycle."""
+  waits_for = _adjacency(dependencies)
+  _, remaining = topological_sort(waits_for)
+  return _cycle(waits_for, remaining) if remaining else None
+
+
+def format_cycle(cycle):
+  """Returns a text that describes the given cycle of job ids."""
+  return " -> ".join(str(job) for job in cycle)
+
+
+class JobGraph(object):
+  """The dependency graph of the given jobs.
+
+  Keyword parameters:
+
+  jobs
+    A list of :py:class:`JobNode`'s
+
+  dependencies
+    A list of (waiting job, waited for job) pairs of unique job ids; dependencies on jobs that are not in ``jobs`` are ignored
+  """
+
+  def __init__(self, jobs, dependencies):
+    self.jobs = collections.OrderedDict((job.unique, job) for job in jobs)
+    self.waits_for = dict((unique, []) for unique in self.jobs)
+    self.dependencies = 0
+    for waiting, waited_for in dependencies:
+      if waiting in self.jobs and waited_for in self.jobs:
+        self.waits_for[waiting].append(waited_for)
+        self.dependencies += 1
+    self._order = None
+
+  def _sort(self):
+    # the jobs are sorted only once
+    if self._order is None:
+      self._order = topological_sort(self.waits_for)
+    return self._order
+
+  def find_cycle(self):
+    """Returns a list of job ids that form a cycle, where each job waits for the next one; or None if the graph has no cycle."""
+    order, remaining = self._sort()
+    return _cycle(self.waits_for, remaining) if remaining else None
+
+  def topological_order(self):
+    """Returns the list of job ids, in which each job comes after all jobs that it waits for.
+    Raises a ValueError if the dependencies form a cycle."""
+    order, remaining = self._sort()
+    if remaining:
+      raise ValueError("The dependencies of the jobs form a cycle: %s" % format_cycle(_cycle(self.waits_for, remaining)))
+    return order
+
+  def levels(self):
+    """Returns the topological level of each job: jobs without dependencies have level 0, all other jobs have one level more than the highest level of the jobs they wait for."""
+    levels = {}
+    for job in self.topological_order():
+      levels[job] = max([levels[d] + 1 for d in self.waits_for[job]] or [0])
+    return levels
+
+  def runtimes(self, default = None, now = None):
+    """Returns the runtime of each job in seconds, and the set of jobs whose runtime is estimated.
+    The runtimes of finished jobs are the recorded ones; executing jobs are expected to run at least until ``now``.
+    All other runtimes are estimated by the average runtime of the finished jobs with the same name, or by the ``default`` runtime, which is the average runtime of all finished jobs unless given (or 1 second, if no job has finished)."""
+    now = time.time() if now is None else now
+    recorded, by_name = {}, collections.defaultdict(list)
+    for job in self.jobs.values():
+      if job.status in ('success', 'failure') and job.start_time is not None and job.finish_time is not None:
+        recorded[job.unique] = max(job.finish_time - job.start_time, 0.)
+        by_name[job.name].append(recorded[job.unique])
+    if default is None:
+      default = sum(recorded.values()) / len(recorded) if recorded else 1.
+    averages = dict((name, sum(values) / len(values)) for name, values in by_name.items())
+
+    runtimes, estimated = {}, set()
+    for job in self.jobs.values():
+      if job.unique in recorded:
+        runtimes[job.unique] = recorded[job.unique]
+        continue
+      runtime = averages.get(job.name, default)
+      if job.status == 'executing' and job.start_time is not None:
+        runtime = max(runtime, now - job.start_time)
+      runtimes[job.unique] = runtime
+      estimated.add(job.unique)
+    return runtimes, estimated
+
+  def critical_path(self, runtimes):
+    """Returns the length and the job ids of the longest chain of dependent jobs, weighted by the given runtimes of the jobs.
+    This chain limits the time in which all jobs can be finished, even with an unlimited number of parallel jobs."""
+    finish, previous = {}, {}
+    for job in self.topological_order():
+      start = 0.
+      for dependency in self.waits_for[job]:
+        if job not in previous or finish[dependency] > start:
+          start, previous[job] = finish[dependency], dependency
+      finish[job] = start + runtimes[job]
+    if not finish:
+      return 0., []
+    job = max(finish, key=lambda j: (finish[j], -j))
+    length, path = finish[job], [job]
+    while job in previous:
+      job = previous[job]
+      path.append(job)
+    return length, path[::-1]
+
+  def write_dot(self, stream, critical_path = (), runtimes = None):
+    """Writes the graph in the DOT language of Graphviz to the given stream; the jobs and dependencies of the critical path are highlighted."""
+    colors = {'submitted' : 'white', 'queued' : 'lightblue', 'waiting' : 'lightgrey', 'executing' : 'yellow', 'success' : 'palegreen', 'failure' : 'salmon'}
+    critical = set(critical_path)
+    critical_edges = set(zip(critical_path[:-1], critical_path[1:]))
+    print("digraph jobs {", file=stream)
+    print('  rankdir=LR;', file=stream)
+    print('  node [shape=box, style=filled];', file=stream)
+    for job in self.jobs.values():
+      label = "%d: %s\\n%s" % (job.unique, (job.name or "").replace('"', '\\"'), job.status)
+      if runtimes is not None:
+        label += "\\n%s" % format_time(runtimes[job.unique])
+      print('  %d [label="%s", fillcolor=%s%s];' % (job.unique, label, colors.get(job.status, 'white'), ", penwidth=3" if job.unique in critical else ""), file=stream)
+    for waiting in self.topological_order():
+      for waited_for in self.waits_for[waiting]:
+        print('  %d -> %d%s;' % (waited_for, waiting, " [penwidth=3, color=red]" if (waited_for, waiting) in critical_edges else ""), file=stream)
+    print("}", file=stream)
+
+
+def format_time(seconds):
+  """Returns the given number of seconds as text, e.g. '1:02:03' or '4.5s'."""
+  if seconds < 60:
+    return "%.1fs" % seconds
+  seconds = int(round(seconds))
+  return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
@@ -11,17 +11,250 @@ from __future__ import print_function
 import subprocess
 import time
 import copy, os, sys
+import socket
+import select, signal
+import collections
+import heapq
+import sqlalchemy
 
 if sys.version_info[0] >= 3:
   from pickle import dumps, loads
 else:
   from cPickle import dumps, loads
 
-from .tools import makedirs_safe, logger, str_
+from .tools import makedirs_safe, logger, str_, parse_memory
 
 
 from .manager import JobManager
-from .models import add_job, Job
+from .models import add_job, add_jobs, Job
+from .logs import compress_logs
+from .graph import topological_sort
+
+class _TaskWatcher(object):
+  """Wakes up the scheduler as soon as one of its child processes has finished.
+  A handler for SIGCHLD is installed, which writes to a pipe that we can wait for.
+  Where this is not possible (e.g., when not running in the main thread), we simply sleep."""
+
+  def __init__(self):
+    self._pipe = None
+    if not hasattr(signal, 'SIGCHLD'):
+      return
+    read, write = os.pipe()
+    try:
+      import fcntl
+      for fd in (read, write):
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+      self._old_fd = signal.set_wakeup_fd(write)
+      self._old_handler = signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+      self._pipe = (read, write)
+    except ValueError as e:
+      # signals can only be handled in the main thread
+      logger.debug("Could not install the SIGCHLD handler (%s); falling back to polling", e)
+      os.close(read)
+      os.close(write)
+
+  def wait(self, timeout):
+    """Waits until a child process finished, or the timeout (in seconds) is reached."""
+    if self._pipe is None:
+      time.sleep(timeout)
+      return
+    try:
+      select.select([self._pipe[0]], [], [], timeout)
+    except (select.error, OSError):
+      # interrupted system call (Python 2)
+      pass
+    try:
+      while os.read(self._pipe[0], 4096):
+        pass
+    except OSError:
+      # the pipe is empty
+      pass
+
+  def close(self):
+    """Restores the previous signal handling."""
+    if self._pipe is not None:
+      signal.set_wakeup_fd(self._old_fd)
+      signal.signal(signal.SIGCHLD, self._old_handler)
+      for fd in self._pipe:
+        os.close(fd)
+      self._pipe = None
+
+
+def _machine_resources():
+  """Returns the number of CPUs and the physical memory in bytes of this machine; the memory is None if it cannot be determined."""
+  import multiprocessing
+  try:
+    cpus = multiprocessing.cpu_count()
+  except NotImplementedError:
+    cpus = 1
+  try:
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    memory = None
+  return cpus, memory
+
+
+class _Resources(object):
+  """Keeps track of the CPU slots and the memory that the running tasks requested, so that a task is only started when its request fits into the budget.
+  A budget of None is unlimited."""
+
+  def __init__(self, slots, memory):
+    self.slots = slots
+    self.memory = memory
+    self._requests = {}
+    self._used = [0, 0]
+
+  def fits(self, request):
+    """Returns True if the given (slots, memory) request fits into the remaining budget."""
+    return all(budget is None or used + requested <= budget for budget, used, requested in zip((self.slots, self.memory), self._used, request))
+
+  def acquire(self, process, request):
+    """Reserves the requested resources for the given process."""
+    self._requests[process] = request
+    self._used = [used + requested for used, requested in zip(self._used, request)]
+
+  def release(self, process):
+    """Frees the resources of the given finished process."""
+    request = self._requests.pop(process, (0, 0))
+    self._used = [used - requested for used, requested in zip(self._used, request)]
+
+
+class _JobGraph(object):
+  """Keeps the unfinished local jobs, their dependencies and the tasks that are ready to be executed in memory.
+  This allows the scheduler to update its state incrementally when a job finishes, instead of re-reading the whole database.
+  The database stays the reference: every task is validated against the database before it is started.
+
+  The ready tasks are started in the order of the rank of their jobs, see :py:meth:`update_ranks`."""
+
+  def __init__(self):
+    # the number of tasks that can be started
+    self.ready = 0
+    # a heap of (rank, job id) for the jobs that have tasks which can be started, and for each of these jobs the array ids of the tasks
+    self._heap = []
+    self._ready_tasks = {}
+    # for each known job, its priority, its estimated runtime and the (slots, memory) requested by each of its tasks
+    self._priority = {}
+    self._runtime = {}
+    self._requests = {}
+    # for each job, the highest priority and the longest chain of runtimes of the job and the known jobs that (indirectly) wait for it
+    self._downstream = {}
+    # for each known job, the unfinished jobs that it waits for
+    self._waiting_for = {}
+    # for each job, the known jobs that wait for it
+    self._dependents = collections.defaultdict(set)
+    # the known jobs that cannot be executed yet
+    self._blocked = set()
+    # for each job, the number of tasks that are ready or running
+    self._tasks = collections.defaultdict(int)
+
+  def __contains__(self, job_id):
+    return job_id in self._waiting_for
+
+  def is_blocked(self, job_id):
+    return job_id in self._blocked
+
+  def add(self, job, runtime = None):
+    """Adds the given job, which needs to have the status 'queued', 'waiting' or 'executing'; the estimated runtime is used to rank the jobs.
+    If no runtime is given, the estimate of a job that is added again is kept (1 second for new jobs)."""
+    if runtime is None:
+      runtime = self._runtime.get(job.unique, 1.)
+    self.remove(job.unique)
+    self._priority[job.unique] = job.priority or 0
+    self._runtime[job.unique] = runtime
+    try:
+      self._requests[job.unique] = job.requested_resources()
+    except ValueError as e:
+      logger.warning("Ignoring the resource requirements of job '%s': %s", job, e)
+      self._requests[job.unique] = (1, 0)
+    unfinished = set(dep.unique for dep in job.get_jobs_we_wait_for() if dep.status not in ('success', 'failure'))
+    self._waiting_for[job.unique] = unfinished
+    for dep in unfinished:
+      self._dependents[dep].add(job.unique)
+    if job.status == 'waiting':
+      self._blocked.add(job.unique)
+    else:
+      self.unblock(job)
+
+  def unblock(self, job):
+    """Puts all queued tasks of the given job into the ready queue."""
+    self._blocked.discard(job.unique)
+    if job.get_array():
+      tasks = [(job.unique, array_id) for array_id in job.array_ids(('queued',))]
+    elif job.status == 'queued':
+      tasks = [(job.unique, None)]
+    else:
+      tasks = []
+    if tasks:
+      if job.unique not in self._ready_tasks:
+        self._ready_tasks[job.unique] = collections.deque()
+        heapq.heappush(self._heap, (self._rank(job.unique), job.unique))
+      self._ready_tasks[job.unique].extend(array_id for _, array_id in tasks)
+    self.ready += len(tasks)
+    self._tasks[job.unique] += len(tasks)
+
+  def _rank(self, job_id):
+    # the highest priority first, then the longest chain of jobs, then the oldest job
+    priority, length = self._downstream.get(job_id, (self._priority.get(job_id, 0), self._runtime.get(job_id, 1.)))
+    return (-priority, -length, job_id)
+
+  def update_ranks(self):
+    """Ranks the known jobs by the highest priority of the job and the jobs that (indirectly) wait for it, so that the jobs that others with a high priority wait for are executed early.
+    Jobs with the same priority are ranked by the longest remaining downstream path, i.e., the highest sum of estimated runtimes of a chain of jobs that starts with the job, so that the critical path is executed first."""
+    # sort the jobs such that all jobs that wait for a job come before it
+    dependents = dict((job_id, [d for d in self._dependents.get(job_id, ()) if d in self._waiting_for]) for job_id in self._waiting_for)
+    order, cyclic = topological_sort(dependents)
+    self._downstream = {}
+    for job_id in order + cyclic:
+      priority, length = self._priority[job_id], 0.
+      for d in dependents[job_id]:
+        if d in self._downstream:
+          priority, length = max(priority, self._downstream[d][0]), max(length, self._downstream[d][1])
+      self._downstream[job_id] = (priority, length + self._runtime[job_id])
+    self._heap = [(self._rank(job_id), job_id) for job_id in self._ready_tasks]
+    heapq.heapify(self._heap)
+
+  def peek(self):
+    """Returns the job id and the (slots, memory) request of the ready task that should be started next."""
+    job_id = self._heap[0][1]
+    return job_id, self._requests.get(job_id, (1, 0))
+
+  def pop(self):
+    """Returns the (job id, array id) of the ready task that should be started next."""
+    job_id = self._heap[0][1]
+    tasks = self._ready_tasks[job_id]
+    array_id = tasks.popleft()
+    if not tasks:
+      heapq.heappop(self._heap)
+      del self._ready_tasks[job_id]
+    self.ready -= 1
+    return job_id, array_id
+
+  def task_done(self, job_id):
+    """Registers that a task of the given job finished (or was dropped); returns True if no other task of this job is ready or running."""
+    self._tasks[job_id] -= 1
+    return self._tasks[job_id] <= 0
+
+  def finish(self, job_id):
+    """Removes the given finished job and returns the ids of the jobs that do not need to wait any more."""
+    self.remove(job_id)
+    unblocked = []
+    for waiting in self._dependents.pop(job_id, ()):
+      if waiting in self._waiting_for:
+        self._waiting_for[waiting].discard(job_id)
+        if not self._waiting_for[waiting] and waiting in self._blocked:
+          unblocked.append(waiting)
+    return sorted(unblocked)
+
+  def remove(self, job_id):
+    """Forgets about the given job; its tasks that are still in the ready queue will be dropped when they are started."""
+    for dep in self._waiting_for.pop(job_id, ()):
+      self._dependents[dep].discard(job_id)
+    self._blocked.discard(job_id)
+    self._tasks.pop(job_id, None)
+    self._priority.pop(job_id, None)
+    self._runtime.pop(job_id, None)
+    self._requests.pop(job_id, None)
+
 
 class JobManagerLocal(JobManager):
   """Manages jobs run in parallel on the local machine."""
@@ -38,15 +271,16 @@ class JobManagerLocal(JobManager):
     JobManager.__init__(self, **kwargs)
 
 
-  def submit(self, command_line, name = None, array = None, dependencies = [], log_dir = None, dry_run = False, stop_on_failure = False, **kwargs):
+  def submit(self, command_line, name = None, array = None, dependencies = [], log_dir = None, dry_run = False, stop_on_failure = False, priority = 0, **kwargs):
     """Submits a job that will be executed on the local machine during a call to "run".
-    All kwargs will simply be ignored."""
+    Jobs with a higher ``priority`` are started first, see :py:meth:`run_scheduler`.
+    The grid arguments in kwargs are stored for re-submission to the grid; the requested slots (``pe_opt``) and memory (``memfree`` or ``hvmem``) are also respected by the local scheduler."""
     # remove duplicate dependencies
     dependencies = sorted(list(set(dependencies)))
 
     # add job to database
     self.lock()
-    job = add_job(self.session, command_line=command_line, name=name, dependencies=dependencies, array=array, log_dir=log_dir, stop_on_failure=stop_on_failure)
+    job = add_job(self.session, command_line=command_line, name=name, dependencies=dependencies, array=array, log_dir=log_dir, stop_on_failure=stop_on_failure, priority=priority, **kwargs)
     logger.info("Added job '%s' to the database", job)
 
     if dry_run:
@@ -62,6 +296,26 @@ class JobManagerLocal(JobManager):
     return job_id
 
 
+  def submit_many(self, jobs, dry_run = False):
+    """Submits several jobs within a single database transaction, which will be executed on the local machine during a call to "run".
+    Each job is given as a dictionary with the parameters of :py:meth:`submit`; jobs of the same batch can refer to each other in the dependencies, see :py:func:`gridtk.models.add_jobs`.
+    Returns the list of new job ids."""
+
+    if dry_run:
+      for job in jobs:
+        print("Would have added the Job", job, "to the database to be executed locally.")
+      return []
+
+    self.lock()
+    try:
+      job_ids = add_jobs(self.session, jobs)
+      logger.info("Added %d jobs to the database", len(job_ids))
+    finally:
+      # an invalid batch is rolled back completely
+      self.unlock()
+    return job_ids
+
+
   def resubmit(self, job_ids = None, also_success = False, running_jobs = False, new_command=None, **kwargs):
     """Re-submit jobs automatically"""
     self.lock()
@@ -81,6 +335,11 @@ class JobManagerLocal(JobManager):
         else:
           # re-submit job to the grid
           logger.info("Re-submitted job '%s' to the database", job)
+          if kwargs:
+            # e.g., the memory requirements have changed
+            arguments = job.get_arguments()
+            arguments.update(**kwargs)
+            job.set_arguments(**arguments)
           job.submit('local')
 
     self.session.commit()
@@ -112,12 +371,10 @@ class JobManagerLocal(JobManager):
 
       if array_job is not None and array_job.status in ('executing', 'queued', 'waiting'):
         logger.debug("Reset array job '%s' in the database", array_job)
-        array_job.status = 'submitted'
-      if array_job is None:
-        for array_job in job.array:
-          if array_job.status in ('executing', 'queued', 'waiting'):
-            logger.debug("Reset array job '%s' in the database", array_job)
-            array_job.status = 'submitted'
+        job.set_array_task(array_job.id, 'submitted')
+      if array_job is None and job.get_array():
+        logger.debug("Reset array jobs of job '%s' in the database", job.name)
+        job.move_array_tasks(('executing', 'queued', 'waiting'), 'submitted')
 
     self.session.commit()
     self.unlock()
@@ -126,23 +383,28 @@ class JobManagerLocal(JobManager):
 #####################################################################
 ###### Methods to run the jobs in parallel on the local machine #####
 
-  def _run_parallel_job(self, job_id, array_id = None, no_log = False, nice = None):
-    """Executes the code for this job on the local machine."""
+  def _run_parallel_job(self, job, array_job = None, no_log = False, nice = None, use_wrapper = False):
+    """Executes the code for this job on the local machine.
+    By default, the command line of the job is executed directly, and the caller is responsible to record the start and the end of the job in the database.
+    When ``use_wrapper`` is set, the job is executed through the ``jman run-job`` wrapper script (as in the grid), which updates the database itself."""
+    array_id = array_job.id if array_job is not None else None
     environ = copy.deepcopy(os.environ)
-    environ['JOB_ID'] = str(job_id)
+    environ['JOB_ID'] = str(job.unique)
     if array_id:
       environ['SGE_TASK_ID'] = str(array_id)
     else:
       environ['SGE_TASK_ID'] = 'undefined'
 
-    # generate call to the wrapper script
-    command = [self.wrapper_script, '-ld', self._database, 'run-job']
+    if use_wrapper:
+      # generate call to the wrapper script
+      command = [self.wrapper_script, '-ld', self._database, '--journal-mode', self._journal_mode] + (['--compress-logs', self._compress_logs] if self._compress_logs else []) + ['run-job']
+    else:
+      command = job.get_command_line()
 
     if nice is not None:
       command = ['nice', '-n%d'%nice] + command
 
-    job, array_job = self._job_and_array(job_id, array_id)
-    logger.info("Starting execution of Job '%s' (%s)", job.name, self._format_log(job_id, array_id, len(job.array)))
+    logger.info("Starting execution of Job '%s' (%s)", job.name, self._format_log(job.unique, array_id))
     # create log files
     if no_log or job.log_dir is None:
       out, err = sys.stdout, sys.stderr
@@ -158,103 +420,255 @@ class JobManagerLocal(JobManager):
     try:
       return subprocess.Popen(command, env=environ, stdout=out, stderr=err, bufsize=1)
     except OSError as e:
-      logger.error("Could not execute job '%s' (%s) locally\n- reason:\t%s\n- command line:\t%s\n- command:\t%s", job.name, self._format_log(job_id, array_id, len(job.array)), e, " ".join(job.get_command_line()), " ".join(command))
-      job.finish(117, array_id) # ASCII 'O'
+      logger.error("Could not execute job '%s' (%s) locally\n- reason:\t%s\n- command line:\t%s\n- command:\t%s", job.name, self._format_log(job.unique, array_id), e, " ".join(job.get_command_line()), " ".join(command))
+      if use_wrapper:
+        job.finish(117, array_id) # ASCII 'O'
+      else:
+        # the same as the wrapper script does when the command line cannot be executed
+        print("ERROR: The job with id '%d' could not be executed: %s" % (job.unique, e), file=err)
+        job.finish(69, array_id) # ASCII: 'E'
       return None
 
 
   def _format_log(self, job_id, array_id = None, array_count = 0):
     return ("%d (%d/%d)" % (job_id, array_id, array_count)) if array_id is not None and array_count else ("%d (%d)" % (job_id, array_id)) if array_id is not None else ("%d" % job_id)
 
-  def run_scheduler(self, parallel_jobs = 1, job_ids = None, sleep_time = 0.1, die_when_finished = False, no_log = False, nice = None):
-    """Starts the scheduler, which is constantly checking for jobs that should be ran."""
+  def _database_state(self):
+    """Returns a cheap fingerprint of the database file, which changes whenever a transaction was committed.
+    It consists of the file status and the change counter stored in the SQLite header, as well as the status and the header of the write-ahead log, so that no database lock is required.
+    Empty files are treated like missing files, since opening a connection creates an empty write-ahead log that does not contain any changes."""
+    state = []
+    for path, offset, size in ((self._database, 24, 4), (self._database + '-wal', 0, 32)):
+      try:
+        stat = os.stat(path)
+        if stat.st_size == 0:
+          state.append(None)
+          continue
+        with open(path, 'rb') as f:
+          f.seek(offset)
+          state.append((stat.st_mtime, stat.st_size, stat.st_ino, f.read(size)))
+      except (IOError, OSError):
+        state.append(None)
+    return tuple(state)
+
+
+  def _lock_state(self):
+    """Locks the database for writing and returns its state, see :py:meth:`_database_state`.
+    The write transaction is started before the state is read, so that no other process can commit changes in between, which would be mistaken for our own."""
+    self.lock()
+    self.session.connection().execute(sqlalchemy.text('SELECT 1'))
+    return self._database_state()
+
+
+  def _estimated_runtimes(self, names):
+    """Returns the average runtime of the finished jobs with each of the given names, and the average runtime of all these finished jobs (or 1 second, if none of them finished).
+    Only the jobs with the given names are read, using the index on the job names."""
+    names = sorted(set(names), key=str)
+    query = self.session.query(Job.name, sqlalchemy.func.avg(Job.finish_time - Job.start_time), sqlalchemy.func.count(Job.unique)).filter(Job.status.in_(('success', 'failure'))).filter(Job.start_time != None).filter(Job.finish_time != None)
+    conditions = [Job.name.in_([name for name in names[i:i+500] if name is not None]) for i in range(0, len(names), 500)]
+    if None in names:
+      conditions.append(Job.name == None)
+    runtimes, total, count = {}, 0., 0
+    for condition in conditions:
+      for name, average, n in query.filter(condition).group_by(Job.name):
+        runtimes[name] = average
+        total, count = total + average * n, count + n
+    return runtimes, total / count if count else 1.
+
+
+  def _update_graph(self, graph, job_ids):
+    """Adds the unfinished local jobs that are not yet known to the given graph, and unblocks the known jobs that have been queued in the meantime."""
+    query = self.session.query(Job.unique, Job.status).filter(Job.queue_name == 'local').filter(Job.status.in_(('submitted', 'queued', 'waiting', 'executing')))
+    if job_ids is not None:
+      query = query.filter(Job.unique.in_(job_ids))
+    new_ids = [unique for unique, status in query if unique not in graph or (status == 'queued' and graph.is_blocked(unique))]
+    if not new_ids:
+      return
+
+    jobs = self.get_jobs(new_ids, load=('array', 'dependencies'))
+    # put all new jobs into the queue
+    for job in jobs:
+      if job.status == 'submitted':
+        job.queue()
+    runtimes, default = self._estimated_runtimes(job.name for job in jobs if job.unique not in graph)
+    for job in jobs:
+      if job.unique in graph:
+        graph.unblock(job)
+      elif job.status in ('queued', 'waiting', 'executing'):
+        graph.add(job, runtimes.get(job.name, default))
+    graph.update_ranks()
+
+
+  def _stop_dependent_jobs(self, job, queue_name = 'local'):
+    """Resets the jobs that depend on the given failed job, as done by the wrapper script for jobs with the stop-on-failure flag; only the jobs that are executed locally are reset."""
+    return JobManager._stop_dependent_jobs(self, job, queue_name)
+
+
+  def _finish_job(self, graph, job):
+    """Updates the graph after the last known task of the given job has finished."""
+    if job.get_array() and job.status == 'executing':
+      # sometimes, the 'finish' command did not work for array jobs
+      job.finish(0, -1)
+    if job.status not in ('success', 'failure'):
+      if job.status != 'executing':
+        # the job has been reset in the meantime; it will be re-read from the database
+        graph.remove(job.unique)
+      return
+
+    for waiting in self.get_jobs(graph.finish(job.unique), load=('array', 'dependencies')):
+      if waiting.status == 'waiting':
+        waiting.queue()
+      if waiting.status == 'queued':
+        graph.unblock(waiting)
+      elif waiting.status in ('success', 'failure'):
+        # e.g., the job depends on a failed job and should stop on failure
+        self._finish_job(graph, waiting)
+      else:
+        graph.remove(waiting.unique)
+
+
+  def run_scheduler(self, parallel_jobs = 1, job_ids = None, sleep_time = 0.1, die_when_finished = False, no_log = False, nice = None, use_wrapper = False, slots = None, memory = None):
+    """Starts the scheduler, which executes the jobs that should be ran.
+    The scheduler is woken up when one of its jobs finished, and every ``sleep_time`` seconds to check if the database has changed (e.g., since new jobs were submitted).
+    The unfinished jobs are kept in memory, so that only the jobs that changed need to be read from the database.
+    Among the tasks that can be executed, the tasks of the jobs with the highest priority are started first; otherwise, jobs on the longest chain of estimated runtimes are preferred, see :py:meth:`_JobGraph.update_ranks`.
+    Besides running at most ``parallel_jobs`` tasks at the same time, the CPU slots and the memory (e.g. '64G') that the jobs requested with the ``pe_opt``, ``memfree`` and ``hvmem`` arguments need to fit into the given ``slots`` and ``memory``, which default to the number of CPUs and the physical memory of this machine.
+    The next task waits until enough resources are free, and no task of a lower rank is started before it; tasks that request more than the whole budget are executed when no other task is running.
+    The command lines of the jobs are executed directly, and the scheduler records their start and end; with ``use_wrapper``, each job is executed through the ``jman run-job`` wrapper script instead."""
     running_tasks = []
     finished_tasks = set()
+    graph = _JobGraph()
+    watcher = _TaskWatcher()
+    machine_slots, machine_memory = _machine_resources()
+    resources = _Resources(slots if slots is not None else machine_slots, parse_memory(memory) if memory is not None else machine_memory)
+    machine_name = socket.gethostname()
+    # the state of the database when we last read it (or after our own changes, if nobody else changed it in the meantime)
+    last_state = None
+    # the log files of the finished tasks that still need to be compressed
+    finished_logs = []
+    compressor = None
     try:
 
       # keep the scheduler alive until every job is finished or the KeyboardInterrupt is caught
       while True:
-        # Flag that might be set in some rare cases, and that prevents the scheduler to die
-        repeat_execution = False
-        # FIRST, try if there are finished processes
-        for task_index in range(len(running_tasks)-1, -1, -1):
-          task = running_tasks[task_index]
-          process = task[0]
+        database_state = self._database_state()
 
-          if process.poll() is not None:
+        # FIRST, try if there are finished processes
+        ended_tasks = [task for task in running_tasks if task[0].poll() is not None]
+        if ended_tasks:
+          synced = self._lock_state() == last_state
+          for task in ended_tasks:
             # process ended
+            resources.release(task[0])
             job_id = task[1]
             array_id = task[2] if len(task) > 2 else None
-            self.lock()
             job, array_job = self._job_and_array(job_id, array_id)
+            if job is None:
+              # the job has been deleted in the meantime
+              running_tasks.remove(task)
+              graph.remove(job_id)
+              continue
+            if not use_wrapper:
+              job.finish(task[0].returncode, array_id)
+              array_job = job.get_array_task(array_id) if array_id is not None else None
+              if job.stop_on_failure and job.status == 'failure':
+                deps = self._stop_dependent_jobs(job)
+                logger.warn("Stopped dependent jobs '%s' since job '%s' failed." % (str(deps), self._format_log(job.unique)))
             jj = array_job if array_job is not None else job
             result = "%s (%d)" % (jj.status, jj.result) if jj.result is not None else "%s (?)" % jj.status
             if jj.status not in ('success', 'failure'):
               logger.error("Job '%s' (%s) finished with status '%s' instead of 'success' or 'failure'. Usually this means an internal error. Check your wrapper_script parameter!", job.name, self._format_log(job_id, array_id), jj.status)
               raise StopIteration("Job did not finish correctly.")
             logger.info("Job '%s' (%s) finished execution with result '%s'", job.name, self._format_log(job_id, array_id), result)
-            self.unlock()
+            if self._compress_logs and not use_wrapper and not no_log:
+              # the wrapper script compresses the log files itself
+              finished_logs.extend(f for f in (jj.std_out_file(), jj.std_err_file()) if f is not None)
             finished_tasks.add(job_id)
             # in any case, remove the job from the list
-            del running_tasks[task_index]
-
-        # SECOND, check if new jobs can be submitted; THIS NEEDS TO LOCK THE DATABASE
-        if len(running_tasks) < parallel_jobs:
-          # get all unfinished jobs:
-          self.lock()
-          jobs = self.get_jobs(job_ids)
-          # put all new jobs into the queue
-          for job in jobs:
-            if job.status == 'submitted' and job.queue_name == 'local':
-              job.queue()
-
-          # get all unfinished jobs that are submitted to the local queue
-          unfinished_jobs = [job for job in jobs if job.status in ('queued', 'executing') and job.queue_name == 'local']
-          for job in unfinished_jobs:
-            if job.array:
-              # find array jobs that can run
-              queued_array_jobs = [array_job for array_job in job.array if array_job.status == 'queued']
-              if not len(queued_array_jobs):
-                job.finish(0, -1)
-                repeat_execution = True
-              else:
-                # there are new array jobs to run
-                for i in range(min(parallel_jobs - len(running_tasks), len(queued_array_jobs))):
-                  array_job = queued_array_jobs[i]
-                  # start a new job from the array
-                  process = self._run_parallel_job(job.unique, array_job.id, no_log=no_log, nice=nice)
-                  if process is None:
-                    continue
-                  running_tasks.append((process, job.unique, array_job.id))
-                  # we here set the status to executing manually to avoid jobs to be run twice
-                  # e.g., if the loop is executed while the asynchronous job did not start yet
-                  array_job.status = 'executing'
-                  job.status = 'executing'
-                  if len(running_tasks) == parallel_jobs:
-                    break
+            running_tasks.remove(task)
+            if graph.task_done(job_id):
+              self._finish_job(graph, job)
+          self.session.commit()
+          self.unlock()
+          if synced:
+            # our own changes do not need to be read again
+            last_state = database_state = self._database_state()
+          if finished_logs:
+            # the log files are compressed in the background, so that the next jobs are not delayed
+            if compressor is None:
+              from multiprocessing.pool import ThreadPool
+              compressor = ThreadPool(1)
+            compressor.apply_async(compress_logs, (finished_logs, self._compress_logs))
+            finished_logs = []
+
+        # SECOND, check if there are new jobs in the database; THIS NEEDS TO LOCK THE DATABASE
+        if database_state != last_state:
+          # any change of the database after this point will be detected in the next iteration
+          last_state = database_state
+          synced = self._lock_state() == last_state
+          self._update_graph(graph, job_ids)
+          self.session.commit()
+          self.unlock()
+          if synced:
+            last_state = self._database_state()
+
+        # THIRD, start the tasks that are ready to run
+        if graph.ready and len(running_tasks) < parallel_jobs:
+          synced = self._lock_state() == last_state
+          while graph.ready and len(running_tasks) < parallel_jobs:
+            job_id, request = graph.peek()
+            if not resources.fits(request):
+              if running_tasks:
+                # wait until enough resources are free
+                break
+              logger.warning("Job '%s' requests %d slots and %d MB of memory, which exceeds the available resources; it is executed without other jobs", self._format_log(job_id), request[0], request[1] // (1 << 20))
+            job_id, array_id = graph.pop()
+            # assure that the task still needs to be executed
+            jobs = self.get_jobs((job_id,))
+            job = jobs[0] if jobs else None
+            if array_id is not None:
+              array_job = job.get_array_task(array_id) if job is not None else None
+              valid = job is not None and job.status in ('queued', 'executing') and array_job is not None and array_job.status == 'queued'
+            else:
+              array_job = None
+              valid = job is not None and job.status == 'queued'
+            if not valid:
+              if job is not None and job.status == 'waiting':
+                # the job needs to wait for another job again; its runtime estimate is kept
+                graph.add(job)
+              elif graph.task_done(job_id) and job is not None:
+                self._finish_job(graph, job)
+              continue
+
+            # start a new job (or a new job from the array)
+            process = self._run_parallel_job(job, array_job, no_log=no_log, nice=nice, use_wrapper=use_wrapper)
+            if process is None:
+              if graph.task_done(job_id):
+                self._finish_job(graph, job)
+              continue
+            running_tasks.append((process, job_id, array_id) if array_id is not None else (process, job_id))
+            resources.acquire(process, request)
+            if use_wrapper:
+              # we here set the status to executing manually to avoid jobs to be run twice
+              # e.g., if the loop is executed while the asynchronous job did not start yet
+              if array_job is not None:
+                job.set_array_task(array_id, 'executing')
+              job.status = 'executing'
             else:
-              if job.status == 'queued':
-                # start a new job
-                process = self._run_parallel_job(job.unique, no_log=no_log, nice=nice)
-                if process is None:
-                  continue
-                running_tasks.append((process, job.unique))
-                # we here set the status to executing manually to avoid jobs to be run twice
-                # e.g., if the loop is executed while the asynchronous job did not start yet
-                job.status = 'executing'
-            if len(running_tasks) == parallel_jobs:
-              break
+              job.execute(array_id, machine_name)
 
           self.session.commit()
           self.unlock()
+          if synced:
+            last_state = self._database_state()
 
         # if after the submission of jobs there are no jobs running, we should have finished all the queue.
-        if die_when_finished and not repeat_execution and len(running_tasks) == 0:
+        if die_when_finished and not graph.ready and len(running_tasks) == 0:
           logger.info("Stopping task scheduler since there are no more jobs running.")
           break
 
-        # THIRD: sleep the desired amount of time before re-checking
-        time.sleep(sleep_time)
+        # FOURTH: wait until a job finishes, or until the desired amount of time has passed
+        watcher.wait(sleep_time)
 
     # This is the only way to stop: you have to interrupt the scheduler
     except (KeyboardInterrupt, StopIteration):
@@ -267,9 +681,14 @@ class JobManagerLocal(JobManager):
         self.stop_job(task[1])
       # stop all jobs that are currently running or queued
       self.stop_jobs(job_ids)
+    finally:
+      watcher.close()
+      if compressor is not None:
+        compressor.close()
+        compressor.join()
 
     # check the result of the jobs that we have run, and return the list of failed jobs
-    self.lock()
+    self.lock(read_only=True)
     jobs = self.get_jobs(finished_tasks)
     failures = [job.unique for job in jobs if job.status != 'success']
     self.unlock()
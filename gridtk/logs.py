@@ -0,0 +1,778 @@
+#!/usr/bin/env python
+# vim: set fileencoding=utf-8 :
+
+"""Functions to read the log files of the jobs efficiently.
+
+Log files can be huge, so they are never read as a whole, but streamed in
+chunks, and only the requested lines are read.  Log files of finished jobs
+might be compressed (see :py:func:`compress_log`); all functions in this module
+read the compressed files transparently.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import io
+import re
+import codecs
+import time
+import shutil
+import tempfile
+import collections
+import itertools
+import six
+
+from .tools import logger
+
+# The size of the chunks in which the log files are read
+CHUNK_SIZE = 1 << 16
+
+# Log files up to this size are read into memory in parallel before they are printed; larger files are streamed
+SMALL_FILE_SIZE = 1 << 20
+
+# Marks log files that are too large to be read in advance
+_LARGE = object()
+
+# The size of the chunks in which log files are searched
+GREP_CHUNK_SIZE = 1 << 22
+
+# The maximum number of search patterns, for which the results are kept in the index of the log files
+INDEX_PATTERNS = 16
+
+# The suffixes of the compressed log files for each of the supported compression methods
+COMPRESSION = collections.OrderedDict((('gzip', '.gz'), ('xz', '.xz')))
+
+
+def log_files(filename):
+  """Returns the names of the files in which the log file with the given name might be stored, i.e., the name itself and the names of its compressed versions."""
+  return [filename] + [filename + suffix for suffix in COMPRESSION.values()]
+
+
+def find_log(filename):
+  """Returns the name of the file that stores the log file with the given name, or None if neither the file nor a compressed version of it exists."""
+  for path in log_files(filename):
+    if os.path.exists(path):
+      return path
+  return None
+
+
+def _is_compressed(path):
+  return path.endswith(tuple(COMPRESSION.values()))
+
+
+def open_log(filename):
+  """Opens the log file with the given name, or its compressed version, for reading in binary mode."""
+  path = find_log(filename) or filename
+  if path.endswith(COMPRESSION['gzip']):
+    import gzip
+    return gzip.open(path, 'rb')
+  if path.endswith(COMPRESSION['xz']):
+    import lzma
+    return lzma.open(path, 'rb')
+  return open(path, 'rb')
+
+
+def compress_log(filename, method = 'gzip'):
+  """Compresses the given log file with the given method, one of the keys of :py:data:`COMPRESSION`, and removes the original file.
+  Returns the name of the compressed file, or None if the file does not exist or is empty; empty files are not compressed."""
+  suffix = COMPRESSION[method]
+  try:
+    status = os.stat(filename)
+  except (IOError, OSError):
+    return None
+  if status.st_size == 0:
+    return None
+  directory, basename = os.path.split(filename)
+  # the compressed file is written to a temporary file first, so that readers never see a partially compressed file
+  fd, temp = tempfile.mkstemp(prefix='.' + basename + '.', dir=directory or '.')
+  try:
+    with open(filename, 'rb') as f, os.fdopen(fd, 'wb') as raw:
+      if method == 'gzip':
+        import gzip
+        compressed = gzip.GzipFile(basename, 'wb', 6, raw)
+      else:
+        import lzma
+        compressed = lzma.LZMAFile(raw, 'wb')
+      with compressed:
+        shutil.copyfileobj(f, compressed, CHUNK_SIZE)
+    os.chmod(temp, status.st_mode & 0o777)
+    os.rename(temp, filename + suffix)
+  except Exception:
+    os.remove(temp)
+    raise
+  os.remove(filename)
+  logger.debug("Compressed log file '%s' to '%s'" % (filename, filename + suffix))
+  return filename + suffix
+
+
+def compress_logs(filenames, method = 'gzip'):
+  """Compresses the given log files, see :py:func:`compress_log`; errors are logged, but not raised."""
+  for filename in filenames:
+    try:
+      compress_log(filename, method)
+    except (IOError, OSError) as e:
+      logger.warning("Could not compress log file '%s': %s" % (filename, e))
+
+
+def _content_end(f, end):
+  """Returns the position after the last non-white-space character before the given position in the given binary file."""
+  position = end
+  while position > 0:
+    size = min(CHUNK_SIZE, position)
+    f.seek(position - size)
+    stripped = f.read(size).rstrip()
+    if stripped:
+      return position - size + len(stripped)
+    position -= size
+  return 0
+
+
+def _tail_start(f, end, lines):
+  """Returns the position of the first of the last ``lines`` lines that end at the given position."""
+  if lines <= 0:
+    return end
+  position, count = end, 0
+  while position > 0:
+    size = min(CHUNK_SIZE, position)
+    f.seek(position - size)
+    data = f.read(size)
+    index = len(data)
+    while True:
+      index = data.rfind(b'\n', 0, index)
+      if index < 0:
+        break
+      count += 1
+      if count == lines:
+        return position - size + index + 1
+    position -= size
+  return 0
+
+
+def _head_end(f, start, end, lines):
+  """Returns the position after the first ``lines`` lines that start at the given position."""
+  if lines <= 0:
+    return start
+  position, count = start, 0
+  f.seek(start)
+  while position < end:
+    data = f.read(min(CHUNK_SIZE, end - position))
+    if not data:
+      break
+    index = -1
+    while True:
+      index = data.find(b'\n', index + 1)
+      if index < 0:
+        break
+      count += 1
+      if count == lines:
+        return position + index
+    position += len(data)
+  return end
+
+
+def log_range(f, size, head = None, tail = None):
+  """Returns the (start, end) positions of the part of the given binary log file that should be printed.
+  Trailing white space is never printed; if given, only the first ``head`` or the last ``tail`` lines are selected."""
+  end = _content_end(f, size)
+  start = 0
+  if tail is not None:
+    start = _tail_start(f, end, tail)
+  if head is not None:
+    end = _head_end(f, start, end, head)
+  return start, end
+
+
+def _list_directory(directory):
+  """Returns the set of names in the given directory, or an empty set if it does not exist."""
+  try:
+    if hasattr(os, 'scandir'):
+      return set(entry.name for entry in os.scandir(directory))
+    return set(os.listdir(directory))
+  except (IOError, OSError):
+    return set()
+
+
+def _remove(path):
+  try:
+    os.remove(path)
+    return True
+  except (IOError, OSError):
+    # e.g., the file has been removed in the meantime
+    return False
+
+
+def remove_logs(filenames, directories = (), threads = 16):
+  """Removes the given log files, or their compressed versions, and afterwards the given directories, if they are empty.
+  Each directory is listed only once instead of checking every file, and the files are removed by several threads in parallel, which is much faster on network file systems.
+  Returns the number of removed files."""
+  names = collections.defaultdict(list)
+  for filename in filenames:
+    directory, _, basename = filename.rpartition(os.sep)
+    names[directory].append(basename)
+
+  # the names that are left in the listed directories
+  remaining, paths = {}, []
+  for directory in sorted(names):
+    path = os.path.normpath(directory or '.')
+    existing = _list_directory(path)
+    # the compressed log files, indexed by the names of the original files
+    compressed = collections.defaultdict(list)
+    for name in existing:
+      for suffix in COMPRESSION.values():
+        if name.endswith(suffix):
+          compressed[name[:-len(suffix)]].append(name)
+    for basename in names[directory]:
+      found = ([basename] if basename in existing else []) + compressed.get(basename, [])
+      for name in found:
+        existing.discard(name)
+        paths.append(path + os.sep + name)
+    remaining[path] = existing
+
+  if len(paths) > 1 and threads > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(threads, len(paths)))
+    try:
+      removed = sum(pool.map(_remove, paths, chunksize=16))
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    removed = sum(_remove(path) for path in paths)
+  logger.debug("Removed %d log files" % removed)
+
+  for directory in sorted(set(os.path.normpath(d) for d in directories)):
+    existing = remaining[directory] if directory in remaining else _list_directory(directory)
+    if os.path.isdir(directory) and not existing:
+      try:
+        os.rmdir(directory)
+        logger.info("Removed empty log directory '%s'" % directory)
+      except OSError:
+        # new files have been written in the meantime
+        pass
+  return removed
+
+
+def _select(f, head, tail, write):
+  """Writes the part of the given binary log file that :py:func:`log_range` selects using the given function.
+  Compressed files cannot be read backwards, so they are read sequentially, keeping only the selected lines in memory."""
+  if head is None and tail is None:
+    # white space is only written when it is followed by other characters
+    pending = b''
+    for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+      stripped = data.rstrip()
+      if stripped:
+        write(pending + stripped)
+        pending = data[len(stripped):]
+      else:
+        pending += data
+    return
+  if tail is not None:
+    lines, blank = collections.deque(maxlen=max(tail, 0)), []
+    for line in f:
+      # empty lines at the end of the file are not counted
+      if line.strip():
+        lines.extend(blank)
+        del blank[:]
+        lines.append(line)
+      else:
+        blank.append(line)
+  else:
+    lines, more = [], False
+    for line in f:
+      if len(lines) < head:
+        lines.append(line)
+      elif line.strip():
+        # the selected lines are not followed by white space only
+        more = True
+        break
+    if more:
+      data = b''.join(lines)
+      write(data[:-1] if data.endswith(b'\n') else data)
+      return
+  data = b''.join(lines).rstrip()
+  if head is not None and tail is not None:
+    data = b'\n'.join(data.split(b'\n')[:head]) if head > 0 else b''
+  if data:
+    write(data)
+
+
+def _write_bytes(stream, data, decoder = None):
+  """Writes the given bytes to the given text stream."""
+  buffer = getattr(stream, 'buffer', None)
+  if buffer is not None:
+    stream.flush()
+    buffer.write(data)
+    buffer.flush()
+  elif six.PY2:
+    stream.write(data)
+  else:
+    # the decoder keeps multi-byte characters that are split between chunks
+    decoder = decoder or codecs.getincrementaldecoder('utf-8')('replace')
+    stream.write(decoder.decode(data))
+
+
+def _sendfile(f, start, end, stream):
+  """Copies the given part of the given binary file to the given stream without copying the data through user space.
+  Returns the position up to which the file was copied, which is ``start`` when the stream is not a file."""
+  try:
+    out = stream.fileno()
+  except (AttributeError, ValueError, io.UnsupportedOperation):
+    return start
+  if not hasattr(os, 'sendfile'):
+    return start
+  stream.flush()
+  position = start
+  try:
+    while position < end:
+      sent = os.sendfile(out, f.fileno(), position, end - position)
+      if sent == 0:
+        break
+      position += sent
+  except OSError:
+    # e.g., the output is a file system that does not support sendfile
+    pass
+  return position
+
+
+def _copy(f, start, end, stream):
+  """Copies the given part of the given binary file to the given stream in chunks."""
+  position = _sendfile(f, start, end, stream)
+  f.seek(position)
+  decoder = codecs.getincrementaldecoder('utf-8')('replace')
+  while position < end:
+    data = f.read(min(CHUNK_SIZE, end - position))
+    if not data:
+      break
+    _write_bytes(stream, data, decoder)
+    position += len(data)
+
+
+def _print_large(filename, head, tail, stream):
+  """Copies the selected part of the given large log file to the given stream."""
+  path = find_log(filename)
+  if path is None:
+    return
+  with open_log(path) as f:
+    if _is_compressed(path):
+      decoder = codecs.getincrementaldecoder('utf-8')('replace')
+      _select(f, head, tail, lambda data: _write_bytes(stream, data, decoder))
+    else:
+      start, end = log_range(f, os.fstat(f.fileno()).st_size, head, tail)
+      _copy(f, start, end, stream)
+
+
+def _prefetch(arguments):
+  """Returns the contents of the given log file if it is small, :py:data:`_LARGE` for large files, or None if the file does not exist or is empty."""
+  filename, head, tail = arguments
+  try:
+    path = find_log(filename)
+    if path is None:
+      return None
+    size = os.stat(path).st_size
+    if size == 0:
+      return None
+    if _is_compressed(path):
+      # compressed files are decompressed in advance, if only a few lines are selected or if they are small
+      if head is None and tail is None and size > SMALL_FILE_SIZE // 16:
+        return _LARGE
+      data = io.BytesIO()
+      with open_log(path) as f:
+        _select(f, head, tail, data.write)
+      return data.getvalue()
+    if size > SMALL_FILE_SIZE:
+      return _LARGE
+    with open(path, 'rb') as f:
+      data = f.read()
+  except (IOError, OSError, EOFError):
+    return None
+  start, end = log_range(io.BytesIO(data), len(data), head, tail)
+  return data[start:end]
+
+
+def _read_ahead(pool, function, arguments, window):
+  """Yields the results of the function for the given arguments in order.
+  The results are computed by the given pool, but at most ``window`` results are computed (and kept in memory) before they are consumed."""
+  arguments = iter(arguments)
+  pending = collections.deque(pool.apply_async(function, (argument,)) for argument in itertools.islice(arguments, window))
+  while pending:
+    result = pending.popleft().get()
+    pending.extend(pool.apply_async(function, (argument,)) for argument in itertools.islice(arguments, 1))
+    yield result
+
+
+def print_logs(items, head = None, tail = None, stream = None, threads = 8):
+  """Prints the given texts and the contents of the given log files in the given order.
+
+  Keyword parameters:
+
+  items
+    A list of texts, and of tuples of a log file name and a delimiter, which
+    is printed after the contents of the log file; log files that do not exist
+    or that are empty are skipped
+
+  head, tail
+    If given, only the first or the last lines of each log file are printed
+
+  stream
+    The stream to write into; sys.stdout by default
+
+  threads
+    The number of threads that read small log files in advance
+  """
+  stream = stream or sys.stdout
+  files = [(item[0], head, tail) for item in items if not isinstance(item, six.string_types)]
+  if len(files) > 1 and threads > 1:
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(threads)
+    # the results are returned in order, while the next files are read in the background;
+    # the read-ahead is limited, so that the memory does not grow with the size of all logs when the output is consumed slowly
+    contents = _read_ahead(pool, _prefetch, files, 2 * threads)
+  else:
+    pool = None
+    contents = (_prefetch(f) for f in files)
+
+  try:
+    for item in items:
+      if isinstance(item, six.string_types):
+        print(item, file=stream)
+        continue
+      filename, delimiter = item
+      content = next(contents)
+      if content is None:
+        continue
+      logger.info("Contents of log file: '%s'" % filename)
+      if content is _LARGE:
+        _print_large(filename, head, tail, stream)
+      else:
+        _write_bytes(stream, content)
+      print(file=stream)
+      print(delimiter, file=stream)
+  finally:
+    if pool is not None:
+      pool.terminate()
+      pool.join()
+
+
+class _Inotify(object):
+  """Waits for changes of files in a set of directories using Linux' inotify, if available.
+  Changes on network file systems, which are done on other machines, are not reported, so the files need to be checked regularly anyways."""
+
+  # see /usr/include/linux/inotify.h
+  IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE = 0x2, 0x8, 0x80, 0x100
+
+  def __init__(self):
+    self._fd = None
+    self._directories = {}
+    try:
+      import ctypes, ctypes.util
+      self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+      fd = self._libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+      return
+    if fd >= 0:
+      self._fd = fd
+
+  def watch(self, directory):
+    """Adds the given directory to the watched directories."""
+    if self._fd is None or directory in self._directories.values():
+      return
+    wd = self._libc.inotify_add_watch(self._fd, directory.encode(sys.getfilesystemencoding()), self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE)
+    if wd >= 0:
+      self._directories[wd] = directory
+
+  def wait(self, timeout):
+    """Waits until a file in one of the watched directories changes, or until the timeout is reached.
+    Returns the set of changed files, or None if the changes are unknown (i.e., all files need to be checked)."""
+    import select, struct
+    if self._fd is None or not self._directories:
+      time.sleep(timeout)
+      return None
+    if not select.select([self._fd], [], [], timeout)[0]:
+      return None
+    changed = set()
+    while True:
+      try:
+        data = os.read(self._fd, 1 << 16)
+      except OSError:
+        # no more events
+        break
+      position = 0
+      while position + 16 <= len(data):
+        wd, mask, cookie, length = struct.unpack_from('iIII', data, position)
+        name = data[position + 16 : position + 16 + length].rstrip(b'\0').decode(sys.getfilesystemencoding())
+        if wd in self._directories:
+          changed.add(os.path.join(self._directories[wd], name))
+        position += 16 + length
+    return changed
+
+  def close(self):
+    if self._fd is not None:
+      os.close(self._fd)
+      self._fd = None
+
+
+def follow_logs(get_files, interval = 1., tail = None, stream = None):
+  """Prints the contents of the given log files as they grow, like ``tail -f``.
+
+  Keyword parameters:
+
+  get_files
+    A function that returns the list of log files to follow, and whether the
+    jobs that write them are still running; it is called regularly, so that
+    log files of newly started tasks are followed as well
+
+  interval
+    The maximum number of seconds between two checks of the files; changes of
+    files on local file systems are detected immediately
+
+  tail
+    If given, only the last lines of the log files that exist when starting
+    are printed; otherwise, their whole contents is printed
+
+  stream
+    The stream to write into; sys.stdout by default
+  """
+  stream = stream or sys.stdout
+  # the number of bytes of each file that have been printed already (None for files that were there before)
+  offsets = {}
+  # the followed files indexed by their absolute paths, as reported by inotify
+  paths = {}
+  # the files that have been compressed while they were followed
+  compressed = set()
+  current = [None]
+  inotify = _Inotify()
+
+  def _header(filename):
+    if current[0] != filename:
+      print("\n==> %s <==" % filename, file=stream)
+      current[0] = filename
+
+  def _print_compressed(filename):
+    # the file has been compressed after its job finished; prints the part that has not been printed yet, only once
+    path = find_log(filename)
+    if path is None or not _is_compressed(path) or filename in compressed:
+      return
+    compressed.add(filename)
+    offset = offsets[filename]
+    data = io.BytesIO()
+    try:
+      with open_log(path) as f:
+        if offset is None:
+          _select(f, None, tail, data.write)
+        else:
+          f.seek(offset)
+          _select(f, None, None, data.write)
+    except (IOError, OSError, EOFError):
+      return
+    if data.getvalue():
+      _header(filename)
+      _write_bytes(stream, data.getvalue())
+      print(file=stream)
+
+  def _print_new(filename):
+    # prints the part of the given file that has not been printed yet
+    try:
+      size = os.stat(filename).st_size
+    except (IOError, OSError):
+      _print_compressed(filename)
+      return
+    offset = offsets[filename]
+    if offset is not None and size < offset:
+      # the file has been truncated (e.g., by a re-submission of the job)
+      offset = 0
+    if size == offset:
+      return
+    with open(filename, 'rb') as f:
+      if offset is None:
+        offset = _tail_start(f, _content_end(f, size), tail) if tail is not None else 0
+      if size > offset:
+        _header(filename)
+        _copy(f, offset, size, stream)
+    offsets[filename] = size
+
+  try:
+    first = True
+    while True:
+      files, running = get_files()
+      for filename in files:
+        if filename not in offsets:
+          # files that exist when starting might be printed partially; new files are printed completely
+          offsets[filename] = None if first and find_log(filename) is not None else 0
+          paths[os.path.abspath(filename)] = filename
+          inotify.watch(os.path.dirname(os.path.abspath(filename)))
+      first = False
+      for filename in sorted(offsets):
+        _print_new(filename)
+      stream.flush()
+      if not running:
+        break
+
+      # wait for changes of the files, until the list of files needs to be updated
+      deadline = time.time() + interval
+      while True:
+        timeout = deadline - time.time()
+        if timeout <= 0:
+          break
+        changed = inotify.wait(timeout)
+        if changed is None:
+          break
+        for path in sorted(changed & set(paths)):
+          _print_new(paths[path])
+        stream.flush()
+  finally:
+    inotify.close()
+
+
+def _grep_file(arguments):
+  """Counts the lines of the given log file, and the lines that contain a match of the given regular expression.
+  Returns the file name, the path, size and modification time of the file that was searched, and the two counts; or None if the file does not exist."""
+  filename, pattern, flags = arguments
+  regex = re.compile(pattern, flags | re.MULTILINE)
+  path = find_log(filename)
+  if path is None:
+    return None
+  try:
+    status = os.stat(path)
+    lines = matches = 0
+    rest = b''
+    with open_log(path) as f:
+      while True:
+        data = f.read(GREP_CHUNK_SIZE)
+        # only complete lines are searched; the last line of the file might not end with a new line
+        chunk = rest + data
+        if data:
+          end = chunk.rfind(b'\n') + 1
+          chunk, rest = chunk[:end], chunk[end:]
+        elif chunk:
+          lines += 1
+        lines += chunk.count(b'\n')
+        position = 0
+        while position < len(chunk):
+          match = regex.search(chunk, position)
+          if match is None:
+            break
+          matches += 1
+          # continue with the next line
+          position = chunk.find(b'\n', match.start()) + 1 or len(chunk)
+        if not data:
+          break
+  except (IOError, OSError, EOFError) as e:
+    logger.warning("Could not search log file '%s': %s" % (filename, e))
+    return None
+  return filename, path, status.st_size, status.st_mtime, lines, matches
+
+
+def read_log_index(filename):
+  """Reads the index of log files written by :py:func:`write_log_index`; returns an empty index if the file does not exist or cannot be read."""
+  import json
+  try:
+    with open(filename) as f:
+      index = json.load(f)
+  except (IOError, OSError, ValueError):
+    return {}
+  return index if isinstance(index, dict) else {}
+
+
+def prune_log_index(index):
+  """Removes the entries of log files that do not exist any more, e.g., because the jobs were deleted, from the given index.
+  Each directory is listed only once instead of checking every file.
+  Returns the number of removed entries."""
+  names = collections.defaultdict(list)
+  for filename, entry in index.items():
+    # the index is keyed by absolute file names, and compressed log files are stored next to the original files
+    names[os.path.dirname(filename)].append((filename, os.path.basename(entry['path'])))
+  removed = 0
+  for directory in names:
+    existing = _list_directory(directory)
+    for filename, basename in names[directory]:
+      if basename not in existing:
+        del index[filename]
+        removed += 1
+  return removed
+
+
+def write_log_index(filename, index):
+  """Writes the given index of log files to the given file; the file is replaced atomically, so that it can be read at any time.
+  Entries of log files that do not exist any more are removed from the index first, see :py:func:`prune_log_index`."""
+  import json
+  prune_log_index(index)
+  directory = os.path.dirname(os.path.abspath(filename))
+  fd, temp_file = tempfile.mkstemp(dir=directory, prefix='.logindex')
+  with os.fdopen(fd, 'w') as f:
+    json.dump(index, f)
+  os.rename(temp_file, filename)
+
+
+def grep_logs(filenames, pattern, flags = 0, processes = None, index = None):
+  """Searches the given log files, or their compressed versions, for lines that match the given regular expression.
+
+  Returns a dictionary that contains the number of lines and the number of matching lines for each log file that exists.
+
+  Keyword parameters:
+
+  filenames
+    The names of the log files to search
+
+  pattern
+    The regular expression to search for, as bytes or as a text that is encoded in UTF-8
+
+  flags
+    The flags of the regular expression, e.g. ``re.IGNORECASE``
+
+  processes
+    The number of processes that search the files in parallel; by default, one process per CPU is used
+
+  index
+    If given, a dictionary as returned by :py:func:`read_log_index`; files whose size and modification time did not change since they were searched for the same pattern are not searched again.
+    The index is updated with the results of the search.
+  """
+  if isinstance(pattern, six.text_type):
+    pattern = pattern.encode('utf-8')
+  # fail early on invalid patterns
+  try:
+    re.compile(pattern, flags)
+  except re.error as e:
+    raise ValueError("The pattern '%s' is not a valid regular expression: %s" % (pattern.decode('utf-8', 'replace'), e))
+  key = "%d:%s" % (flags, pattern.decode('utf-8', 'replace'))
+
+  results, search = {}, []
+  for filename in filenames:
+    entry = index.get(os.path.abspath(filename)) if index is not None else None
+    if entry is not None:
+      path = find_log(filename)
+      try:
+        status = os.stat(path) if path is not None else None
+      except (IOError, OSError):
+        status = None
+      if status is not None and entry['path'] == path and entry['size'] == status.st_size and entry['mtime'] == status.st_mtime:
+        matches = dict(entry['matches'])
+        if key in matches:
+          results[filename] = (entry['lines'], matches[key])
+          continue
+    search.append((filename, pattern, flags))
+
+  if len(search) > 1 and processes != 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(processes)
+    try:
+      found = list(pool.imap_unordered(_grep_file, search, chunksize=max(1, min(64, len(search) // (4 * (processes or multiprocessing.cpu_count()))))))
+    finally:
+      pool.terminate()
+      pool.join()
+  else:
+    found = [_grep_file(arguments) for arguments in search]
+
+  for result in found:
+    if result is None:
+      continue
+    filename, path, size, mtime, lines, matches = result
+    results[filename] = (lines, matches)
+    if index is not None:
+      entry = index.get(os.path.abspath(filename))
+      if entry is None or entry['path'] != path or entry['size'] != size or entry['mtime'] != mtime:
+        entry = {'path' : path, 'size' : size, 'mtime' : mtime, 'lines' : lines, 'matches' : []}
+        index[os.path.abspath(filename)] = entry
+      # the results for the most recent patterns are kept
+      entry['matches'] = ([m for m in entry['matches'] if m[0] != key] + [[key, matches]])[-INDEX_PATTERNS:]
+  return results
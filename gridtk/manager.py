@@ -2,30 +2,92 @@
 from __future__ import print_function
 
 import os, sys
+import json
 import subprocess
 import socket # to get the host name
-from .models import Base, Job, ArrayJob, Status
-from .tools import logger
+from .models import Base, Job, ArrayJob, JobDependence, Status, migrate, _decode, _ranges_from_ids, _submitted_array_state
+from .tools import logger, filesystem_type, NETWORK_FILE_SYSTEMS
 
 
 import sqlalchemy
+import sqlalchemy.event
 
 """This file defines a minimum Job Manager interface."""
 sqlalchemy_version = [int(v) for v in sqlalchemy.__version__.split('.')]
 
+# The SQLite settings that are applied to each connection to the database; see https://www.sqlite.org/pragma.html
+DEFAULT_PRAGMAS = {
+  'synchronous' : 'NORMAL',   # in WAL mode, this is safe against corruption, but avoids most fsyncs
+  'cache_size' : -16384,      # 16 MB of page cache
+  'mmap_size' : 67108864,     # memory-map up to 64 MB of the database file
+}
+
+# The columns by which the jobs can be sorted in :py:meth:`JobManager.list`
+LIST_ORDER = {
+  'id' : Job.unique,
+  'grid-id' : Job.id,
+  'name' : Job.name,
+  'queue' : Job.queue_name,
+  'status' : Job.status,
+}
+
+# The strategies to load the relationships of the jobs together with the jobs, see :py:meth:`JobManager.get_jobs`
+EAGER_LOADING = ('selectin', 'joined', 'subquery', 'lazy')
+
+
 class JobManager:
   """This job manager defines the basic interface for handling jobs in the SQL database."""
 
-  def __init__(self, database, wrapper_script = None, debug = False):
+  def __init__(self, database, wrapper_script = None, debug = False, journal_mode = 'wal', pragmas = None, eager_loading = 'selectin', compress_logs = None):
+    """Initializes the job manager.
+
+    Keyword parameters:
+
+    database
+      The file containing the SQLite database of the jobs. If the file does not exist, it is created.
+
+    wrapper_script
+      The path to the ``jman`` script that is used to execute the jobs; if not given, it is searched in the ``bin`` directory and the ``PATH``
+
+    debug
+      Print all SQL statements
+
+    journal_mode
+      The journal mode of the database. The default 'wal' allows readers to access the database while jobs write to it.
+      Since WAL is not supported on network file systems such as NFS, the traditional 'delete' mode is used for databases on these file systems.
+
+    pragmas
+      A dictionary of SQLite pragmas that overwrite the :py:data:`DEFAULT_PRAGMAS`
+
+    eager_loading
+      The default strategy to load the array jobs and the dependencies of many jobs at once, one of :py:data:`EAGER_LOADING`; see :py:meth:`get_jobs`
+
+    compress_logs
+      If given, the log files of the jobs that are executed by this job manager are compressed when the jobs have finished, using one of the methods in :py:data:`gridtk.logs.COMPRESSION`
+    """
+    self._eager_loading = eager_loading
+    self._compress_logs = compress_logs
     self._database = os.path.realpath(database)
-    self._engine = sqlalchemy.create_engine("sqlite:///"+self._database, connect_args={'timeout': 600}, echo=debug)
+    self._journal_mode, self._pragmas = self._sqlite_settings(journal_mode, pragmas)
+    self._engine = self._create_engine(echo=debug)
+    self._write_engine = self._engine.execution_options(gridtk_begin='IMMEDIATE')
     self._session_maker = sqlalchemy.orm.sessionmaker(bind=self._engine)
+    # the schema of existing databases is checked (and upgraded) when the database is accessed for the first time
+    self._schema_checked = False
 
     # store the command that this job manager was called with
     if wrapper_script is None:
       # try to find the executable, search in the bin path first
-      import distutils.spawn
-      wrapper_script = os.path.realpath(distutils.spawn.find_executable('jman', '.' + os.pathsep + 'bin' + os.pathsep + os.environ['PATH']))
+      search_path = '.' + os.pathsep + 'bin' + os.pathsep + os.environ['PATH']
+      try:
+        from shutil import which
+        wrapper_script = which('jman', path=search_path)
+      except ImportError:
+        # python 2 (importing distutils is slow, so we only do it when needed)
+        import distutils.spawn
+        wrapper_script = distutils.spawn.find_executable('jman', search_path)
+      if wrapper_script is not None:
+        wrapper_script = os.path.realpath(wrapper_script)
 
     if wrapper_script is None:
       raise IOError("Could not find the installation path of gridtk. Please specify it in the wrapper_script parameter of the JobManager.")
@@ -39,31 +101,95 @@ class JobManager:
     if os.path.isfile(self._database):
       # in errornous cases, the session might still be active, so don't create a deadlock here!
       if not hasattr(self, 'session'):
-        self.lock()
-      job_count = len(self.get_jobs())
+        self.lock(read_only=True)
+      empty = self.session.query(Job.unique).first() is None
       self.unlock()
-      if not job_count:
+      if empty:
         logger.debug("Removed database file '%s' since database is empty" % self._database)
         os.remove(self._database)
-
-
-  def lock(self):
-    """Generates (and returns) a blocking session object to the database."""
+        # remove the files of the write-ahead log, in case they have not been cleaned up, and the index of the log files
+        for suffix in ('-wal', '-shm', '.logindex'):
+          if os.path.exists(self._database + suffix):
+            os.remove(self._database + suffix)
+
+
+  def _sqlite_settings(self, journal_mode, pragmas):
+    """Returns the journal mode and the pragmas that can be used for the database file."""
+    settings = dict(DEFAULT_PRAGMAS)
+    settings.update(pragmas or {})
+    journal_mode = journal_mode.lower()
+    fstype = filesystem_type(self._database)
+    if fstype in NETWORK_FILE_SYSTEMS:
+      # WAL requires shared memory, which does not work between machines; memory-mapping files is not safe either
+      if journal_mode == 'wal':
+        logger.debug("Using the 'delete' instead of the 'wal' journal mode since the database '%s' is located on a '%s' file system" % (self._database, fstype))
+        journal_mode = 'delete'
+      settings['mmap_size'] = 0
+    if journal_mode != 'wal' and not (pragmas and 'synchronous' in pragmas):
+      # without WAL, reducing the synchronization might corrupt the database on power loss
+      settings['synchronous'] = 'FULL'
+    return journal_mode, settings
+
+
+  def _create_engine(self, echo = False):
+    """Creates the engine to the database, which sets up the journal mode and the pragmas of each new connection."""
+    # do not keep connections open, so that the database file can be removed and transactions are not kept alive
+    engine = sqlalchemy.create_engine("sqlite:///"+self._database, connect_args={'timeout': 600}, echo=echo, poolclass=sqlalchemy.pool.NullPool)
+
+    # don't refer to self inside the listener, so that the job manager can be deleted as soon as it is not used any more
+    database, journal_mode, pragmas = self._database, self._journal_mode, self._pragmas
+    def _connect(dbapi_connection, connection_record):
+      cursor = dbapi_connection.cursor()
+      cursor.execute("PRAGMA journal_mode=%s" % journal_mode)
+      mode = cursor.fetchone()[0].lower()
+      if mode != journal_mode:
+        # WAL is not supported by the file system (or the database is in use by a connection that prevents changing the mode)
+        logger.debug("Could not set the journal mode of database '%s' to '%s'; using '%s' instead" % (database, journal_mode, mode))
+      for key in sorted(pragmas):
+        cursor.execute("PRAGMA %s=%s" % (key, pragmas[key]))
+      cursor.close()
+      # transactions are started explicitly in _begin
+      dbapi_connection.isolation_level = None
+
+    def _begin(connection):
+      # sessions that write to the database take the write lock before reading anything,
+      # so that the state that they read cannot be changed by other processes before they write
+      statement = "BEGIN %s" % connection.get_execution_options().get('gridtk_begin', 'DEFERRED')
+      getattr(connection, 'exec_driver_sql', connection.execute)(statement)
+
+    sqlalchemy.event.listen(engine, 'connect', _connect)
+    sqlalchemy.event.listen(engine, 'begin', _begin)
+    return engine
+
+
+  def lock(self, read_only = False):
+    """Generates (and returns) a blocking session object to the database.
+    When ``read_only`` is set, changes to the objects of this session are never written to the database, so that the session does not take the write lock."""
     if hasattr(self, 'session'):
       raise RuntimeError('Dead lock detected. Please do not try to lock the session when it is already locked!')
 
     if sqlalchemy_version < [0,7,8]:
       # for old sqlalchemy versions, in some cases it is required to re-generate the engine for each session
-      self._engine = sqlalchemy.create_engine("sqlite:///"+self._database)
+      self._engine = self._create_engine()
+      self._write_engine = self._engine.execution_options(gridtk_begin='IMMEDIATE')
       self._session_maker = sqlalchemy.orm.sessionmaker(bind=self._engine)
 
     # create the database if it does not exist yet
     if not os.path.exists(self._database):
       self._create()
+    elif not self._schema_checked:
+      # upgrade databases that have been created by older versions of gridtk
+      migrate(self._write_engine, self._engine)
+    self._schema_checked = True
 
     # now, create a session
-    self.session = self._session_maker()
-    logger.debug("Created new database session to '%s'" % self._database)
+    self.session = self._session_maker(bind = self._engine if read_only else self._write_engine, autoflush = not read_only)
+    if read_only:
+      # forbid writing, just in case
+      def _deny_flush(session, flush_context, instances):
+        raise RuntimeError("The database session is read-only")
+      sqlalchemy.event.listen(self.session, 'before_flush', _deny_flush)
+    logger.debug("Created new %sdatabase session to '%s'" % ("read-only " if read_only else "", self._database))
     return self.session
 
 
@@ -83,20 +209,81 @@ class JobManager:
     # create directory for sql database
     makedirs_safe(os.path.dirname(self._database))
 
-    # create all the tables
-    Base.metadata.create_all(self._engine)
+    # create all the tables and register the current schema version
+    Base.metadata.create_all(self._write_engine)
+    migrate(self._write_engine)
     logger.debug("Created new empty database '%s'" % self._database)
 
 
 
-  def get_jobs(self, job_ids = None):
-    """Returns a list of jobs that are stored in the database."""
+  def get_jobs(self, job_ids = None, queues = None, memory = None, command = None, load = (), eager_loading = None):
+    """Returns a list of jobs that are stored in the database.
+    The jobs can be filtered by the given queue names, the memory requirement and by a part of the command line; the filtering is done in the database.
+
+    The relationships given in ``load`` ('array' for the array jobs, 'dependencies' for the jobs that we wait for and 'dependents' for the jobs that wait for us) are loaded together with the jobs,
+    using the given ``eager_loading`` strategy (by default, the strategy given in the constructor).
+    Hence, the number of queries does not grow with the number of jobs."""
     if job_ids is not None and len(job_ids) == 0:
       return []
+    q = self._job_query(job_ids, queues, memory, command).order_by(Job.unique)
+    return list(q.options(*self._load_options(load, eager_loading)))
+
+
+  def _load_options(self, load, eager_loading = None):
+    """Returns the query options to load the given relationships of the jobs with the given strategy."""
+    eager_loading = eager_loading or self._eager_loading
+    if eager_loading not in EAGER_LOADING:
+      raise ValueError("The eager loading strategy '%s' is not known; use one of %s" % (eager_loading, EAGER_LOADING))
+    if eager_loading == 'lazy':
+      return []
+    loader = eager_loading + 'load'
+    if not hasattr(sqlalchemy.orm, loader):
+      # selectin loading is not available in old versions of SQLAlchemy
+      loader = 'subqueryload'
+    relationships = {
+      'array' : (Job.array, None),
+      'dependencies' : (Job.jobs_we_have_to_wait_for, JobDependence.waited_for_job),
+      'dependents' : (Job.jobs_that_wait_for_us, JobDependence.waiting_job),
+    }
+    options = []
+    for name in load:
+      relationship, job = relationships[name]
+      option = getattr(sqlalchemy.orm, loader)(relationship)
+      options.append(option if job is None else getattr(option, loader)(job))
+    return options
+
+
+  def _id_condition(self, column, ids):
+    """Returns the SQL condition that selects the given ids in the given column."""
+    # consecutive ids (such as given on command line by 1-1000) are selected by ranges, which keeps the query small
+    ranges = sorted(_ranges_from_ids(set(ids), 1), key=lambda r: r[0] - r[1])[:100]
+    ranges = [r for r in ranges if r[1] > r[0]]
+    covered = set(i for start, stop in ranges for i in range(start, stop + 1))
+    conditions = [column.between(start, stop) for start, stop in ranges]
+    singles = [i for i in ids if i not in covered]
+    if singles or not conditions:
+      conditions.append(column.in_(singles))
+    return sqlalchemy.or_(*conditions)
+
+
+  def _job_query(self, job_ids = None, queues = None, memory = None, command = None, names = None):
+    """Returns the query for the jobs with the given properties, see :py:meth:`get_jobs`."""
     q = self.session.query(Job)
     if job_ids is not None:
-      q = q.filter(Job.unique.in_(job_ids))
-    return sorted(list(q), key=lambda job: job.unique)
+      q = q.filter(self._id_condition(Job.unique, job_ids))
+    if names is not None:
+      q = q.filter(Job.name.in_(names))
+    if queues is not None:
+      q = q.filter(Job.queue_name.in_(queues))
+    if memory is not None:
+      q = q.filter(Job.memory == memory)
+    if command is not None:
+      # the command line is stored as a JSON list, so the pattern has to be encoded in the same way;
+      # the given string might be part of a single argument, or span several arguments separated by white space
+      patterns = set((json.dumps(command)[1:-1], '","'.join(json.dumps(part)[1:-1] for part in command.split())))
+      patterns = ['%' + p.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%' for p in sorted(patterns)]
+      q = q.filter(sqlalchemy.or_(*[Job.command_line.like(p, escape='\\') for p in patterns]))
+    return q
 
 
   def _job_and_array(self, job_id, array_id = None):
@@ -112,13 +299,63 @@ class JobManager:
     unique_id = job.unique
 
     if array_id is not None:
-      array_job = list(self.session.query(ArrayJob).filter(ArrayJob.job_id == unique_id).filter(ArrayJob.id == array_id))
-      assert (len(array_job) == 1)
-      return (job, array_job[0])
+      array_job = job.get_array_task(array_id)
+      assert (array_job is not None)
+      return (job, array_job)
     else:
       return (job, None)
 
 
+  def _dependent_jobs(self, job_id):
+    """Returns the recursive query (common table expression) of the unique ids of all jobs that directly or indirectly depend on the job with the given unique id."""
+    dependents = self.session.query(JobDependence.waiting_job_id.label('unique')).filter(JobDependence.waited_for_job_id == job_id).filter(JobDependence.waiting_job_id != None).cte('dependents', recursive=True)
+    # UNION (instead of UNION ALL) visits each job only once, even if it can be reached in several ways
+    return dependents.union(self.session.query(JobDependence.waiting_job_id).filter(JobDependence.waited_for_job_id == dependents.c.unique).filter(JobDependence.waiting_job_id != None))
+
+
+  def _dependent_job_ids(self, job):
+    """Returns the unique ids of all jobs that directly or indirectly depend on the given job."""
+    return set(unique for (unique,) in self.session.query(self._dependent_jobs(job.unique).c.unique))
+
+
+  def _stop_grid_jobs(self, grid_ids):
+    """Stops the jobs with the given ids in the grid before they are reset by :py:meth:`_stop_dependent_jobs`; nothing needs to be done here."""
+    pass
+
+
+  def _stop_dependent_jobs(self, job, queue_name = None):
+    """Stops all jobs that directly or indirectly depend on the given failed job and that are waiting, queued or executing, and resets them to 'submitted'.
+    If ``queue_name`` is given, only the jobs in this queue are stopped.
+    The dependent jobs are collected by a single recursive query, and they are reset by a single UPDATE statement, instead of loading and changing each of them.
+    Returns the sorted unique ids of the stopped jobs."""
+    # all changes in the session need to be written before, and read again after the rows are changed in the database
+    self.session.flush()
+    dependents = self._dependent_jobs(job.unique)
+    jobs = self.session.query(Job.unique, Job.id, Job.array_string, Job.array_state).join(dependents, Job.unique == dependents.c.unique).filter(Job.status.in_(('executing', 'queued', 'waiting')))
+    if queue_name is not None:
+      jobs = jobs.filter(Job.queue_name == queue_name)
+    jobs = jobs.order_by(Job.unique).all()
+    if not jobs:
+      return []
+    self._stop_grid_jobs([j.id for j in jobs])
+
+    # the array tasks that are stored as rows are moved into the ranges of the submitted tasks
+    job_table, array_table = Job.__table__, ArrayJob.__table__
+    # the array string of jobs without array is the encoded None
+    array_job_ids = [j.unique for j in jobs if _decode(j.array_string) is not None]
+    array_ids = dict((unique, []) for unique in array_job_ids)
+    if array_job_ids:
+      for unique, array_id in self.session.query(ArrayJob.job_id, ArrayJob.id).filter(self._id_condition(ArrayJob.job_id, array_job_ids)):
+        array_ids[unique].append(array_id)
+      self.session.execute(array_table.delete().where(self._id_condition(array_table.c.job_id, array_job_ids)))
+
+    # the same as Job.submit(), for all jobs at once
+    update = job_table.update().where(job_table.c.unique == sqlalchemy.bindparam('_unique')).values(status='submitted', result=None, machine_name=None, start_time=None, finish_time=None, id=job_table.c.unique, array_state=sqlalchemy.bindparam('_array_state'))
+    self.session.execute(update, [{'_unique' : j.unique, '_array_state' : _submitted_array_state(j.array_string, j.array_state, array_ids[j.unique]) if j.unique in array_ids else j.array_state} for j in jobs])
+    self.session.expire_all()
+    return [j.unique for j in jobs]
+
+
   def run_job(self, job_id, array_id = None):
     """This function is called to run a job (e.g. in the grid) with the given id and the given array index if applicable."""
     # set the job's status in the database
@@ -144,7 +381,7 @@ class JobManager:
       self.unlock()
 
     # get the command line of the job from the database; does not need write access
-    self.lock()
+    self.lock(read_only=True)
     job = self.get_jobs((job_id,))[0]
     command_line = job.get_command_line()
     self.unlock()
@@ -175,18 +412,9 @@ class JobManager:
       # This might not be working properly, so use with care!
       if job.stop_on_failure and job.status == 'failure':
         # the job has failed
-        # stop this and all dependent jobs from execution
-        dependent_jobs = job.get_jobs_waiting_for_us()
-        dependent_job_ids = set([dep.unique for dep in dependent_jobs] + [job.unique])
-        while len(dependent_jobs):
-          dep = dependent_jobs.pop(0)
-          new = dep.get_jobs_waiting_for_us()
-          dependent_jobs += new
-          dependent_job_ids.update([dep.unique for dep in new])
-
-        self.unlock()
-        deps = sorted(list(dependent_job_ids))
-        self.stop_jobs(deps)
+        # stop all dependent jobs from execution
+        deps = self._stop_dependent_jobs(job)
+        self.session.commit()
         print ("WARNING: Stopped dependent jobs '%s' since this job failed." % str(deps), file=sys.stderr)
 
     except Exception as e:
@@ -196,11 +424,32 @@ class JobManager:
       if hasattr(self, 'session'):
         self.unlock()
 
+    if self._compress_logs is not None:
+      self._compress_job_logs(job_id, array_id)
 
 
+  def _compress_job_logs(self, job_id, array_id = None):
+    """Compresses the log files of the given job, or of the given task of the array job, if it has finished."""
+    self.lock(read_only=True)
+    try:
+      jobs = self.get_jobs((job_id,))
+      task = (jobs[0].get_array_task(array_id) if array_id is not None else jobs[0]) if jobs else None
+      files = [task.std_out_file(), task.std_err_file()] if task is not None and task.status in ('success', 'failure') else []
+    finally:
+      self.unlock()
+    # the output of this process is written to the log files as well
+    sys.stdout.flush()
+    sys.stderr.flush()
+    from .logs import compress_logs
+    compress_logs([f for f in files if f is not None], self._compress_logs)
+
 
-  def list(self, job_ids, print_array_jobs = False, print_dependencies = False, long = False, status=Status, names=None, ids_only=False):
-    """Lists the jobs currently added to the database."""
+
+
+  def list(self, job_ids, print_array_jobs = False, print_dependencies = False, long = False, status=Status, names=None, ids_only=False, queues=None, memory=None, command=None, order_by='id', reverse=False, limit=None, offset=0):
+    """Lists the jobs currently added to the database; see :py:meth:`get_jobs` for the ``queues``, ``memory`` and ``command`` filters.
+    The jobs are sorted by the given ``order_by`` key (one of :py:data:`LIST_ORDER`), and only ``limit`` jobs after skipping the first ``offset`` jobs are listed.
+    All filters, the ordering and the paging are evaluated in the database, where possible."""
     # configuration for jobs
     if print_dependencies:
       fields = ("job-id", "grid-id", "queue", "status", "job-name", "dependencies", "submitted command line")
@@ -231,130 +480,339 @@ class JobManager:
       print(delimiter)
 
 
-    self.lock()
-    for job in self.get_jobs(job_ids):
+    if job_ids is not None and len(job_ids) == 0:
+      return
+    self.lock(read_only=True)
+    # the jobs are streamed, which does not allow to join collections or to load them with subqueries
+    load = (('array',) if print_array_jobs else ()) + (('dependencies',) if print_dependencies else ())
+    q = self._job_query(job_ids, queues=queues, memory=memory, command=command, names=names)
+    q = q.options(*self._load_options(load, 'selectin' if self._eager_loading in ('joined', 'subquery') else None))
+
+    # executing array jobs might have finished, which is only known after refreshing them
+    statuses = set(status)
+    refreshed = set(('executing', 'success', 'failure'))
+    exact = statuses >= refreshed or not (statuses & refreshed)
+    if statuses != set(Status):
+      condition = Job.status.in_(statuses)
+      if not exact:
+        condition = sqlalchemy.or_(condition, sqlalchemy.and_(Job.status == 'executing', Job.array_state != None))
+      q = q.filter(condition)
+
+    order = [LIST_ORDER[order_by], Job.unique]
+    q = q.order_by(*[o.desc() if reverse else o for o in order])
+    skip = offset
+    if exact:
+      # the statuses do not change when refreshing the jobs, so the paging can be done in the database
+      q = q.offset(offset or None).limit(limit)
+      skip = 0
+
+    count = 0
+    for job in q.yield_per(1000):
       job.refresh()
-      if job.status in status and (names is None or job.name in names):
-        if ids_only:
-          print(job.unique, end=" ")
-        else:
-          print(job.format(format, dependency_length, None if long else 43))
-        if (not ids_only) and print_array_jobs and job.array:
-          print(array_delimiter)
-          for array_job in job.array:
-            if array_job.status in status:
-              print(array_job.format(array_format))
-          print(array_delimiter)
+      if job.status not in statuses:
+        continue
+      if skip:
+        skip -= 1
+        continue
+      count += 1
+      if ids_only:
+        print(job.unique, end=" ")
+      else:
+        print(job.format(format, dependency_length, None if long else 43))
+      if (not ids_only) and print_array_jobs and job.get_array():
+        print(array_delimiter)
+        for array_job in job.array_tasks(status):
+          print(array_job.format(array_format))
+        print(array_delimiter)
+      if limit is not None and count >= limit:
+        break
 
     self.unlock()
 
 
-  def report(self, job_ids=None, array_ids=None, output=True, error=True, status=Status, name=None):
-    """Iterates through the output and error files and write the results to command line."""
+  def report(self, job_ids=None, array_ids=None, output=True, error=True, status=Status, name=None, head=None, tail=None, follow=False, interval=1.):
+    """Iterates through the output and error files and write the results to command line.
+    If ``head`` or ``tail`` is given, only the first or last lines of each log file are written.
+    With ``follow``, the log files are written as they grow until all jobs have finished, see :py:meth:`follow`."""
+    if follow:
+      return self.follow(job_ids, array_ids, output, error, name, tail, interval)
+
+    # the texts and log files to write; the log files are read after the database has been unlocked
+    items = []
+
     def _write_contents(job):
       # Writes the contents of the output and error files to command line
       out_file, err_file = job.std_out_file(), job.std_err_file()
-      logger.info("Contents of output file: '%s'" % out_file)
-      if output and out_file is not None and os.path.exists(out_file) and os.stat(out_file).st_size > 0:
-        print(open(out_file).read().rstrip())
-        print("-"*20)
-      if error and err_file is not None and os.path.exists(err_file) and os.stat(err_file).st_size > 0:
-        logger.info("Contents of error file: '%s'" % err_file)
-        print(open(err_file).read().rstrip())
-        print("-"*40)
+      if output and out_file is not None:
+        items.append((out_file, "-"*20))
+      if error and err_file is not None:
+        items.append((err_file, "-"*40))
 
     def _write_array_jobs(array_jobs):
       for array_job in array_jobs:
-        print("Array Job", str(array_job.id), ("(%s) :"%array_job.machine_name if array_job.machine_name is not None else ":"))
+        items.append(" ".join(("Array Job", str(array_job.id), ("(%s) :"%array_job.machine_name if array_job.machine_name is not None else ":"))))
         _write_contents(array_job)
 
-    self.lock()
+    self.lock(read_only=True)
 
     # check if an array job should be reported
     if array_ids:
       if len(job_ids) != 1: logger.error("If array ids are specified exactly one job id must be given.")
-      array_jobs = list(self.session.query(ArrayJob).join(Job).filter(Job.unique.in_(job_ids)).filter(Job.unique == ArrayJob.job_id).filter(ArrayJob.id.in_(array_ids)))
-      if array_jobs: print(array_jobs[0].job)
+      array_jobs = [array_job for job in self.get_jobs(job_ids) for array_job in filter(None, (job.get_array_task(array_id) for array_id in array_ids))]
+      if array_jobs: items.append(str(array_jobs[0].job))
       _write_array_jobs(array_jobs)
 
     else:
       # iterate over all jobs
-      jobs = self.get_jobs(job_ids)
+      jobs = self.get_jobs(job_ids, load=('array',))
       for job in jobs:
         if name is not None and job.name != name:
           continue
         if job.status not in status:
           continue
-        if job.array:
-          print(job)
-          _write_array_jobs(job.array)
+        if job.get_array():
+          items.append(str(job))
+          _write_array_jobs(job.array_tasks())
         else:
-          print(job)
+          items.append(str(job))
           _write_contents(job)
         if job.log_dir is not None:
-          print("-"*60)
+          items.append("-"*60)
 
     self.unlock()
+    from .logs import print_logs
+    print_logs(items, head=head, tail=tail)
+
+
+  def follow(self, job_ids=None, array_ids=None, output=True, error=True, name=None, tail=None, interval=1.):
+    """Writes the output and error files of the given jobs to command line while they are growing, until all jobs have finished or the user interrupts.
+    The log files of array tasks are followed as soon as the tasks start; the database and the files are checked every ``interval`` seconds."""
+    def _files():
+      # returns the log files that should be followed, and whether any job has not finished yet
+      self.lock(read_only=True)
+      try:
+        files, running = [], False
+        for job in self.get_jobs(job_ids, load=('array',)):
+          if name is not None and job.name != name:
+            continue
+          job.refresh()
+          running = running or job.status not in ('success', 'failure')
+          if array_ids:
+            tasks = filter(None, (job.get_array_task(array_id) for array_id in array_ids))
+          elif job.get_array():
+            tasks = job.array_tasks(('executing', 'success', 'failure'))
+          else:
+            tasks = [job]
+          for task in tasks:
+            files.extend(f for f in ((task.std_out_file() if output else None), (task.std_err_file() if error else None)) if f is not None)
+      finally:
+        self.unlock()
+      return files, running
+
+    from .logs import follow_logs
+    try:
+      follow_logs(_files, interval=interval, tail=tail)
+    except KeyboardInterrupt:
+      logger.info("Stopped following the log files due to user interrupt.")
+
+
+  def log_index_file(self):
+    """Returns the name of the file that stores the index of the log files, which is used by :py:meth:`grep`."""
+    return self._database + '.logindex'
+
+
+  def grep(self, pattern, job_ids=None, array_ids=None, output=True, error=True, status=Status, name=None, ignore_case=False, fixed_strings=False, processes=None, use_index=False):
+    """Searches the output and error files of the given jobs for lines that match the given regular expression, and writes the number of matching lines for each job or array task that has matches.
+    The log files are searched in parallel by ``processes`` processes; with ``use_index``, log files that did not change since the last search for the same pattern are not searched again, see :py:func:`gridtk.logs.grep_logs`.
+    Returns the list of (job id, array id, matching output lines, matching error lines) for all jobs and array tasks with matches."""
+    # the job ids, array ids and log files to search; the log files are searched after the database has been unlocked
+    tasks = []
+
+    def _add(job, task, array_id=None):
+      tasks.append((job.unique, array_id, task.std_out_file() if output else None, task.std_err_file() if error else None))
+
+    self.lock(read_only=True)
+    try:
+      if array_ids:
+        if len(job_ids) != 1: logger.error("If array ids are specified exactly one job id must be given.")
+        for job in self.get_jobs(job_ids):
+          for array_job in filter(None, (job.get_array_task(array_id) for array_id in array_ids)):
+            _add(job, array_job, array_job.id)
+      else:
+        for job in self.get_jobs(job_ids, load=('array',)):
+          if name is not None and job.name != name:
+            continue
+          if job.get_array():
+            # the statuses of the array tasks are checked instead of the status of the whole job
+            for array_job in job.array_tasks(status):
+              _add(job, array_job, array_job.id)
+          elif job.status in status:
+            _add(job, job)
+    finally:
+      self.unlock()
+
+    import re
+    from .logs import grep_logs, read_log_index, write_log_index
+    if fixed_strings:
+      pattern = re.escape(pattern)
+    index = read_log_index(self.log_index_file()) if use_index else None
+    files = [f for task in tasks for f in task[2:] if f is not None]
+    counts = grep_logs(files, pattern, re.IGNORECASE if ignore_case else 0, processes=processes, index=index)
+    if use_index:
+      write_log_index(self.log_index_file(), index)
+
+    results = []
+    for job_id, array_id, out_file, err_file in tasks:
+      out_matches, err_matches = (counts[f][1] if f in counts else 0 for f in (out_file, err_file))
+      if out_matches or err_matches:
+        results.append((job_id, array_id, out_matches, err_matches))
+
+    fields = ("job-id", "array-id", "output", "error")
+    lengths = (8, 8, 10, 10)
+    format = "{0:>%d}  {1:>%d}  {2:>%d}  {3:>%d}" % lengths
+    print(format.format(*fields))
+    print(format.format(*("-" * length for length in lengths)))
+    for job_id, array_id, out_matches, err_matches in results:
+      print(format.format(job_id, array_id if array_id is not None else "", out_matches if output else "", err_matches if error else ""))
+    logger.info("Found matches in %d of %d jobs and array tasks, in %d existing log files" % (len(results), len(tasks), len(counts)))
+    return results
+
+
+  def dependency_graph(self, job_ids = None):
+    """Returns the :py:class:`gridtk.graph.JobGraph` of the given jobs (or of all jobs), including the dependencies among them."""
+    from .graph import JobGraph, JobNode
+    self.lock(read_only=True)
+    try:
+      # the rows are read without the ORM, which is considerably faster for many jobs
+      query = self._job_query(job_ids).with_entities(Job.unique, Job.name, Job.status, Job.start_time, Job.finish_time)
+      connection = self.session.connection()
+      jobs = [JobNode(*row) for row in connection.execute(query.statement)]
+      dependencies = connection.execute(self.session.query(JobDependence.waiting_job_id, JobDependence.waited_for_job_id).statement).fetchall()
+    finally:
+      self.unlock()
+    return JobGraph(jobs, dependencies)
+
+
+  def graph(self, job_ids = None, format = 'text', default_runtime = None, stream = None):
+    """Writes the dependency graph of the given jobs, either as a summary of the topological levels and the critical path (``format='text'``), or in the DOT language of Graphviz (``format='dot'``).
+    The critical path is the chain of dependent jobs with the longest total runtime, where the runtimes of jobs that did not finish yet are estimated, see :py:meth:`gridtk.graph.JobGraph.runtimes`.
+    Returns the length and the job ids of the critical path, or None if the dependencies form a cycle."""
+    from .graph import format_cycle, format_time
+    stream = sys.stdout if stream is None else stream
+    graph = self.dependency_graph(job_ids)
+    cycle = graph.find_cycle()
+    if cycle is not None:
+      logger.error("The dependencies of the jobs form a cycle, so that these jobs will wait forever: %s" % format_cycle(cycle))
+      return None
+
+    runtimes, estimated = graph.runtimes(default_runtime)
+    length, path = graph.critical_path(runtimes)
+    if format == 'dot':
+      graph.write_dot(stream, path, runtimes)
+      return length, path
+
+    levels = graph.levels()
+    counts = {}
+    for unique, level in levels.items():
+      counts.setdefault(level, {}).setdefault(graph.jobs[unique].status, 0)
+      counts[level][graph.jobs[unique].status] += 1
+    print("Jobs: %d, dependencies: %d, levels: %d" % (len(graph.jobs), graph.dependencies, len(counts)), file=stream)
+    print(file=stream)
+    format = "{0:>6}  {1:>8}" + "".join("  {%d:>9}" % (i + 2) for i in range(len(Status)))
+    print(format.format("level", "jobs", *Status), file=stream)
+    print(format.format("-" * 6, "-" * 8, *("-" * 9 for _ in Status)), file=stream)
+    for level in sorted(counts):
+      print(format.format(level, sum(counts[level].values()), *(counts[level].get(status, "") for status in Status)), file=stream)
+    print(file=stream)
+
+    print("Critical path: %d jobs, %s (runtimes marked with '*' are estimated)" % (len(path), format_time(length)), file=stream)
+    print(file=stream)
+    format = "{0:>8}  {1:>6}  {2:>9}  {3:>10}  {4}"
+    print(format.format("job-id", "level", "status", "runtime", "name"), file=stream)
+    print(format.format("-" * 8, "-" * 6, "-" * 9, "-" * 10, "-" * 20), file=stream)
+    for unique in path:
+      job = graph.jobs[unique]
+      print(format.format(unique, levels[unique], job.status, ("*" if unique in estimated else "") + format_time(runtimes[unique]), job.name or ""), file=stream)
+    return length, path
 
 
   def delete(self, job_ids, array_ids = None, delete_logs = True, delete_log_dir = False, status = Status, delete_jobs = True):
-    """Deletes the jobs with the given ids from the database."""
-    def _delete_dir_if_empty(log_dir):
-      if log_dir and delete_log_dir and os.path.isdir(log_dir) and not os.listdir(log_dir):
-        os.rmdir(log_dir)
-        logger.info("Removed empty log directory '%s'" % log_dir)
-
-    def _delete(job, try_to_delete_dir=False):
-      # delete the job from the database
-      if delete_logs:
-        out_file, err_file = job.std_out_file(), job.std_err_file()
-        if out_file and os.path.exists(out_file):
-          os.remove(out_file)
-          logger.debug("Removed output log file '%s'" % out_file)
-        if err_file and os.path.exists(err_file):
-          os.remove(err_file)
-          logger.debug("Removed error log file '%s'" % err_file)
-        if try_to_delete_dir:
-          _delete_dir_if_empty(job.log_dir)
-      if delete_jobs:
-        self.session.delete(job)
+    """Deletes the jobs with the given ids from the database.
+    The jobs, their array tasks and their dependencies are deleted with a few SQL statements; afterwards, their log files are removed, see :py:func:`gridtk.logs.remove_logs`."""
+    # the log files of the deleted jobs and array tasks, and the log directories that should be removed when they are empty
+    logs, log_dirs = [], set()
 
+    def _delete_logs(job, try_to_delete_dir=False):
+      logs.extend(f for f in (job.std_out_file(), job.std_err_file()) if f is not None)
+      if try_to_delete_dir and job.log_dir:
+        log_dirs.add(job.log_dir)
 
     self.lock()
-
-    # check if array ids are specified
-    if array_ids:
-      if len(job_ids) != 1: logger.error("If array ids are specified exactly one job id must be given.")
-      array_jobs = list(self.session.query(ArrayJob).join(Job).filter(Job.unique.in_(job_ids)).filter(Job.unique == ArrayJob.job_id).filter(ArrayJob.id.in_(array_ids)))
-      if array_jobs:
-        job = array_jobs[0].job
-        for array_job in array_jobs:
-          if array_job.status in status:
-            if delete_jobs:
-              logger.debug("Deleting array job '%d' of job '%d' from the database." % (array_job.id, job.unique))
-            _delete(array_job)
-        if not job.array:
+    try:
+      # check if array ids are specified
+      if array_ids:
+        if len(job_ids) != 1: logger.error("If array ids are specified exactly one job id must be given.")
+        array_jobs = [array_job for job in self.get_jobs(job_ids) for array_job in filter(None, (job.get_array_task(array_id) for array_id in array_ids))]
+        if array_jobs:
+          job = array_jobs[0].job
+          for array_job in array_jobs:
+            if array_job.status in status:
+              if delete_jobs:
+                logger.debug("Deleting array job '%d' of job '%d' from the database." % (array_job.id, job.unique))
+                job.remove_array_task(array_job.id)
+              _delete_logs(array_job)
+          if not job.has_array_tasks():
+            if job.status in status:
+              if delete_jobs:
+                logger.info("Deleting job '%d' from the database." % job.unique)
+                self._delete_rows([job.unique], [], status)
+              _delete_logs(job, delete_jobs)
+
+      else:
+        # iterate over all jobs; the dependencies are deleted in the database directly
+        deleted, partial = [], []
+        for job in self.get_jobs(job_ids, load=('array',)):
+          if job.get_array():
+            array_jobs = job.array_tasks(status)
+            if array_jobs:
+              if delete_jobs:
+                logger.debug("Deleting %d array jobs of job '%d' from the database." % (len(array_jobs), job.unique))
+                if job.status not in status:
+                  # the remaining array tasks are kept
+                  partial.append(job)
+              # the names of the log files of the tasks are built as in ArrayJob.std_out_file, which is much faster for many tasks
+              for log_file in (job.std_out_file(), job.std_err_file()):
+                if log_file is not None:
+                  logs.extend("%s.%d" % (log_file, array_job.id) for array_job in array_jobs)
+          # delete this job
           if job.status in status:
             if delete_jobs:
               logger.info("Deleting job '%d' from the database." % job.unique)
-            _delete(job, delete_jobs)
+              deleted.append(job.unique)
+            _delete_logs(job, delete_jobs)
+        if delete_jobs:
+          self._delete_rows(deleted, partial, status)
 
-    else:
-      # iterate over all jobs
-      jobs = self.get_jobs(job_ids)
-      for job in jobs:
-        # delete all array jobs
-        if job.array:
-          for array_job in job.array:
-            if array_job.status in status:
-              if delete_jobs:
-                logger.debug("Deleting array job '%d' of job '%d' from the database." % (array_job.id, job.unique))
-              _delete(array_job)
-        # delete this job
-        if job.status in status:
-          if delete_jobs:
-            logger.info("Deleting job '%d' from the database." % job.unique)
-          _delete(job, delete_jobs)
-
-    self.session.commit()
-    self.unlock()
+      self.session.commit()
+    finally:
+      self.unlock()
+
+    if delete_logs:
+      # the database does not need to be locked while the log files are removed
+      from .logs import remove_logs
+      remove_logs(logs, log_dirs if delete_log_dir else ())
+
+
+  def _delete_rows(self, job_ids, partial_jobs, statuses):
+    """Deletes the jobs with the given ids, their array tasks and their dependencies from the database, and the array tasks with the given statuses from the given jobs."""
+    job_table, array_table, dependence_table = Job.__table__, ArrayJob.__table__, JobDependence.__table__
+    for job in partial_jobs:
+      job._set_array_state(dict((status, ranges) for status, ranges in job._get_array_state().items() if status not in statuses))
+    # the changes of the jobs in the session need to be written before the rows are deleted
+    self.session.flush()
+    if partial_jobs:
+      self.session.execute(array_table.delete().where(self._id_condition(array_table.c.job_id, [job.unique for job in partial_jobs])).where(array_table.c.status.in_(list(statuses))))
+    if job_ids:
+      self.session.execute(array_table.delete().where(self._id_condition(array_table.c.job_id, job_ids)))
+      self.session.execute(dependence_table.delete().where(sqlalchemy.or_(self._id_condition(dependence_table.c.waiting_job_id, job_ids), self._id_condition(dependence_table.c.waited_for_job_id, job_ids))))
+      self.session.execute(job_table.delete().where(self._id_condition(job_table.c.unique, job_ids)))
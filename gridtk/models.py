@@ -1,42 +1,195 @@
 import sqlalchemy
-from sqlalchemy import Table, Column, Integer, String, Boolean, ForeignKey
+from sqlalchemy import Table, Column, Integer, Float, String, Text, Boolean, ForeignKey, Index
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
-from .tools import Enum, relationship
+
+# sqlalchemy migration; copied from Bob
+try:
+  from sqlalchemy import Enum
+except ImportError:
+  from sqlalchemy import types
+
+  class Enum(types.TypeDecorator):
+    impl = types.Unicode
+
+    def __init__(self, *values):
+      """Emulates an Enum type.
+      values:
+      A list of valid values for this column
+      """
+
+      if values is None or len(values) == 0:
+          raise AssertionError('Enum requires a list of values')
+      self.values = values[:]
+
+      # The length of the string/unicode column should be the longest string
+      # in values
+      size = max([len(v) for v in values if v is not None])
+      super(Enum, self).__init__(size)
+
+    def process_bind_param(self, value, dialect):
+      if value not in self.values:
+          raise AssertionError('"%s" not in Enum.values' % value)
+      return value
+
+    def process_result_value(self, value, dialect):
+      return value
+
+try:
+  from sqlalchemy.orm import relationship
+except ImportError:
+  from sqlalchemy.orm import relation as relationship
+
 
 import os
 import sys
+import six
+import json
+import time
+import bisect
 
 if sys.version_info[0] >= 3:
-  from pickle import dumps, loads
+  from pickle import loads
 else:
-  from cPickle import dumps, loads
+  from cPickle import loads
 
-from .tools import logger
+from .tools import logger, Status, parse_memory, parse_slots
+from .graph import find_cycle, format_cycle
 
 Base = declarative_base()
 
-Status = ('submitted', 'queued', 'waiting', 'executing', 'success', 'failure')
+# The version of the database schema; whenever the schema is changed, this number needs to be increased and a migration needs to be added to MIGRATIONS
+SCHEMA_VERSION = 6
+
+def _encode(value):
+  """Encodes the given value (command lines, grid arguments, array specifications) into a compact JSON string."""
+  return json.dumps(value, separators=(',', ':'), sort_keys=True)
+
+def _decode(value):
+  """Decodes a value that was stored with :py:func:`_encode`.
+  Databases created with older versions of gridtk stored pickled values, which are still understood."""
+  if value is None:
+    return None
+  if isinstance(value, bytes) and not isinstance(value, str):
+    # In python 3, pickled values are stored as bytes
+    return loads(value)
+  try:
+    return json.loads(value)
+  except ValueError:
+    # In python 2, pickled values are stored as (unicode) strings
+    return loads(str(value))
+
+def _grid_arguments(kwargs):
+  """Extracts the arguments that are required to (re-)submit a job to the grid from the given keyword arguments."""
+  # older versions stored the keyword arguments in a nested dictionary
+  if 'kwargs' in kwargs and isinstance(kwargs['kwargs'], dict):
+    kwargs = kwargs['kwargs']
+  retval = {}
+  if 'pe_opt' in kwargs and kwargs['pe_opt'] is not None:
+    retval['pe_opt'] = kwargs['pe_opt']
+  if 'memfree' in kwargs and kwargs['memfree'] is not None:
+    retval['memfree'] = kwargs['memfree']
+  if 'hvmem' in kwargs and kwargs['hvmem'] is not None:
+    retval['hvmem'] = kwargs['hvmem']
+  if 'env' in kwargs and kwargs['env']:
+    retval['env'] = list(kwargs['env'])
+  if 'io_big' in kwargs and kwargs['io_big']:
+    retval['io_big'] = True
+  return retval
+
+
+# The state of the tasks of an array job is stored as ranges of task ids per status.
+# Each range [start, stop] contains the task ids start, start+step, ..., stop, where step is the step of the array.
+def _ranges_from_ids(ids, step):
+  """Returns the sorted list of ranges that contain exactly the given task ids."""
+  ranges = []
+  for i in sorted(ids):
+    if ranges and i == ranges[-1][1] + step:
+      ranges[-1][1] = i
+    else:
+      ranges.append([i, i])
+  return ranges
+
+def _merge_ranges(ranges, step):
+  """Returns the sorted list of ranges that contains the task ids of all given (disjoint) ranges."""
+  merged = []
+  for start, stop in sorted(ranges):
+    if merged and start <= merged[-1][1] + step:
+      merged[-1][1] = max(merged[-1][1], stop)
+    else:
+      merged.append([start, stop])
+  return merged
+
+def _find_range(ranges, task_id, step):
+  """Returns the index of the range that contains the given task id, or None."""
+  k = bisect.bisect_right(ranges, [task_id, float('inf')]) - 1
+  if k >= 0 and ranges[k][0] <= task_id <= ranges[k][1] and (task_id - ranges[k][0]) % step == 0:
+    return k
+  return None
+
+def _add_to_ranges(ranges, task_id, step):
+  """Adds the given task id, which is not contained yet, to the sorted list of ranges in place."""
+  k = bisect.bisect_left(ranges, [task_id, task_id])
+  merge_left = k > 0 and ranges[k-1][1] + step == task_id
+  merge_right = k < len(ranges) and ranges[k][0] - step == task_id
+  if merge_left and merge_right:
+    ranges[k-1][1] = ranges[k][1]
+    del ranges[k]
+  elif merge_left:
+    ranges[k-1][1] = task_id
+  elif merge_right:
+    ranges[k][0] = task_id
+  else:
+    ranges.insert(k, [task_id, task_id])
+
+def _remove_from_ranges(ranges, task_id, step):
+  """Removes the given task id from the sorted list of ranges in place; returns False if the task id was not contained."""
+  k = _find_range(ranges, task_id, step)
+  if k is None:
+    return False
+  start, stop = ranges[k]
+  ranges[k:k+1] = ([[start, task_id - step]] if task_id > start else []) + ([[task_id + step, stop]] if task_id < stop else [])
+  return True
+
+def _range_ids(ranges, step):
+  """Iterates over all task ids in the given ranges."""
+  for start, stop in ranges:
+    for i in range(start, stop+1, step):
+      yield i
 
-class ArrayJob(Base):
-  """This class defines one element of an array job."""
-  __tablename__ = 'ArrayJob'
+def _initial_array_state(array):
+  """Returns the encoded state of the tasks of a newly submitted array job with the given specification (start, stop, step)."""
+  (start, stop, step) = array
+  return _encode({'submitted' : [[start, start + (stop - start) // step * step]]})
 
-  unique = Column(Integer, primary_key = True)
-  id = Column(Integer)
-  job_id = Column(Integer, ForeignKey('Job.unique'))
-  status = Column(Enum(*Status))
-  result = Column(Integer)
-  machine_name = Column(String(10))
+def _submitted_array_state(array_string, array_state, array_ids):
+  """Returns the encoded state of the tasks of an array job after all tasks have been set to 'submitted', as done by :py:meth:`Job.submit`.
+  The ``array_ids`` are the ids of the tasks that are stored in :py:class:`ArrayJob` rows."""
+  array = _decode(array_string)
+  if array is None:
+    return array_state
+  if array_state is None:
+    return _initial_array_state(array)
+  ranges = [r for status_ranges in _decode(array_state).values() for r in status_ranges] + [[i, i] for i in array_ids]
+  return _encode({'submitted' : _merge_ranges(ranges, array[2])} if ranges else {})
 
-  job = relationship("Job", backref='array', order_by=id)
+def _compressible(status, result, machine_name):
+  """Returns True if a task with the given state can be stored in the ranges, i.e., it has no information besides its status."""
+  return machine_name is None and result == (0 if status == 'success' else None)
 
-  def __init__(self, id, job_id):
-    self.id = id
-    self.job_id = job_id
-    self.status = Status[0]
-    self.result = None
-    self.machine_name = None # will be set later, by the Job class
+
+class SchemaVersion(Base):
+  """This table stores the version of the schema of the database, so that old databases can be upgraded automatically."""
+  __tablename__ = 'SchemaVersion'
+
+  version = Column(Integer, primary_key = True)
+
+  def __init__(self, version):
+    self.version = version
+
+
+class _ArrayTaskBase(object):
+  """The functionality shared by all elements of an array job."""
 
   def std_out_file(self):
     return self.job.std_out_file() + "." + str(self.id) if self.job.log_dir else None
@@ -60,34 +213,76 @@ class ArrayJob(Base):
     return format.format("", job_id, queue, status)
 
 
+class ArrayJob(Base, _ArrayTaskBase):
+  """This class defines one element of an array job.
+  Rows are only stored for elements that have more information than their status, i.e., a machine name or a non-default result; see :py:meth:`Job.array_tasks`."""
+  __tablename__ = 'ArrayJob'
+  # array jobs are always searched by the job and their array id
+  __table_args__ = (Index('ix_ArrayJob_job_id_id', 'job_id', 'id'),)
+
+  unique = Column(Integer, primary_key = True)
+  id = Column(Integer)
+  job_id = Column(Integer, ForeignKey('Job.unique'))
+  status = Column(Enum(*Status))
+  result = Column(Integer)
+  machine_name = Column(String(10))
+
+  job = relationship("Job", backref='array', order_by=id)
+
+  def __init__(self, id, job_id):
+    self.id = id
+    self.job_id = job_id
+    self.status = Status[0]
+    self.result = None
+    self.machine_name = None # will be set later, by the Job class
+
+
+class ArrayTask(_ArrayTaskBase):
+  """This class defines one element of an array job, whose state is stored in the ranges of the job only."""
+
+  def __init__(self, job, id, status):
+    self.job = job
+    self.job_id = job.unique
+    self.id = id
+    self.status = status
+    self.result = 0 if status == 'success' else None
+    self.machine_name = None
+
+
 class Job(Base):
   """This class defines one Job that was submitted to the Job Manager."""
   __tablename__ = 'Job'
 
   unique = Column(Integer, primary_key = True) # The unique ID of the job (not corresponding to the grid ID)
-  command_line = Column(String(255))           # The command line to execute, converted to one string
-  name = Column(String(20))                    # A hand-chosen name for the task
+  command_line = Column(Text)                  # The command line to execute, as a JSON list
+  name = Column(String(20), index = True)      # A hand-chosen name for the task
   queue_name = Column(String(20))              # The name of the queue
   machine_name = Column(String(10))            # The name of the machine in which the job is run
-  grid_arguments = Column(String(255))         # The kwargs arguments for the job submission (e.g. in the grid)
-  id = Column(Integer)                         # The ID of the job as given from the grid
+  grid_arguments = Column(Text)                # The kwargs arguments for the job submission (e.g. in the grid), as a JSON dictionary
+  memory = Column(String(20), index = True)    # The memory requirement of the job (the mem_free parameter), if any
+  id = Column(Integer, index = True)           # The ID of the job as given from the grid
   log_dir = Column(String(255))                # The directory where the log files will be put to
-  array_string = Column(String(255))           # The array string (only needed for re-submission)
+  array_string = Column(String(255))           # The array specification (start, stop, step) as a JSON list (only needed for re-submission)
+  array_state = Column(Text)                   # The ids of the array tasks without an ArrayJob row, as JSON dictionary of ranges per status
   stop_on_failure = Column(Boolean)            # An indicator whether to stop depending jobs when this job finishes with an error
+  start_time = Column(Float)                   # The time (in seconds since the epoch) when the job, or its first array task, started executing
+  finish_time = Column(Float)                  # The time (in seconds since the epoch) when the job, or its last array task, finished
+  priority = Column(Integer)                   # The priority of the job in the local scheduler; jobs with higher priorities are started first
 
-  status = Column(Enum(*Status))
+  status = Column(Enum(*Status), index = True)
   result = Column(Integer)
 
-  def __init__(self, command_line, name = None, log_dir = None, array_string = None, queue_name = 'local', machine_name = None, stop_on_failure = False, **kwargs):
+  def __init__(self, command_line, name = None, log_dir = None, array_string = None, queue_name = 'local', machine_name = None, stop_on_failure = False, priority = 0, **kwargs):
     """Constructs a Job object without an ID (needs to be set later)."""
-    self.command_line = dumps(command_line)
+    self.set_command_line(command_line)
     self.name = name
     self.queue_name = queue_name   # will be set during the queue command later
     self.machine_name = machine_name   # will be set during the execute command later
-    self.grid_arguments = dumps(kwargs)
+    self.set_arguments(**kwargs)
     self.log_dir = log_dir
     self.stop_on_failure = stop_on_failure
-    self.array_string = dumps(array_string)
+    self.priority = priority
+    self.array_string = _encode(array_string)
     self.submit()
 
 
@@ -96,12 +291,16 @@ class Job(Base):
     self.status = 'submitted'
     self.result = None
     self.machine_name = None
+    self.start_time = None
+    self.finish_time = None
     if new_queue is not None:
       self.queue_name = new_queue
-    for array_job in self.array:
-      array_job.status = 'submitted'
-      array_job.result = None
-      array_job.machine_name = None
+    if self.array_state is None:
+      array = self.get_array()
+      if array:
+        self.array_state = _initial_array_state(array)
+    else:
+      self.move_array_tasks(Status, 'submitted')
     self.id = self.unique
 
 
@@ -132,27 +331,25 @@ class Job(Base):
         job.status = 'failure' if new_status == 'failure' else 'waiting'
 
     self.status = new_status
-    for array_job in self.array:
-      if array_job.status not in ('success', 'failure'):
-        array_job.status = new_status
+    self.move_array_tasks(('submitted', 'queued', 'waiting', 'executing'), new_status)
 
 
   def execute(self, array_id = None, machine_name = None):
     """Sets the status of this job to 'executing'."""
     self.status = 'executing'
+    if self.start_time is None:
+      self.start_time = time.time()
     if array_id is not None:
-      for array_job in self.array:
-        if array_job.id == array_id:
-          array_job.status = 'executing'
-          if machine_name is not None:
-            array_job.machine_name = machine_name
+      array_job = self.get_array_task(array_id)
+      if array_job is not None:
+        self.set_array_task(array_id, 'executing', machine_name = machine_name if machine_name is not None else array_job.machine_name)
     elif machine_name is not None:
       self.machine_name = machine_name
 
     # sometimes, the 'finish' command did not work for array jobs,
     # so check if any old job still has the 'executing' flag set
     for job in self.get_jobs_we_wait_for():
-      if job.array and job.status == 'executing':
+      if job.array_state is not None and job.status == 'executing':
         job.finish(0, -1)
 
 
@@ -163,19 +360,22 @@ class Job(Base):
     new_result = result
     finished = True
     if array_id is not None:
-      for array_job in self.array:
-        if array_job.id == array_id:
-          array_job.status = new_status
-          array_job.result = result
-        if array_job.status not in ('success', 'failure'):
-          finished = False
-        elif new_result == 0:
-          new_result = array_job.result
+      array_job = self.get_array_task(array_id)
+      if array_job is not None:
+        # the machine name is only kept for failed tasks
+        self.set_array_task(array_id, new_status, result, array_job.machine_name if new_status == 'failure' else None)
+      finished = not self._has_array_tasks(('submitted', 'queued', 'waiting', 'executing'))
+      if finished and new_result == 0:
+        # the result of the first failed task
+        failures = self.array_tasks(('failure',), limit = 1)
+        if failures:
+          new_result = failures[0].result
 
     if finished:
       # There was no array job, or all array jobs finished
       self.status = 'success' if new_result == 0 else 'failure'
       self.result = new_result
+      self.finish_time = time.time()
 
       # update all waiting jobs
       for job in self.get_jobs_waiting_for_us():
@@ -185,53 +385,146 @@ class Job(Base):
 
   def refresh(self):
     """Refreshes the status information."""
-    if self.status == 'executing' and self.array:
-      new_result = 0
-      for array_job in self.array:
-        if array_job.status == 'failure' and new_result is not None:
-          new_result = array_job.result
-        elif array_job.status not in ('success', 'failure'):
-          new_result = None
+    if self.status == 'executing' and self.array_state is not None:
+      new_result = None
+      if not self._has_array_tasks(('submitted', 'queued', 'waiting', 'executing')):
+        # the result of the last failed task
+        failures = self.array_tasks(('failure',))
+        new_result = failures[-1].result if failures else 0
       if new_result is not None:
         self.status = 'success' if new_result == 0 else 'failure'
         self.result = new_result
 
 
+  def _get_array_state(self):
+    return _decode(self.array_state) or {}
+
+  def _set_array_state(self, state):
+    self.array_state = _encode(dict((status, ranges) for status, ranges in state.items() if ranges))
+
+  def _array_step(self):
+    array = self.get_array()
+    return array[2] if array else 1
+
+  def _remove_array_row(self, array_job):
+    self.array.remove(array_job)
+    session = sqlalchemy.orm.object_session(array_job)
+    if session is not None:
+      if sqlalchemy.inspect(array_job).pending:
+        session.expunge(array_job)
+      else:
+        session.delete(array_job)
+
+  def _has_array_tasks(self, statuses):
+    """Returns True if any array task has one of the given statuses."""
+    state = self._get_array_state()
+    return any(state.get(status) for status in statuses) or any(array_job.status in statuses for array_job in self.array)
+
+  def move_array_tasks(self, statuses, new_status):
+    """Sets all array tasks with one of the given statuses to the given new status, resetting their results and machine names."""
+    if self.array_state is None:
+      return
+    state = self._get_array_state()
+    moved = []
+    for status in statuses:
+      if status != new_status:
+        moved.extend(state.pop(status, []))
+    for array_job in list(self.array):
+      if array_job.status in statuses:
+        moved.append([array_job.id, array_job.id])
+        self._remove_array_row(array_job)
+    if moved:
+      state[new_status] = _merge_ranges(state.get(new_status, []) + moved, self._array_step())
+      self._set_array_state(state)
+
+
+  def array_ids(self, statuses = Status):
+    """Returns the sorted ids of the array tasks that have one of the given statuses."""
+    step = self._array_step()
+    ids = [i for status, ranges in self._get_array_state().items() if status in statuses for i in _range_ids(ranges, step)]
+    ids.extend(array_job.id for array_job in self.array if array_job.status in statuses)
+    return sorted(ids)
+
+  def array_tasks(self, statuses = Status, limit = None):
+    """Returns the array tasks that have one of the given statuses, sorted by their ids.
+    Tasks that are stored in the database are returned as :py:class:`ArrayJob`, all others as :py:class:`ArrayTask`."""
+    step = self._array_step()
+    tasks = [array_job for array_job in self.array if array_job.status in statuses]
+    for status, ranges in self._get_array_state().items():
+      if status in statuses:
+        ids = _range_ids(ranges, step)
+        if limit is not None:
+          ids = (i for i, _ in zip(ids, range(limit)))
+        tasks.extend(ArrayTask(self, i, status) for i in ids)
+    tasks.sort(key=lambda task: task.id)
+    return tasks[:limit] if limit is not None else tasks
+
+  def get_array_task(self, array_id):
+    """Returns the array task with the given id, or None if this job has no such task."""
+    for array_job in self.array:
+      if array_job.id == array_id:
+        return array_job
+    step = self._array_step()
+    for status, ranges in self._get_array_state().items():
+      if _find_range(ranges, array_id, step) is not None:
+        return ArrayTask(self, array_id, status)
+    return None
+
+  def set_array_task(self, array_id, status, result = None, machine_name = None):
+    """Sets the state of the array task with the given id.
+    Only tasks with a machine name or a non-default result are stored as :py:class:`ArrayJob` rows, all others are stored as ranges."""
+    step = self._array_step()
+    state = self._get_array_state()
+    array_job = ([a for a in self.array if a.id == array_id] or [None])[0]
+    if array_job is None and not any(_remove_from_ranges(ranges, array_id, step) for ranges in state.values()):
+      logger.warning("Could not find array task %d of job %d" % (array_id, self.unique))
+      return
+
+    if _compressible(status, result, machine_name):
+      if array_job is not None:
+        self._remove_array_row(array_job)
+      _add_to_ranges(state.setdefault(status, []), array_id, step)
+    else:
+      if array_job is None:
+        array_job = ArrayJob(array_id, self.unique)
+        self.array.append(array_job)
+      array_job.status, array_job.result, array_job.machine_name = status, result, machine_name
+    self._set_array_state(state)
+
+  def remove_array_task(self, array_id):
+    """Removes the array task with the given id from this job."""
+    for array_job in self.array:
+      if array_job.id == array_id:
+        self._remove_array_row(array_job)
+        return
+    state = self._get_array_state()
+    step = self._array_step()
+    if any(_remove_from_ranges(ranges, array_id, step) for ranges in state.values()):
+      self._set_array_state(state)
+
+  def has_array_tasks(self):
+    """Returns True if this job has any array tasks left."""
+    return self._has_array_tasks(Status)
+
+
   def get_command_line(self):
     """Returns the command line for the job."""
-    # In python 2, the command line is unicode, which needs to be converted to string before pickling;
-    # In python 3, the command line is bytes, which can be pickled directly
-    return loads(self.command_line) if isinstance(self.command_line, bytes) else loads(str(self.command_line))
+    return _decode(self.command_line)
 
   def set_command_line(self, command_line):
     """Sets / overwrites the command line for the job."""
-    self.command_line = dumps(command_line)
+    self.command_line = _encode(list(command_line))
 
 
   def get_array(self):
-    """Returns the array arguments for the job; usually a string."""
-    # In python 2, the command line is unicode, which needs to be converted to string before pickling;
-    # In python 3, the command line is bytes, which can be pickled directly
-    return loads(self.array_string) if isinstance(self.array_string, bytes) else loads(str(self.array_string))
+    """Returns the array arguments (start, stop, step) for the job, or None if this is not an array job."""
+    array = _decode(self.array_string)
+    return tuple(array) if array is not None else None
 
 
   def get_arguments(self):
     """Returns the additional options for the grid (such as the queue, memory requirements, ...)."""
-    # In python 2, the command line is unicode, which needs to be converted to string before pickling;
-    # In python 3, the command line is bytes, which can be pickled directly
-    args = loads(self.grid_arguments)['kwargs'] if isinstance(self.grid_arguments, bytes) else loads(str(self.grid_arguments))['kwargs']
-    # in any case, the commands have to be converted to str
-    retval = {}
-    if 'pe_opt' in args:
-      retval['pe_opt'] = args['pe_opt']
-    if 'memfree' in args and args['memfree'] is not None:
-      retval['memfree'] = args['memfree']
-    if 'hvmem' in args and args['hvmem'] is not None:
-      retval['hvmem'] = args['hvmem']
-    if 'env' in args and len(args['env']) > 0:
-      retval['env'] = args['env']
-    if 'io_big' in args and args['io_big']:
-      retval['io_big'] = True
+    retval = _grid_arguments(_decode(self.grid_arguments) or {})
 
     # also add the queue
     if self.queue_name is not None:
@@ -239,8 +532,24 @@ class Job(Base):
 
     return retval
 
+  def requested_resources(self):
+    """Returns the number of CPU slots and the memory in bytes that this job (or each of its array tasks) requests with the ``pe_opt``, ``memfree`` and ``hvmem`` arguments.
+    As in the grid, ``memfree`` is the memory of all slots, while ``hvmem`` is the memory per slot."""
+    arguments = self.get_arguments()
+    slots = parse_slots(arguments['pe_opt']) if 'pe_opt' in arguments else 1
+    if 'memfree' in arguments:
+      memory = parse_memory(arguments['memfree'])
+    elif 'hvmem' in arguments:
+      memory = parse_memory(arguments['hvmem']) * slots
+    else:
+      memory = 0
+    return slots, memory
+
   def set_arguments(self, **kwargs):
-    self.grid_arguments = dumps(kwargs)
+    """Sets / overwrites the additional options for the grid; only the options required for re-submission are stored."""
+    arguments = _grid_arguments(kwargs)
+    self.grid_arguments = _encode(arguments)
+    self.memory = arguments.get('memfree')
 
   def get_jobs_we_wait_for(self):
     return [j.waited_for_job for j in self.jobs_we_have_to_wait_for if j.waited_for_job is not None]
@@ -270,7 +579,8 @@ class Job(Base):
     id = "%d (%d)" % (self.unique, self.id)
     if self.machine_name: m = "%s - %s" % (self.queue_name, self.machine_name)
     else: m = self.queue_name
-    if self.array: a = "[%d-%d:%d]" % self.get_array()
+    array = self.get_array()
+    if array: a = "[%d-%d:%d]" % array
     else: a = ""
     if self.name is not None: n = "<Job: %s %s - '%s'>" % (id, a, self.name)
     else: n = "<Job: %s>" % id
@@ -284,22 +594,23 @@ class Job(Base):
     if limit_command_line is not None and len(command_line) > limit_command_line:
       command_line = command_line[:limit_command_line-3] + '...'
 
-    job_id = "%d" % self.id + (" [%d-%d:%d]" % self.get_array() if self.array else "")
+    array = self.get_array()
+    job_id = "%d" % self.id + (" [%d-%d:%d]" % array if array else "")
     status = "%s" % self.status + (" (%d)" % self.result if self.result is not None else "" )
     queue = self.queue_name if self.machine_name is None else self.machine_name
     if limit_command_line is None:
       grid_opt = self.get_arguments()
       if grid_opt:
         # add additional information about the job at the end
-        command_line = "<" + ",".join(["%s=%s" % (key,value) for key,value in grid_opt.iteritems()]) + ">: " + command_line
+        command_line = "<" + ",".join(["%s=%s" % (key,value) for key,value in sorted(grid_opt.items())]) + ">: " + command_line
 
     if dependencies:
       deps = str(sorted(list(set([dep.unique for dep in self.get_jobs_we_wait_for()]))))
       if dependencies < len(deps):
         deps = deps[:dependencies-3] + '...'
-      return format.format(self.unique, job_id, queue[:12], status, self.name, deps, command_line)
+      return format.format(self.unique, job_id, queue[:12], status, self.name or "", deps, command_line)
     else:
-      return format.format(self.unique, job_id, queue[:12], status, self.name, command_line)
+      return format.format(self.unique, job_id, queue[:12], status, self.name or "", command_line)
 
 
 
@@ -307,13 +618,13 @@ class JobDependence(Base):
   """This table defines a many-to-many relationship between Jobs."""
   __tablename__ = 'JobDependence'
   id = Column(Integer, primary_key=True)
-  waiting_job_id = Column(Integer, ForeignKey('Job.unique')) # The ID of the waiting job
-  waited_for_job_id = Column(Integer, ForeignKey('Job.unique')) # The ID of the job to wait for
+  waiting_job_id = Column(Integer, ForeignKey('Job.unique'), index = True) # The ID of the waiting job
+  waited_for_job_id = Column(Integer, ForeignKey('Job.unique'), index = True) # The ID of the job to wait for
 
   # This is twisted: The 'jobs_we_have_to_wait_for' field in the Job class needs to be joined with the waiting job id, so that jobs_we_have_to_wait_for.waiting_job is correct
   # Honestly, I am lost but it seems to work...
-  waiting_job = relationship('Job', backref = 'jobs_we_have_to_wait_for', primaryjoin=(Job.unique == waiting_job_id), order_by=id) # The job that is waited for
-  waited_for_job = relationship('Job', backref = 'jobs_that_wait_for_us', primaryjoin=(Job.unique == waited_for_job_id), order_by=id) # The job that waits
+  waiting_job = relationship('Job', backref = backref('jobs_we_have_to_wait_for', order_by=id), primaryjoin=(Job.unique == waiting_job_id)) # The job that is waited for
+  waited_for_job = relationship('Job', backref = backref('jobs_that_wait_for_us', order_by=id), primaryjoin=(Job.unique == waited_for_job_id)) # The job that waits
 
   def __init__(self, waiting_job_id, waited_for_job_id):
     self.waiting_job_id = waiting_job_id
@@ -321,9 +632,154 @@ class JobDependence(Base):
 
 
 
-def add_job(session, command_line, name = 'job', dependencies = [], array = None, log_dir = None, stop_on_failure = False, **kwargs):
+def _create_indexes(connection):
+  """Creates all indexes of the tables, if they do not exist yet."""
+  for table in (Job.__table__, ArrayJob.__table__, JobDependence.__table__):
+    # indexes on columns that are added by later migrations are created by these migrations
+    existing = set(row[1] for row in connection.execute(sqlalchemy.text('PRAGMA table_info("%s")' % table.name)))
+    for index in sorted(table.indexes, key=lambda index: index.name):
+      if any(column.name not in existing for column in index.columns):
+        continue
+      columns = ", ".join('"%s"' % column.name for column in index.columns)
+      connection.execute(sqlalchemy.text('CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (index.name, table.name, columns)))
+
+
+def _encode_columns(connection):
+  """Adds the memory column and converts the pickled command lines, grid arguments and array specifications to JSON."""
+  columns = [row[1] for row in connection.execute(sqlalchemy.text('PRAGMA table_info("Job")'))]
+  if 'memory' not in columns:
+    try:
+      connection.execute(sqlalchemy.text('ALTER TABLE "Job" ADD COLUMN memory VARCHAR(20)'))
+    except sqlalchemy.exc.OperationalError as e:
+      # another process might have added the column in the meantime
+      if 'duplicate column' not in str(e):
+        raise
+  _create_indexes(connection)
+
+  def _is_json(value):
+    if not isinstance(value, six.string_types):
+      return False
+    try:
+      json.loads(value)
+      return True
+    except ValueError:
+      return False
+
+  updates = []
+  for unique, command_line, grid_arguments, array_string in connection.execute(sqlalchemy.text('SELECT "unique", command_line, grid_arguments, array_string FROM "Job"')):
+    if all(_is_json(value) for value in (command_line, grid_arguments, array_string)):
+      continue
+    arguments = _grid_arguments(_decode(grid_arguments) or {})
+    array = _decode(array_string)
+    updates.append({
+        'unique' : unique,
+        'command_line' : _encode(list(_decode(command_line))),
+        'grid_arguments' : _encode(arguments),
+        'memory' : arguments.get('memfree'),
+        'array_string' : _encode(list(array) if array is not None else None),
+    })
+  if updates:
+    connection.execute(sqlalchemy.text('UPDATE "Job" SET command_line = :command_line, grid_arguments = :grid_arguments, memory = :memory, array_string = :array_string WHERE "unique" = :unique'), updates)
+
+
+def _compress_arrays(connection):
+  """Adds the array_state column and replaces the ArrayJob rows that carry no information besides their status by ranges."""
+  columns = [row[1] for row in connection.execute(sqlalchemy.text('PRAGMA table_info("Job")'))]
+  if 'array_state' not in columns:
+    try:
+      connection.execute(sqlalchemy.text('ALTER TABLE "Job" ADD COLUMN array_state TEXT'))
+    except sqlalchemy.exc.OperationalError as e:
+      # another process might have added the column in the meantime
+      if 'duplicate column' not in str(e):
+        raise
+
+  jobs = connection.execute(sqlalchemy.text('SELECT "unique", array_string FROM "Job" WHERE array_state IS NULL')).fetchall()
+  for unique, array_string in jobs:
+    array = _decode(array_string)
+    if not array:
+      continue
+    state, compressed = {}, []
+    for row_id, task_id, status, result, machine_name in connection.execute(sqlalchemy.text('SELECT "unique", id, status, result, machine_name FROM "ArrayJob" WHERE job_id = :job_id'), {'job_id' : unique}):
+      # machine names are only kept for running and failed tasks
+      if status not in ('executing', 'failure'):
+        machine_name = None
+      if _compressible(status, result, machine_name):
+        state.setdefault(status, []).append(task_id)
+        compressed.append(row_id)
+    state = dict((status, _ranges_from_ids(ids, array[2])) for status, ids in state.items())
+    connection.execute(sqlalchemy.text('UPDATE "Job" SET array_state = :state WHERE "unique" = :unique'), {'state' : _encode(state), 'unique' : unique})
+    if compressed:
+      connection.execute(sqlalchemy.text('DELETE FROM "ArrayJob" WHERE "unique" = :unique'), [{'unique' : row_id} for row_id in compressed])
+
+
+def _add_column(connection, column, definition):
+  """Adds the given column to the Job table, if it does not exist yet."""
+  columns = [row[1] for row in connection.execute(sqlalchemy.text('PRAGMA table_info("Job")'))]
+  if column not in columns:
+    try:
+      connection.execute(sqlalchemy.text('ALTER TABLE "Job" ADD COLUMN %s %s' % (column, definition)))
+    except sqlalchemy.exc.OperationalError as e:
+      # another process might have added the column in the meantime
+      if 'duplicate column' not in str(e):
+        raise
+
+
+def _add_times(connection):
+  """Adds the start_time and finish_time columns, which are used to estimate the runtimes of the jobs."""
+  _add_column(connection, 'start_time', 'FLOAT')
+  _add_column(connection, 'finish_time', 'FLOAT')
+
+
+def _add_priority(connection):
+  """Adds the priority column; existing jobs get the default priority 0."""
+  _add_column(connection, 'priority', 'INTEGER DEFAULT 0')
+
+
+# The functions that upgrade the database schema from the previous version to the given version.
+# Each migration needs to be idempotent, since several processes might try to upgrade the same database at the same time.
+MIGRATIONS = {
+  1 : _create_indexes,
+  2 : _encode_columns,
+  3 : _compress_arrays,
+  4 : _create_indexes,
+  5 : _add_times,
+  6 : _add_priority,
+}
+
+
+def schema_version(connection):
+  """Returns the version of the schema of the database, or 0 if the database was created by a gridtk version that did not store the version."""
+  if connection.execute(sqlalchemy.text("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'SchemaVersion'")).first() is None:
+    return 0
+  return connection.execute(sqlalchemy.text('SELECT MAX(version) FROM "SchemaVersion"')).scalar() or 0
+
+
+def migrate(engine, read_engine = None):
+  """Upgrades the schema of the given database to the current :py:data:`SCHEMA_VERSION`.
+  If given, the version is read through the ``read_engine`` first, so that databases that are up to date are not locked for writing.
+  Returns the version of the database before the upgrade."""
+  if read_engine is not None:
+    with read_engine.connect() as connection:
+      version = schema_version(connection)
+    if version >= SCHEMA_VERSION:
+      return version
+  with engine.connect() as connection:
+    connection.execute(sqlalchemy.text('CREATE TABLE IF NOT EXISTS "SchemaVersion" (version INTEGER NOT NULL, PRIMARY KEY (version))'))
+    version = connection.execute(sqlalchemy.text('SELECT MAX(version) FROM "SchemaVersion"')).scalar() or 0
+    if version < SCHEMA_VERSION:
+      logger.info("Upgrading the schema of the database from version %d to %d" % (version, SCHEMA_VERSION))
+      for new_version in range(version + 1, SCHEMA_VERSION + 1):
+        MIGRATIONS[new_version](connection)
+      connection.execute(sqlalchemy.text('DELETE FROM "SchemaVersion"'))
+      connection.execute(sqlalchemy.text('INSERT INTO "SchemaVersion" (version) VALUES (%d)' % SCHEMA_VERSION))
+    if hasattr(connection, 'commit'):
+      connection.commit()
+  return version
+
+
+def add_job(session, command_line, name = 'job', dependencies = [], array = None, log_dir = None, stop_on_failure = False, priority = 0, **kwargs):
   """Helper function to create a job, add the dependencies and the array jobs."""
-  job = Job(command_line=command_line, name=name, log_dir=log_dir, array_string=array, stop_on_failure=stop_on_failure, kwargs=kwargs)
+  job = Job(command_line=command_line, name=name, log_dir=log_dir, array_string=array, stop_on_failure=stop_on_failure, priority=priority, **kwargs)
 
   session.add(job)
   session.flush()
@@ -342,12 +798,92 @@ def add_job(session, command_line, name = 'job', dependencies = [], array = None
     else:
       logger.warn("Could not find dependent job with id %d in database" % d)
 
-  if array:
-    (start, stop, step) = array
-    # add array jobs
-    for i in range(start, stop+1, step):
-      session.add(ArrayJob(i, job.unique))
-
+  # the array jobs are stored as ranges in the job (see Job.array_tasks), so no rows need to be added
   session.commit()
 
   return job
+
+
+def add_jobs(session, jobs):
+  """Helper function to add several jobs, including their dependencies and array jobs, within a single transaction.
+
+  Each element of ``jobs`` is a dictionary with the keyword arguments of :py:func:`add_job`, i.e., ``command_line`` and optionally ``name``, ``dependencies``, ``array``, ``log_dir``, ``stop_on_failure``, ``priority`` and additional grid arguments.
+  Additionally, a ``key`` can be specified, which can be used in the ``dependencies`` of later jobs in the same batch to refer to this job.
+  Integral dependencies refer to the (unique) ids of jobs already stored in the database.
+
+  Returns the list of unique ids of the newly added jobs (in the order of ``jobs``)."""
+  job_table, dependence_table = Job.__table__, JobDependence.__table__
+  keys = {}
+  job_ids = []
+  dependencies = []
+
+  for spec in jobs:
+    spec = dict(spec)
+    key = spec.pop('key', None)
+    command_line = spec.pop('command_line')
+    name = spec.pop('name', None)
+    deps = spec.pop('dependencies', [])
+    array = spec.pop('array', None)
+    log_dir = spec.pop('log_dir', None)
+    stop_on_failure = spec.pop('stop_on_failure', False)
+    priority = spec.pop('priority', 0)
+
+    # translate the dependencies into unique job ids
+    dependent_ids = set()
+    for d in deps:
+      if isinstance(d, six.integer_types):
+        dependent_ids.add(d)
+      elif d in keys:
+        dependent_ids.add(keys[d])
+      else:
+        raise ValueError("The dependency '%s' does not refer to a job that was added before in this batch" % str(d))
+
+    # add the job, without going through the ORM
+    arguments = _grid_arguments(spec)
+    unique = session.execute(job_table.insert(), {
+        'command_line' : _encode(list(command_line)),
+        'name' : name,
+        'queue_name' : 'local',
+        'grid_arguments' : _encode(arguments),
+        'memory' : arguments.get('memfree'),
+        'log_dir' : log_dir,
+        'array_string' : _encode(list(array) if array else None),
+        'array_state' : _initial_array_state(array) if array else None,
+        'stop_on_failure' : stop_on_failure,
+        'priority' : priority,
+        'status' : Status[0],
+    }).inserted_primary_key[0]
+    job_ids.append(unique)
+    if key is not None:
+      keys[key] = unique
+
+    dependencies.extend((unique, d) for d in sorted(dependent_ids))
+
+  # jobs that were stored before cannot wait for the new jobs, so cycles can only be formed by the new jobs
+  new_ids = set(job_ids)
+  cycle = find_cycle([(w, d) for (w, d) in dependencies if d in new_ids])
+  if cycle is not None:
+    session.rollback()
+    raise ValueError("The dependencies of the jobs form a cycle: %s" % format_cycle(cycle))
+
+  # by default id and unique id are identical, but the id might be overwritten later on
+  if job_ids:
+    session.execute(job_table.update().where(job_table.c.unique.in_(job_ids)).values(id = job_table.c.unique))
+
+  # check that the dependent jobs exist
+  if dependencies:
+    existing = set()
+    requested = sorted(set(d for (_, d) in dependencies))
+    for i in range(0, len(requested), 500):
+      chunk = requested[i:i+500]
+      existing.update(row[0] for row in session.query(Job.unique).filter(Job.unique.in_(chunk)))
+    for d in requested:
+      if d not in existing:
+        logger.warning("Could not find dependent job with id %d in database" % d)
+    dependencies = [{'waiting_job_id' : w, 'waited_for_job_id' : d} for (w, d) in dependencies if d in existing]
+    if dependencies:
+      session.execute(dependence_table.insert(), dependencies)
+
+  session.commit()
+
+  return job_ids
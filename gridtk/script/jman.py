@@ -22,18 +22,21 @@ import argparse
 import logging
 import string
 
-from ..tools import make_shell, logger
-from .. import local, sge
-from ..models import Status
+from ..tools import make_shell, logger, Status
 
 def setup(args):
   """Returns the JobManager and sets up the basic infrastructure"""
 
-  kwargs = {'wrapper_script' : args.wrapper_script, 'debug' : args.verbose==3, 'database' : args.database}
+  kwargs = {'wrapper_script' : args.wrapper_script, 'debug' : args.verbose==3, 'database' : args.database, 'journal_mode' : args.journal_mode, 'compress_logs' : args.compress_logs}
+  if args.pragma:
+    kwargs['pragmas'] = dict(pragma.split('=', 1) for pragma in args.pragma)
+  # the job managers (and the database layer) are only imported when they are needed
   if args.local:
-    jm = local.JobManagerLocal(**kwargs)
+    from ..local import JobManagerLocal
+    jm = JobManagerLocal(**kwargs)
   else:
-    jm = sge.JobManagerSGE(**kwargs)
+    from ..sge import JobManagerSGE
+    jm = JobManagerSGE(qsub_parallel=args.qsub_parallel, qsub_rate=args.qsub_rate, **kwargs)
 
   # set-up logging
   if args.verbose not in range(0,4):
@@ -129,6 +132,7 @@ def submit(args):
       kwargs['memfree'] = get_memfree(args.memory, args.parallel)
   kwargs['dry_run'] = args.dry_run
   kwargs['stop_on_failure'] = args.stop_on_failure
+  kwargs['priority'] = args.priority
 
   # submit the job
   job_id = jm.submit(args.job, **kwargs)
@@ -169,13 +173,13 @@ def run_scheduler(args):
   if not args.local:
     raise ValueError("The execute command can only be used with the '--local' command line option")
   jm = setup(args)
-  jm.run_scheduler(parallel_jobs=args.parallel, job_ids=get_ids(args.job_ids), sleep_time=args.sleep_time, die_when_finished=args.die_when_finished, no_log=args.no_log_files, nice=args.nice)
+  jm.run_scheduler(parallel_jobs=args.parallel, job_ids=get_ids(args.job_ids), sleep_time=args.sleep_time, die_when_finished=args.die_when_finished, no_log=args.no_log_files, nice=args.nice, use_wrapper=args.use_wrapper, slots=args.slots, memory=args.memory)
 
 
 def list(args):
   """Lists the jobs in the given database."""
   jm = setup(args)
-  jm.list(job_ids=get_ids(args.job_ids), print_array_jobs=args.print_array_jobs, print_dependencies=args.print_dependencies, status=args.status, long=args.long, ids_only=args.ids_only, names=args.names)
+  jm.list(job_ids=get_ids(args.job_ids), print_array_jobs=args.print_array_jobs, print_dependencies=args.print_dependencies, status=args.status, long=args.long, ids_only=args.ids_only, names=args.names, queues=args.queues, memory=args.memory, command=args.command, order_by=args.order_by, reverse=args.reverse, limit=args.limit, offset=args.offset)
 
 
 def communicate(args):
@@ -183,13 +187,35 @@ def communicate(args):
   if args.local:
     raise ValueError("The communicate command can only be used without the '--local' command line option")
   jm = setup(args)
-  jm.communicate(job_ids=get_ids(args.job_ids))
+  jm.communicate(job_ids=get_ids(args.job_ids), max_age=args.max_age)
+
+
+def poll(args):
+  """Regularly writes the status of the jobs in the grid to a file that is shared by the other commands."""
+  if args.local:
+    raise ValueError("The poll command can only be used without the '--local' command line option")
+  jm = setup(args)
+  jm.poll(min_interval=args.interval[0], max_interval=args.interval[1], polls=args.polls)
 
 
 def report(args):
   """Reports the results of the finished (and unfinished) jobs."""
   jm = setup(args)
-  jm.report(job_ids=get_ids(args.job_ids), array_ids=get_ids(args.array_ids), output=not args.errors_only, error=not args.output_only, status=args.status, name=args.name)
+  if args.follow and args.head is not None:
+    raise ValueError("The --head option cannot be used together with --follow")
+  jm.report(job_ids=get_ids(args.job_ids), array_ids=get_ids(args.array_ids), output=not args.errors_only, error=not args.output_only, status=args.status, name=args.name, head=args.head, tail=args.tail, follow=args.follow, interval=args.interval)
+
+
+def grep(args):
+  """Searches the log files of the jobs for a regular expression."""
+  jm = setup(args)
+  jm.grep(args.pattern, job_ids=get_ids(args.job_ids), array_ids=get_ids(args.array_ids), output=not args.errors_only, error=not args.output_only, status=args.status, name=args.name, ignore_case=args.ignore_case, fixed_strings=args.fixed_strings, processes=args.processes, use_index=args.index)
+
+
+def graph(args):
+  """Writes the dependency graph of the jobs, including the critical path."""
+  jm = setup(args)
+  jm.graph(job_ids=get_ids(args.job_ids), format=args.format, default_runtime=args.runtime)
 
 
 def stop(args):
@@ -253,9 +279,18 @@ class AliasedSubParsersAction(argparse._SubParsersAction):
     return parser
 
 
-def main(command_line_options = None):
+class _VersionAction(argparse.Action):
+  """Prints the version of GridTk; the version is only determined when it is requested."""
+  def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS, help=None):
+    super(_VersionAction, self).__init__(option_strings=option_strings, dest=dest, default=default, nargs=0, help=help)
+
+  def __call__(self, parser, namespace, values, option_string=None):
+    from ..config import __version__
+    print('GridTk version %s' % __version__)
+    parser.exit()
 
-  from ..config import __version__
+
+def main(command_line_options = None):
 
   formatter = argparse.ArgumentDefaultsHelpFormatter
   parser = argparse.ArgumentParser(description=__doc__, epilog=__epilog__,
@@ -266,13 +301,23 @@ def main(command_line_options = None):
   # general options
   parser.add_argument('-v', '--verbose', action = 'count', default = 0,
       help = "Increase the verbosity level from 0 (only error messages) to 1 (warnings), 2 (log messages), 3 (debug information) by adding the --verbose option as often as desired (e.g. '-vvv' for debug).")
-  parser.add_argument('-V', '--version', action='version',
-      version='GridTk version %s' % __version__)
+  parser.add_argument('-V', '--version', action=_VersionAction,
+      help="show program's version number and exit")
   parser.add_argument('-d', '--database', '--db', metavar='DATABASE', default = 'submitted.sql3',
       help='replace the default database "submitted.sql3" by one provided by you.')
+  parser.add_argument('--journal-mode', choices=('wal', 'delete', 'truncate', 'persist'), default='wal',
+      help='The journal mode of the SQLite database; on network file systems such as NFS, "wal" is replaced by "delete".')
+  parser.add_argument('--pragma', metavar='KEY=VALUE', action='append',
+      help='Additional SQLite pragma for the database connections, e.g. "cache_size=-65536" or "synchronous=FULL"; can be given several times.')
+  parser.add_argument('--compress-logs', choices=('gzip', 'xz'),
+      help='Compress the log files of the jobs when they have finished; give this option to the command that executes the jobs, i.e., "submit" and "resubmit" in the grid, or "run-scheduler" locally. Compressed log files are read by "report" and removed by "delete" as usual.')
 
   parser.add_argument('-l', '--local', action='store_true',
         help = 'Uses the local job manager instead of the SGE one.')
+  parser.add_argument('--qsub-parallel', type=int, default=8, metavar='N',
+        help = 'The maximum number of parallel calls to qsub, qstat and qdel when several jobs are (re-)submitted to the SGE grid.')
+  parser.add_argument('--qsub-rate', type=float, default=10., metavar='CALLS',
+        help = 'The maximum number of calls to qsub, qstat and qdel per second, so that the SGE master is not flooded (0 for no limit).')
   cmdparser = parser.add_subparsers(title='commands', help='commands accepted by %(prog)s')
 
   # subcommand 'submit'
@@ -283,6 +328,7 @@ def main(command_line_options = None):
   submit_parser.add_argument('-n', '--name', dest='name', help='Gives the job a name')
   submit_parser.add_argument('-x', '--dependencies', type=int, default=[], metavar='ID', nargs='*', help='Set job dependencies to the list of job identifiers separated by spaces')
   submit_parser.add_argument('-k', '--stop-on-failure', action='store_true', help='Stop depending jobs when this job finished with an error.')
+  submit_parser.add_argument('--priority', type=int, default=0, help='The priority of the job in the local scheduler: jobs with higher priorities (and the jobs they wait for) are started first. Jobs with the same priority are started in the order of the longest chain of jobs that wait for them.')
   submit_parser.add_argument('-l', '--log-dir', metavar='DIR', help='Sets the log directory. By default, "logs" is selected for the SGE. If the jobs are executed locally, by default the result is written to console.')
   submit_parser.add_argument('-s', '--environment', metavar='KEY=VALUE', dest='env', nargs='*', default=[], help='Passes specific environment variables to the job.')
   submit_parser.add_argument('-t', '--array', '--parametric', metavar='(first-)last(:step)', help="Creates a parametric (array) job. You must specify the 'last' value, but 'first' (default=1) and 'step' (default=1) can be specified as well (when specifying 'step', 'first' has to be given, too).")
@@ -320,13 +366,27 @@ def main(command_line_options = None):
   list_parser.add_argument('-x', '--print-dependencies', action='store_true', help='Print the dependencies of the jobs as well.')
   list_parser.add_argument('-o', '--ids-only', action='store_true', help='Prints ONLY the job ids (so that they can be parsed by automatic scripts).')
   list_parser.add_argument('-s', '--status', nargs='+', choices = Status, default = Status, help='Delete only jobs that have the given statuses; by default all jobs are deleted.')
+  list_parser.add_argument('-q', '--queues', metavar='QUEUE', nargs='+', help='List only the jobs that were submitted to the given queues (use \'local\' for local jobs).')
+  list_parser.add_argument('-m', '--memory', help='List only the jobs that requested the given amount of memory, e.g. 8G.')
+  list_parser.add_argument('-c', '--command', help='List only the jobs whose command line contains the given string.')
+  list_parser.add_argument('-O', '--order-by', choices=('id', 'grid-id', 'name', 'queue', 'status'), default='id', help='Sort the jobs by the given property.')
+  list_parser.add_argument('-r', '--reverse', action='store_true', help='Sort the jobs in descending order, e.g., to list the latest jobs first.')
+  list_parser.add_argument('--limit', type=int, metavar='N', help='List at most the given number of jobs.')
+  list_parser.add_argument('--offset', type=int, default=0, metavar='N', help='Skip the given number of jobs before listing (use together with --limit to list the jobs page by page).')
   list_parser.set_defaults(func=list)
 
   # subcommand 'communicate'
   stop_parser = cmdparser.add_parser('communicate', aliases = ['com'], formatter_class=formatter, help='Communicates with the grid to see if there were unexpected errors (e.g. a timeout) during the job execution.')
   stop_parser.add_argument('-j', '--job-ids', metavar='ID', nargs='+', help='Check only the jobs with the given ids (by default, all jobs are checked)')
+  stop_parser.add_argument('-a', '--max-age', type=float, default=30., metavar='SECONDS', help='Use the status of the grid written by another process (e.g. "jman poll") if it is not older than the given number of seconds; use 0 to always call qstat.')
   stop_parser.set_defaults(func=communicate)
 
+  # subcommand 'poll'
+  poll_parser = cmdparser.add_parser('poll', formatter_class=formatter, help='Regularly writes the status of the jobs in the grid to a file next to the database, which is used by "jman communicate" instead of calling qstat. To stop it, please use Ctrl-C.')
+  poll_parser.add_argument('-i', '--interval', type=float, nargs=2, default=[10., 120.], metavar=('MIN', 'MAX'), help='The minimum and maximum number of seconds between two qstat calls; the interval is increased while the status of the jobs does not change.')
+  poll_parser.add_argument('-n', '--polls', type=int, help='Stop after the given number of qstat calls (by default, the poller runs until it is interrupted).')
+  poll_parser.set_defaults(func=poll)
+
 
   # subcommand 'report'
   report_parser = cmdparser.add_parser('report', aliases=['rep', 'r', 'explain', 'why'], formatter_class=formatter, help='Iterates through the result and error log files and prints out the logs.')
@@ -336,8 +396,35 @@ def main(command_line_options = None):
   report_parser.add_argument('-a', '--array-ids', metavar='ID', nargs='+', help='Report only the jobs with the given array ids. If specified, a single job-id must be given as well.')
   report_parser.add_argument('-n', '--name', help="Report only the jobs with the given name; by default all jobs are reported.")
   report_parser.add_argument('-s', '--status', nargs='+', choices = Status, default = Status, help='Report only jobs that have the given statuses; by default all jobs are reported.')
+  lines_group = report_parser.add_mutually_exclusive_group()
+  lines_group.add_argument('--head', type=int, metavar='N', help='Report only the first N lines of each log file.')
+  lines_group.add_argument('--tail', type=int, metavar='N', help='Report only the last N lines of each log file.')
+  report_parser.add_argument('-f', '--follow', action='store_true', help='Report the log files while they are growing, until all selected jobs have finished (the --status option is ignored); log files of array jobs are added when the tasks start.')
+  report_parser.add_argument('-i', '--interval', type=float, default=1., metavar='SECONDS', help='The interval, in which the database and the log files are checked in --follow mode; changes of log files on local file systems are reported immediately.')
   report_parser.set_defaults(func=report)
 
+  # subcommand 'grep'
+  grep_parser = cmdparser.add_parser('grep', formatter_class=formatter, help='Searches the log files of the jobs for lines that match a regular expression, and lists the jobs and array tasks with the number of matching lines.')
+  grep_parser.add_argument('pattern', help='The regular expression (in Python syntax) to search for.')
+  grep_parser.add_argument('-e', '--errors-only', action='store_true', help='Only search the error logs (by default, both logs are searched).')
+  grep_parser.add_argument('-o', '--output-only', action='store_true', help='Only search the output logs (by default, both logs are searched).')
+  grep_parser.add_argument('-j', '--job-ids', metavar='ID', nargs='+', help='Search only the logs of the jobs with the given ids (by default, all jobs are searched)')
+  grep_parser.add_argument('-a', '--array-ids', metavar='ID', nargs='+', help='Search only the logs of the jobs with the given array ids. If specified, a single job-id must be given as well.')
+  grep_parser.add_argument('-n', '--name', help="Search only the logs of the jobs with the given name; by default all jobs are searched.")
+  grep_parser.add_argument('-s', '--status', nargs='+', choices = Status, default = Status, help='Search only the logs of jobs (or array tasks) that have the given statuses; by default all jobs are searched.')
+  grep_parser.add_argument('-i', '--ignore-case', action='store_true', help='Ignore the case of the letters in the pattern and the log files.')
+  grep_parser.add_argument('-F', '--fixed-strings', action='store_true', help='Interpret the pattern as a plain string, not as a regular expression.')
+  grep_parser.add_argument('-p', '--processes', type=int, metavar='N', help='The number of processes that search the log files in parallel; by default, one per CPU.')
+  grep_parser.add_argument('-x', '--index', action='store_true', help='Keep an index of the sizes, line counts and matches of the log files next to the database, so that repeated searches skip the log files that did not change.')
+  grep_parser.set_defaults(func=grep)
+
+  # subcommand 'graph'
+  graph_parser = cmdparser.add_parser('graph', formatter_class=formatter, help='Analyzes the dependencies of the jobs, and writes their topological levels and the critical path, i.e., the chain of dependent jobs with the longest total runtime.')
+  graph_parser.add_argument('-j', '--job-ids', metavar='ID', nargs='+', help='Analyze only the dependencies among the jobs with the given ids (by default, all jobs are analyzed)')
+  graph_parser.add_argument('-f', '--format', choices=('text', 'dot'), default='text', help='Write a summary as text, or the whole graph in the DOT language of Graphviz, e.g., to be rendered with "dot -Tpdf".')
+  graph_parser.add_argument('-r', '--runtime', type=float, metavar='SECONDS', help='The runtime that is assumed for jobs that did not finish, and for which no finished job with the same name exists; by default, the average runtime of all finished jobs is used.')
+  graph_parser.set_defaults(func=graph)
+
   # subcommand 'delete'
   delete_parser = cmdparser.add_parser('delete', aliases=['del', 'rm', 'remove'], formatter_class=formatter, help='Removes jobs from the database; if jobs are running or are still scheduled in SGE, the jobs are also removed from the SGE queue.')
   delete_parser.add_argument('-j', '--job-ids', metavar='ID', nargs='+', help='Delete only the jobs with the given ids (by default, all jobs are deleted).')
@@ -351,10 +438,13 @@ def main(command_line_options = None):
   scheduler_parser = cmdparser.add_parser('run-scheduler', aliases=['sched', 'x'], formatter_class=formatter, help='Runs the scheduler on the local machine. To stop the scheduler safely, please use Ctrl-C; only valid in combination with the \'--local\' option.')
   scheduler_parser.add_argument('-p', '--parallel', type=int, default=1, help='Select the number of parallel jobs that you want to execute locally')
   scheduler_parser.add_argument('-j', '--job-ids', metavar='ID', nargs='+', help='Select the job ids that should be run (be default, all submitted and queued jobs are run).')
-  scheduler_parser.add_argument('-s', '--sleep-time', type=float, default=0.1, help='Set the sleep time between for the scheduler in seconds.')
+  scheduler_parser.add_argument('-s', '--sleep-time', type=float, default=0.1, help='Set the maximum time in seconds that the scheduler sleeps before checking the database for new jobs; finished jobs wake up the scheduler immediately.')
   scheduler_parser.add_argument('-x', '--die-when-finished', action='store_true', help='Let the job manager die when it has finished all jobs of the database.')
   scheduler_parser.add_argument('-l', '--no-log-files', action='store_true', help='Overwrites the log file setup to print the results to the console.')
   scheduler_parser.add_argument('-n', '--nice', type=int, help='Jobs will be run with the given priority (can only be positive, i.e., to have lower priority')
+  scheduler_parser.add_argument('-c', '--slots', type=int, help='The number of CPU slots that the jobs can use together, where each job uses the number of slots that it was submitted with (-p); by default, the number of CPUs of this machine.')
+  scheduler_parser.add_argument('-m', '--memory', help='The memory that the jobs can use together (e.g. 64G), where each job uses the memory that it was submitted with (-m); by default, the physical memory of this machine.')
+  scheduler_parser.add_argument('-w', '--use-wrapper', action='store_true', help='Executes each job through the \'jman run-job\' wrapper script, as it is done in the grid; by default, the scheduler executes the command lines of the jobs directly.')
   scheduler_parser.set_defaults(func=run_scheduler)
 
 
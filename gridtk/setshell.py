@@ -10,14 +10,111 @@ import os
 import sys
 import signal
 import subprocess
+import time
+import json
+import hashlib
+import tempfile
 from .tools import logger, str_
 
-def environ(context):
-  """Retrieves the environment for a particular SETSHELL context"""
+# The Idiap-wide shell initialization, which is sourced when SETSHELL is not set up
+IDIAP_SOURCE = "/idiap/resource/software/initfiles/shrc"
+
+# The number of seconds that a cached environment is valid; can be overwritten by the GRIDTK_SETSHELL_CACHE_TTL environment variable (0 disables the cache)
+CACHE_TTL = 3600
+
+
+def _cache_dir():
+  """Returns the directory where the environments of the SETSHELL contexts are cached."""
+  if 'GRIDTK_CACHE_DIR' in os.environ:
+    return os.environ['GRIDTK_CACHE_DIR']
+  return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser('~'), '.cache')), 'gridtk')
+
+def _cache_ttl():
+  try:
+    return float(os.environ.get('GRIDTK_SETSHELL_CACHE_TTL', CACHE_TTL))
+  except ValueError:
+    return CACHE_TTL
+
+def _cache_file(context):
+  """Returns the name of the cache file for the given context.
+  The name depends on all inputs of SETSHELL, so that changes of the setup invalidate the cache."""
+  inputs = [context, os.environ.get('BASEDIRSETSHELL', ''), os.environ.get('PATH', '')]
+  for path in (IDIAP_SOURCE, '%s/setshell/bin/dosetshell' % os.environ.get('BASEDIRSETSHELL', '')):
+    try:
+      inputs.append("%s:%d" % (path, os.stat(path).st_mtime))
+    except OSError:
+      inputs.append("%s:-" % path)
+  key = hashlib.sha1("\n".join(inputs).encode('utf-8')).hexdigest()
+  name = "".join(c if c.isalnum() else '_' for c in context)
+  return os.path.join(_cache_dir(), "setshell-%s-%s.json" % (name, key))
+
+def _read_cache(cache_file, ttl):
+  """Returns the cached changes of the environment, or None if there are no valid cached changes."""
+  try:
+    if time.time() - os.stat(cache_file).st_mtime > ttl:
+      return None
+    with open(cache_file) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+def _write_cache(cache_file, changes):
+  """Writes the given changes of the environment to the given cache file."""
+  try:
+    if not os.path.isdir(os.path.dirname(cache_file)):
+      os.makedirs(os.path.dirname(cache_file))
+    # write to a temporary file first, so that concurrent readers never see a partial file
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file), prefix='.setshell')
+    with os.fdopen(fd, 'w') as f:
+      json.dump(changes, f)
+    os.rename(temp_file, cache_file)
+    logger.debug("Cached environment in '%s'", cache_file)
+  except (IOError, OSError) as e:
+    logger.debug("Could not cache environment in '%s': %s", cache_file, e)
+
+def clear_cache(context = None):
+  """Removes the cached environments of the given context, or of all contexts."""
+  cache_dir = _cache_dir()
+  prefix = "setshell-%s-" % "".join(c if c.isalnum() else '_' for c in context) if context is not None else "setshell-"
+  if os.path.isdir(cache_dir):
+    for name in os.listdir(cache_dir):
+      if name.startswith(prefix):
+        try:
+          os.remove(os.path.join(cache_dir, name))
+        except OSError:
+          pass
+
+
+def environ(context, use_cache = True):
+  """Retrieves the environment for a particular SETSHELL context.
+  The changes that SETSHELL applies to the current environment are cached on disk (see :py:data:`CACHE_TTL`), so that the shell scripts do not need to be sourced for every call."""
+  ttl = _cache_ttl() if use_cache else 0
+  if ttl <= 0:
+    return _environ(context)
+
+  # the cache file depends on the original environment, which might be changed by sourcing the Idiap-wide shell
+  cache_file = _cache_file(context)
+  changes = _read_cache(cache_file, ttl)
+  if changes is not None:
+    logger.debug("Using cached environment for context '%s' from '%s'", context, cache_file)
+    new_environ = dict(os.environ)
+    new_environ.update(changes)
+    return new_environ
+
+  old_environ = dict(os.environ)
+  new_environ = _environ(context)
+  if 'BASEDIRSETSHELL' in new_environ:
+    # only cache the changes, so that job specific variables (such as JOB_ID) are not shared
+    _write_cache(cache_file, dict((key, value) for key, value in new_environ.items() if old_environ.get(key) != value))
+  return new_environ
+
+
+def _environ(context):
+  """Sources the SETSHELL scripts to get the environment for the given context."""
   if 'BASEDIRSETSHELL' not in os.environ:
     # It seems that we are in a hostile environment
     # try to source the Idiap-wide shell
-    idiap_source = "/idiap/resource/software/initfiles/shrc"
+    idiap_source = IDIAP_SOURCE
     if os.path.exists(idiap_source):
       logger.debug("Sourcing: '%s'"%idiap_source)
       try:
@@ -10,15 +10,38 @@ from __future__ import print_function
 
 from .manager import JobManager
 from .setshell import environ
-from .models import add_job, Job
-from .tools import logger, qsub, qstat, qdel, make_shell
+from .models import add_job, add_jobs, Job
+from .tools import logger, qsub, qstat, qstat_snapshot, read_qstat_snapshot, write_qstat_snapshot, qdel, make_shell
 
 import os, sys
+import time
+import threading
+
+
+class _RateLimiter(object):
+  """Limits the number of calls per second; it can be shared between threads."""
+
+  def __init__(self, rate):
+    self._interval = 1. / rate if rate else 0.
+    self._next = 0.
+    self._lock = threading.Lock()
+
+  def wait(self):
+    """Waits until the next call is allowed."""
+    if not self._interval:
+      return
+    with self._lock:
+      now = time.time()
+      delay = self._next - now
+      self._next = max(now, self._next) + self._interval
+    if delay > 0:
+      time.sleep(delay)
+
 
 class JobManagerSGE(JobManager):
   """The JobManager will submit and control the status of submitted jobs"""
 
-  def __init__(self, context='grid', **kwargs):
+  def __init__(self, context='grid', qsub_parallel=8, qsub_rate=10., **kwargs):
     """Initializes this object with a state file and a method for qsub'bing.
 
     Keyword parameters:
@@ -30,13 +53,33 @@ class JobManagerSGE(JobManager):
     context
       The context to provide when setting up the environment to call the SGE
       utilities such as qsub, qstat and qdel (normally 'grid', which also
-      happens to be default)
+      happens to be default); the environment is only set up when one of
+      these utilities is called for the first time
+
+    qsub_parallel
+      The maximum number of SGE utilities that are called in parallel when
+      several jobs are (re-)submitted at once
+
+    qsub_rate
+      The maximum number of calls to the SGE utilities per second, so that
+      the SGE master is not flooded; use 0 for no limit
     """
 
-    self.context = environ(context)
+    self._context_name = context
+    self._context = None
+    self._qsub_parallel = max(qsub_parallel, 1)
+    self._rate_limiter = _RateLimiter(qsub_rate)
     JobManager.__init__(self, **kwargs)
 
 
+  @property
+  def context(self):
+    """The environment to call the SGE utilities with."""
+    if self._context is None:
+      self._context = environ(self._context_name)
+    return self._context
+
+
   def _queue(self, kwargs):
     """The hard resource_list comes like this: '<qname>=TRUE,mem=128M'. To
     process it we have to split it twice (',' and then on '='), create a
@@ -48,7 +91,8 @@ class JobManagerSGE(JobManager):
     return 'all.q'
 
 
-  def _submit_to_grid(self, job, name, array, dependencies, log_dir, **kwargs):
+  def _qsub_arguments(self, name, array, dependencies, log_dir, **kwargs):
+    """Returns the arguments of the :py:func:`gridtk.tools.qsub` call for a job."""
     # ... what we will actually submit to the grid is a wrapper script that will call the desired command...
     # get the name of the file that was called originally
     jman = self.wrapper_script
@@ -59,17 +103,43 @@ class JobManagerSGE(JobManager):
     deps = sorted(list(set([j.id for j in dependent_jobs])))
 
     # generate call to the wrapper script
-    command = make_shell(python, [jman, '-d', self._database, 'run-job'])
+    command = make_shell(python, [jman, '-d', self._database, '--journal-mode', self._journal_mode] + (['--compress-logs', self._compress_logs] if self._compress_logs else []) + ['run-job'])
     q_array = "%d-%d:%d" % array if array else None
-    grid_id = qsub(command, context=self.context, name=name, deps=deps, array=q_array, stdout=log_dir, stderr=log_dir, **kwargs)
+    return dict(command=command, name=name, deps=deps, array=q_array, stdout=log_dir, stderr=log_dir, **kwargs)
+
 
-    # get the result of qstat
-    status = qstat(grid_id, context=self.context)
+  def _qsub(self, arguments):
+    """Submits a job to the grid and returns its grid id and the result of qstat.
+    This function does not access the database, so that it can be called from several threads."""
+    self._rate_limiter.wait()
+    grid_id = qsub(context=self.context, **arguments)
+    self._rate_limiter.wait()
+    return grid_id, qstat(grid_id, context=self.context)
 
-    # set the grid id of the job
+
+  def _qdel(self, grid_id):
+    """Deletes a job from the grid; this function does not access the database, so that it can be called from several threads."""
+    self._rate_limiter.wait()
+    qdel(grid_id, context=self.context)
+
+
+  def _stop_grid_jobs(self, grid_ids):
+    """Deletes the given jobs from the grid, using several threads."""
+    for grid_id, (_, exception) in zip(grid_ids, self._parallel(self._qdel, grid_ids)):
+      if exception is not None:
+        logger.warning("Could not delete job '%d' from the grid: %s" % (grid_id, exception))
+
+
+  def _submit_to_grid(self, job, name, array, dependencies, log_dir, **kwargs):
+    grid_id, status = self._qsub(self._qsub_arguments(name, array, dependencies, log_dir, **kwargs))
+    return self._queued(job, grid_id, status, **kwargs)
+
+
+  def _queued(self, job, grid_id, status, **kwargs):
+    """Sets the grid id of the given job after it has been submitted to the grid."""
     job.queue(new_job_id = int(status['job_number']), new_job_name = status['job_name'], queue_name = self._queue(status))
 
-    logger.info("Submitted job '%s' with dependencies '%s' to the SGE grid." % (job, str(deps)))
+    logger.info("Submitted job '%s' with dependencies '%s' to the SGE grid." % (job, str([dep.id for dep in job.get_jobs_we_wait_for()])))
 
     if 'io_big' in kwargs and kwargs['io_big'] and ('queue' not in kwargs or kwargs['queue'] == 'all.q'):
       logger.warn("This job will never be executed since the 'io_big' flag is not available for the 'all.q'.")
@@ -80,11 +150,78 @@ class JobManagerSGE(JobManager):
     return job.unique
 
 
-  def submit(self, command_line, name = None, array = None, dependencies = [], log_dir = "logs", dry_run = False, stop_on_failure = False, **kwargs):
-    """Submits a job that will be executed in the grid."""
+  def _parallel(self, function, arguments, callback = None):
+    """Calls the given function for all arguments using at most ``qsub_parallel`` threads.
+    Returns the list of results, where each result is a tuple of the return value and the exception raised by the function (or None).
+    If given, the ``callback`` is called in the current thread with the index of each argument and its result, as soon as the results of all previous arguments are available."""
+    def call(argument):
+      try:
+        return function(argument), None
+      except Exception as e:
+        return None, e
+
+    if len(arguments) <= 1 or self._qsub_parallel == 1:
+      results = (call(argument) for argument in arguments)
+      pool = None
+    else:
+      # make sure that the environment is set up before the threads are started
+      self.context
+      from multiprocessing.pool import ThreadPool
+      pool = ThreadPool(min(self._qsub_parallel, len(arguments)))
+      results = pool.imap(call, arguments, chunksize=1)
+    try:
+      collected = []
+      for index, result in enumerate(results):
+        if callback is not None:
+          callback(index, result)
+        collected.append(result)
+      return collected
+    finally:
+      if pool is not None:
+        pool.close()
+        pool.join()
+
+
+  def _submit_all(self, submissions):
+    """Submits several jobs to the grid, where several qsub calls are executed in parallel.
+    Each submission is a tuple of the job, its name, array, dependencies, log directory and the additional qsub arguments;
+    the dependencies must be listed before the jobs that depend on them.
+    Jobs are submitted in waves, so that the grid ids of all dependencies are known when a job is submitted."""
+    # compute the waves, i.e., the length of the longest chain of dependencies inside the submitted jobs
+    levels, waves = {}, []
+    for submission in submissions:
+      level = max([levels[dep] + 1 for dep in submission[3] if dep in levels] + [0])
+      levels[submission[0].unique] = level
+      while len(waves) <= level:
+        waves.append([])
+      waves[level].append(submission)
+
+    for wave in waves:
+      arguments = [self._qsub_arguments(name, array, dependencies, log_dir, **kwargs) for (job, name, array, dependencies, log_dir, kwargs) in wave]
+      # the database must not be locked while the (rate limited) qsub calls run, otherwise the jobs that already started in the grid cannot read it
+      self.session.commit()
+      errors = []
+      def _submitted(index, outcome):
+        submission, (result, exception) = wave[index], outcome
+        if exception is not None:
+          logger.error("Could not submit job '%s' to the SGE grid: %s" % (submission[0], exception))
+          errors.append(exception)
+          return
+        self._queued(submission[0], result[0], result[1], **submission[5])
+        # commit each job right away to avoid failures of not finding the job during execution in the grid
+        self.session.commit()
+      self._parallel(self._qsub, arguments, _submitted)
+      if errors:
+        # the jobs of the next waves might depend on the failed jobs
+        raise errors[0]
+
+
+  def submit(self, command_line, name = None, array = None, dependencies = [], log_dir = "logs", dry_run = False, stop_on_failure = False, priority = 0, **kwargs):
+    """Submits a job that will be executed in the grid.
+    The ``priority`` is only used when the job is re-submitted to the local scheduler."""
     # add job to database
     self.lock()
-    job = add_job(self.session, command_line, name, dependencies, array, log_dir=log_dir, stop_on_failure=stop_on_failure, context=self.context, **kwargs)
+    job = add_job(self.session, command_line, name, dependencies, array, log_dir=log_dir, stop_on_failure=stop_on_failure, priority=priority, **kwargs)
     logger.info("Added job '%s' to the database." % job)
     if dry_run:
       print("Would have added the Job")
@@ -103,23 +240,121 @@ class JobManagerSGE(JobManager):
     return job_id
 
 
-  def communicate(self, job_ids = None):
-    """Communicates with the SGE grid (using qstat) to see if jobs are still running."""
+  def submit_many(self, jobs, dry_run = False):
+    """Submits several jobs to the grid, which are added to the database within a single transaction.
+    Each job is given as a dictionary with the parameters of :py:meth:`submit`; jobs of the same batch can refer to each other in the dependencies, see :py:func:`gridtk.models.add_jobs`.
+    Returns the list of new job ids."""
+    job_keys = ('key', 'command_line', 'name', 'array', 'dependencies', 'log_dir', 'stop_on_failure', 'priority')
+    specs = [dict(job) for job in jobs]
+    for spec in specs:
+      spec.setdefault('log_dir', 'logs')
+
+    if dry_run:
+      for spec in specs:
+        print("Would have added the Job", spec, "to the database to be executed in the grid.")
+      return []
+
+    self.lock()
+    try:
+      job_ids = add_jobs(self.session, specs)
+      logger.info("Added %d jobs to the database." % len(job_ids))
+
+      # jobs can only depend on jobs that have been added before, so they are already sorted topologically
+      jobs = dict((job.unique, job) for job in self.get_jobs(job_ids, load=('dependencies',)))
+      submissions = []
+      for job_id, spec in zip(job_ids, specs):
+        job = jobs[job_id]
+        kwargs = dict((k, v) for k, v in spec.items() if k not in job_keys)
+        deps = [dep.unique for dep in job.get_jobs_we_wait_for()]
+        submissions.append((job, job.name, spec.get('array'), deps, job.log_dir, kwargs))
+      self.session.commit()
+      self._submit_all(submissions)
+    finally:
+      self.unlock()
+
+    return job_ids
+
+
+  def snapshot_file(self):
+    """Returns the name of the file, in which the status of the jobs in the grid is shared between processes."""
+    return self._database + '.qstat'
+
+
+  def grid_user(self):
+    """Returns the user whose jobs are listed in the snapshot file, which is the owner of the database.
+    This way, everybody who watches the same database shares the same snapshot."""
+    try:
+      import pwd
+      return pwd.getpwuid(os.stat(self._database).st_uid).pw_name
+    except (ImportError, KeyError, OSError):
+      import getpass
+      return getpass.getuser()
+
+
+  def grid_snapshot(self, max_age = 0):
+    """Returns the status of all jobs of the owner of the database in the grid, see :py:func:`gridtk.tools.qstat_snapshot`.
+    If the snapshot file was written less than ``max_age`` seconds ago (e.g. by :py:meth:`poll`), it is used instead of calling qstat.
+    Otherwise, qstat is called and the snapshot file is updated, so that other processes can use it; it gets the permissions of the database, so that all users who can read the database can read the snapshot."""
+    user = self.grid_user()
+    if max_age > 0:
+      snapshot = read_qstat_snapshot(self.snapshot_file(), max_age, user=user)
+      if snapshot is not None:
+        logger.debug("Using the grid status from '%s'", self.snapshot_file())
+        return snapshot
+
+    self._rate_limiter.wait()
+    snapshot = qstat_snapshot(user=user, context=self.context)
+    try:
+      write_qstat_snapshot(self.snapshot_file(), snapshot, user=user, mode=os.stat(self._database).st_mode & 0o666)
+    except (IOError, OSError) as e:
+      logger.warning("Could not write the grid status to '%s': %s" % (self.snapshot_file(), e))
+    return snapshot
+
+
+  def poll(self, min_interval = 10., max_interval = 120., polls = None):
+    """Regularly writes the status of all our jobs in the grid to the snapshot file, so that other processes do not need to call qstat themselves.
+    The interval between two qstat calls starts with ``min_interval`` seconds and is doubled up to ``max_interval`` seconds while the status in the grid does not change.
+    This function runs until it is interrupted, or until the given number of ``polls`` were made."""
+    interval, last = min_interval, None
+    count = 0
+    try:
+      while polls is None or count < polls:
+        snapshot = self.grid_snapshot()
+        states = dict((job_id, (job['state'], job['tasks'])) for job_id, job in snapshot.items())
+        interval = min_interval if states != last else min(interval * 2, max_interval)
+        last = states
+        count += 1
+        logger.info("Wrote the status of %d jobs in the grid to '%s'; next update in %g seconds" % (len(snapshot), self.snapshot_file(), interval))
+        if polls is None or count < polls:
+          time.sleep(interval)
+    # This is the only way to stop: you have to interrupt the poller
+    except KeyboardInterrupt:
+      logger.info("Stopping the grid poller due to user interrupt.")
+
+
+  def communicate(self, job_ids = None, max_age = 0):
+    """Communicates with the SGE grid (using qstat) to see if jobs are still running.
+    The status of the grid is read from the snapshot file if it is not older than ``max_age`` seconds, see :py:meth:`grid_snapshot`."""
+    # get the status of all our jobs in the grid with a single call;
+    # this needs to be done BEFORE reading the database, so that jobs that left the grid in the meantime have already written their final status
+    snapshot = self.grid_snapshot(max_age)
+
     self.lock()
     # iterate over all jobs
     jobs = self.get_jobs(job_ids)
     for job in jobs:
       job.refresh()
       if job.status in ('queued', 'executing', 'waiting') and job.queue_name != 'local':
+        if job.id in snapshot:
+          continue
+        # the job might have been submitted after the snapshot was taken, so make sure that it is really gone
         status = qstat(job.id, context=self.context)
         if len(status) == 0:
           job.status = 'failure'
           job.result = 70 # ASCII: 'F'
           logger.warn("The job '%s' was not executed successfully (maybe a time-out happened). Please check the log files." % job)
-          for array_job in job.array:
-            if array_job.status in ('queued', 'executing'):
-              array_job.status = 'failure'
-              array_job.result = 70 # ASCII: 'F'
+          for array_job in job.array_tasks(('queued', 'executing')):
+            job.set_array_task(array_job.id, 'failure', 70, array_job.machine_name) # ASCII: 'F'
 
 
     self.session.commit()
@@ -129,21 +364,36 @@ class JobManagerSGE(JobManager):
   def resubmit(self, job_ids = None, also_success = False, running_jobs = False, new_command=None, **kwargs):
     """Re-submit jobs automatically"""
     self.lock()
-    # iterate over all jobs
-    jobs = self.get_jobs(job_ids)
-    if new_command is not None:
-      if len(jobs) == 1:
-        jobs[0].set_command_line(new_command)
-      else:
-        logger.warn("Ignoring new command since no single job id was specified")
-    accepted_old_status = ('submitted', 'success', 'failure') if also_success else ('submitted', 'failure',)
-    for job in jobs:
-      # check if this job needs re-submission
-      if running_jobs or job.status in accepted_old_status:
-        grid_status = qstat(job.id, context=self.context)
-        if len(grid_status) != 0:
-          logger.warn("Deleting job '%d' since it was still running in the grid." % job.unique)
-          qdel(job.id, context=self.context)
+    try:
+      # iterate over all jobs
+      jobs = self.get_jobs(job_ids, load=('dependencies',))
+      if new_command is not None:
+        if len(jobs) == 1:
+          jobs[0].set_command_line(new_command)
+        else:
+          logger.warn("Ignoring new command since no single job id was specified")
+      accepted_old_status = ('submitted', 'success', 'failure') if also_success else ('submitted', 'failure',)
+      # check if the jobs need re-submission
+      jobs = [job for job in jobs if running_jobs or job.status in accepted_old_status]
+      if not jobs:
+        self.session.commit()
+        return
+
+      # delete the jobs that are still running in the grid, using a single qstat call per user
+      snapshot = self.grid_snapshot()
+      import getpass
+      if getpass.getuser() != self.grid_user():
+        # the snapshot lists only the jobs of the owner of the database, but not the jobs that we submitted ourselves
+        self._rate_limiter.wait()
+        snapshot.update(qstat_snapshot(context=self.context))
+      running = [job for job in jobs if job.id in snapshot]
+      for job in running:
+        logger.warning("Deleting job '%d' since it was still running in the grid." % job.unique)
+      self._stop_grid_jobs([job.id for job in running])
+
+      # jobs can only depend on jobs that have been added before, so they are already sorted topologically
+      submissions = []
+      for job in jobs:
         # re-submit job to the grid
         arguments = job.get_arguments()
         arguments.update(**kwargs)
@@ -151,7 +401,7 @@ class JobManagerSGE(JobManager):
           for arg in ('hvmem', 'pe_opt', 'io_big'):
             if arg in arguments:
               del arguments[arg]
-        job.set_arguments(kwargs=arguments)
+        job.set_arguments(**arguments)
         # delete old status and result of the job
         job.submit()
         if job.queue_name == 'local' and 'queue' not in arguments:
@@ -159,17 +409,18 @@ class JobManagerSGE(JobManager):
         else:
           deps = [dep.unique for dep in job.get_jobs_we_wait_for()]
           logger.debug("Re-submitting job '%s' with dependencies '%s' to the grid." % (job, deps))
-          self._submit_to_grid(job, job.name, job.get_array(), deps, job.log_dir, **arguments)
+          submissions.append((job, job.name, job.get_array(), deps, job.log_dir, arguments))
 
-        # commit after each job to avoid failures of not finding the job during execution in the grid
-        self.session.commit()
-    self.unlock()
+      self.session.commit()
+      self._submit_all(submissions)
+    finally:
+      self.unlock()
 
 
   def run_job(self, job_id, array_id = None):
     """Overwrites the run-job command from the manager to extract the correct job id before calling base class implementation."""
     # get the unique job id from the given grid id
-    self.lock()
+    self.lock(read_only=True)
     jobs = list(self.session.query(Job).filter(Job.id == job_id))
     if len(jobs) != 1:
       self.unlock()
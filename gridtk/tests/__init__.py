@@ -1,3 +1,4 @@
+# vim: set fileencoding=utf-8 :
 
 from __future__ import print_function
 
@@ -67,7 +68,7 @@ class GridTKTest(unittest.TestCase):
       self.assertEqual(len(jobs), 2)
       self.assertEqual(jobs[0].id, 1)
       self.assertEqual(jobs[1].id, 2)
-      self.assertEqual(len(jobs[1].array), 4)
+      self.assertEqual(len(jobs[1].array_tasks()), 4)
       self.assertEqual(jobs[0].status, 'submitted')
       self.assertEqual(jobs[1].status, 'submitted')
 
@@ -81,62 +82,26 @@ class GridTKTest(unittest.TestCase):
 
       job_manager.unlock()
 
-      # now, start the local execution of the job in a parallel job
-      self.scheduler_job = subprocess.Popen(['./bin/jman', '--local', '--database', self.database, 'run-scheduler', '--sleep-time', '5', '--parallel', '2'])
-
-      # sleep some time to assure that the scheduler was able to start the first job
-      time.sleep(4)
-      # ... and kill the scheduler
-      self.scheduler_job.kill()
-      self.scheduler_job = None
-
-      # now, the first job needs to have status failure, and the second needs to be queued
-      session = job_manager.lock()
-      jobs = list(session.query(Job))
-      self.assertEqual(len(jobs), 2)
-      if jobs[0].status in ('submitted', 'queued', 'executing'):
-        # on slow machines, we don0t want the tests to fail, so we just skip
-        job_manager.unlock()
-        raise nose.plugins.skip.SkipTest("This machine seems to be quite slow in processing parallel jobs.")
-      self.assertEqual(jobs[0].status, 'failure')
-      self.assertEqual(jobs[1].status, 'queued')
-      # the result files should already be there
-      self.assertTrue(os.path.exists(jobs[0].std_out_file()))
-      self.assertTrue(os.path.exists(jobs[0].std_err_file()))
-      job_manager.unlock()
-
-
-      # reset the job 1
-      jman.main(['./bin/jman', '--local', '--database', self.database, 'resubmit', '--job-id', '1', '--running-jobs', '--overwrite-command', script_1])
-
-      # now, start the local execution of the job in a parallel job
-      self.scheduler_job = subprocess.Popen(['./bin/jman', '--local', '--database', self.database, 'run-scheduler', '--sleep-time', '5', '--parallel', '2'])
-
-      # sleep some time to assure that the scheduler was able to finish the first and start the second job
-      time.sleep(9)
-      # ... and kill the scheduler
-      self.scheduler_job.kill()
+      # now, start the local execution of the jobs; the scheduler does not need to wait for the sleep time to start a job after its dependencies have finished
+      start_time = time.time()
+      self.scheduler_job = subprocess.Popen(['./bin/jman', '--local', '--database', self.database, 'run-scheduler', '--sleep-time', '10', '--parallel', '2', '--die-when-finished'])
+      # and wait for the job to finish (the timeout argument to Popen only exists from python 3.3 onwards)
+      self.scheduler_job.wait()
       self.scheduler_job = None
+      self.assertTrue(time.time() - start_time < 10)
 
-      # Job 1 and two array jobs of job two should be finished now, the other two still need to be queued
+      # the first job needs to have failed, and the array jobs of the second job are finished
       session = job_manager.lock()
       jobs = list(session.query(Job))
       self.assertEqual(len(jobs), 2)
-      if jobs[0].status in ('queued', 'executing') or jobs[1].status == 'queued':
-        # on slow machines, we don0t want the tests to fail, so we just skip
-        job_manager.unlock()
-        raise nose.plugins.skip.SkipTest("This machine seems to be quite slow in processing parallel jobs.")
       self.assertEqual(jobs[0].status, 'failure')
-      self.assertEqual(jobs[1].status, 'executing')
-      if jobs[1].array[0].status == 'executing' or jobs[1].array[1].status == 'executing':
-        # on slow machines, we don0t want the tests to fail, so we just skip
-        job_manager.unlock()
-        raise nose.plugins.skip.SkipTest("This machine seems to be quite slow in processing parallel jobs.")
-      self.assertEqual(jobs[1].array[0].status, 'failure')
-      self.assertEqual(jobs[1].array[0].result, 1)
-      self.assertEqual(jobs[1].array[1].status, 'success')
-      self.assertEqual(jobs[1].array[1].result, 0)
-      self.assertEqual(len([a for a in jobs[1].array if a.status == 'queued']), 2)
+      self.assertEqual(jobs[0].result, 255)
+      self.assertEqual(jobs[1].status, 'failure')
+      self.assertEqual(jobs[1].array_tasks()[0].status, 'failure')
+      self.assertEqual(jobs[1].array_tasks()[0].result, 1)
+      for i in range(1,4):
+        self.assertEqual(jobs[1].array_tasks()[i].status, 'success')
+        self.assertEqual(jobs[1].array_tasks()[i].result, 0)
       out_file = jobs[0].std_out_file()
       err_file = jobs[0].std_err_file()
       job_manager.unlock()
@@ -147,6 +112,14 @@ class GridTKTest(unittest.TestCase):
       self.assertEqual(open(out_file).read().rstrip(), 'This is a text message to std-out')
       self.assertEqual(open(err_file).read().split('\n')[0], 'This is a text message to std-err')
 
+      # reset the job 1
+      jman.main(['./bin/jman', '--local', '--database', self.database, 'resubmit', '--job-id', '1', '--running-jobs', '--overwrite-command', script_1])
+      session = job_manager.lock()
+      jobs = list(session.query(Job))
+      self.assertEqual(jobs[0].status, 'submitted')
+      self.assertEqual(jobs[0].get_command_line(), [script_1])
+      job_manager.unlock()
+
       # resubmit all jobs
       jman.main(['./bin/jman', '--local', '--database', self.database, 'resubmit', '--running-jobs'])
       # check that the log files have been cleaned
@@ -155,8 +128,8 @@ class GridTKTest(unittest.TestCase):
       # ... but the log dir still exists
       self.assertTrue(os.path.exists(self.log_dir))
 
-      # now, let the scheduler run all jobs
-      self.scheduler_job = subprocess.Popen(['./bin/jman', '--local', '--database', self.database, 'run-scheduler', '--sleep-time', '1', '--parallel', '2', '--die-when-finished'])
+      # now, let the scheduler run all jobs, this time through the wrapper script
+      self.scheduler_job = subprocess.Popen(['./bin/jman', '--local', '--database', self.database, 'run-scheduler', '--sleep-time', '1', '--parallel', '2', '--die-when-finished', '--use-wrapper'])
       # and wait for the job to finish (the timeout argument to Popen only exists from python 3.3 onwards)
       self.scheduler_job.wait()
       self.scheduler_job = None
@@ -179,11 +152,11 @@ class GridTKTest(unittest.TestCase):
       jobs = list(session.query(Job))
       self.assertEqual(len(jobs), 2)
       self.assertEqual(jobs[1].status, 'failure')
-      self.assertEqual(jobs[1].array[0].status, 'failure')
-      self.assertEqual(jobs[1].array[0].result, 1)
+      self.assertEqual(jobs[1].array_tasks()[0].status, 'failure')
+      self.assertEqual(jobs[1].array_tasks()[0].result, 1)
       for i in range(1,4):
-        self.assertEqual(jobs[1].array[i].status, 'success')
-        self.assertEqual(jobs[1].array[i].result, 0)
+        self.assertEqual(jobs[1].array_tasks()[i].status, 'success')
+        self.assertEqual(jobs[1].array_tasks()[i].result, 0)
       job_manager.unlock()
 
       print()
@@ -237,3 +210,1050 @@ class GridTKTest(unittest.TestCase):
     # Tests the functionality of the grid toolkit in the grid
     import nose
     raise nose.plugins.skip.SkipTest("This test is not yet implemented. If you find a proper ways to test the grid functionality, please go ahead and implement the test.")
+
+
+  def test03_qstat_xml(self):
+    # Tests that the bulk status snapshot of the grid is parsed correctly
+    from gridtk.tools import parse_qstat_xml
+    snapshot = parse_qstat_xml(pkg_resources.resource_filename('gridtk.tests', 'qstat.xml'))
+
+    self.assertEqual(sorted(snapshot.keys()), [4711, 4712, 4713])
+    self.assertEqual(snapshot[4711]['job_name'], 'test_1')
+    self.assertEqual(snapshot[4711]['state'], 'r')
+    self.assertEqual(snapshot[4711]['queue_name'], 'q1d@node01')
+    self.assertEqual(snapshot[4711]['tasks'], [])
+    # the array job is listed twice, once for the running and once for the pending tasks
+    self.assertEqual(snapshot[4712]['state'], 'r')
+    self.assertEqual(snapshot[4712]['tasks'], ['1', '3-7:2'])
+    self.assertEqual(snapshot[4713]['state'], 'hqw')
+    self.assertTrue(snapshot[4713]['queue_name'] is None)
+
+
+  def test04_submit_many(self):
+    # Tests that a batch of jobs with intra-batch dependencies is added correctly
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_ids = job_manager.submit_many([
+      {'key' : 'prepare', 'command_line' : ['echo', 'prepare'], 'name' : 'prepare'},
+      {'key' : 'process', 'command_line' : ['echo', 'process'], 'array' : (1,5,2), 'dependencies' : ['prepare'], 'log_dir' : self.log_dir},
+      {'command_line' : ['echo', 'collect'], 'dependencies' : ['process', 'prepare'], 'stop_on_failure' : True, 'queue' : 'q1d'},
+    ])
+    self.assertEqual(job_ids, [1, 2, 3])
+    self.assertRaises(ValueError, job_manager.submit_many, [{'command_line' : ['echo'], 'dependencies' : ['unknown']}])
+
+    session = job_manager.lock()
+    jobs = list(session.query(Job))
+    self.assertEqual([job.id for job in jobs], [1, 2, 3])
+    self.assertEqual([job.status for job in jobs], ['submitted'] * 3)
+    self.assertEqual(jobs[0].get_command_line(), ['echo', 'prepare'])
+    self.assertEqual(jobs[1].get_array(), (1,5,2))
+    self.assertEqual([a.id for a in jobs[1].array_tasks()], [1, 3, 5])
+    self.assertEqual([j.unique for j in jobs[1].get_jobs_we_wait_for()], [1])
+    self.assertEqual(sorted(j.unique for j in jobs[2].get_jobs_we_wait_for()), [1, 2])
+    self.assertTrue(jobs[2].stop_on_failure)
+    job_manager.unlock()
+
+
+  def test05_migration(self):
+    # Tests that databases of older gridtk versions are upgraded automatically
+    import sqlite3
+    from gridtk.models import SCHEMA_VERSION
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_manager.submit_many([{'command_line' : ['echo'], 'name' : 'old', 'array' : (1,4,1)}])
+
+    # remove everything that older versions did not create, and store the values pickled as older versions did
+    from pickle import dumps
+    connection = sqlite3.connect(self.database)
+    for (index,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'").fetchall():
+      connection.execute('DROP INDEX "%s"' % index)
+    connection.execute('DROP TABLE "SchemaVersion"')
+    connection.execute('ALTER TABLE "Job" DROP COLUMN memory')
+    connection.execute('ALTER TABLE "Job" DROP COLUMN array_state')
+    connection.execute('ALTER TABLE "Job" DROP COLUMN start_time')
+    connection.execute('ALTER TABLE "Job" DROP COLUMN finish_time')
+    connection.execute('ALTER TABLE "Job" DROP COLUMN priority')
+    connection.execute('UPDATE "Job" SET command_line = ?, grid_arguments = ?, array_string = ?', (dumps(['echo', 'hello']), dumps({'kwargs' : {'memfree' : '8G', 'env' : [], 'context' : {'PATH' : '/bin'}}}), dumps((1,4,1))))
+    connection.executemany('INSERT INTO "ArrayJob" (id, job_id, status, result, machine_name) VALUES (?, 1, ?, ?, ?)', [(1, 'failure', 1, 'node'), (2, 'success', 0, 'node'), (3, 'success', 0, 'node'), (4, 'queued', None, None)])
+    connection.commit()
+    connection.close()
+
+    # a new job manager upgrades the database when accessing it
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    session = job_manager.lock()
+    jobs = list(session.query(Job))
+    self.assertEqual(len(jobs), 1)
+    self.assertEqual([(a.id, a.status, a.result, a.machine_name) for a in jobs[0].array_tasks()], [(1, 'failure', 1, 'node'), (2, 'success', 0, None), (3, 'success', 0, None), (4, 'queued', None, None)])
+    self.assertEqual([a.id for a in jobs[0].array], [1])
+    self.assertEqual(jobs[0].get_command_line(), ['echo', 'hello'])
+    self.assertEqual(jobs[0].get_array(), (1,4,1))
+    self.assertEqual(jobs[0].get_arguments(), {'memfree' : '8G', 'queue' : 'local'})
+    self.assertEqual(jobs[0].memory, '8G')
+    job_manager.unlock()
+
+    connection = sqlite3.connect(self.database)
+    indexes = set(name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'ix_%'"))
+    self.assertEqual(indexes, set(('ix_Job_id', 'ix_Job_name', 'ix_Job_status', 'ix_Job_memory', 'ix_ArrayJob_job_id_id', 'ix_JobDependence_waiting_job_id', 'ix_JobDependence_waited_for_job_id')))
+    self.assertEqual(connection.execute('SELECT command_line, array_string, array_state FROM "Job"').fetchall(), [('["echo","hello"]', '[1,4,1]', '{"queued":[[4,4]],"success":[[2,3]]}')])
+    self.assertEqual(connection.execute('SELECT version FROM "SchemaVersion"').fetchall(), [(SCHEMA_VERSION,)])
+    connection.close()
+
+    # checking the version of an up-to-date database does not wait for the write lock
+    import threading
+    writer = sqlite3.connect(self.database, isolation_level=None)
+    writer.execute('BEGIN IMMEDIATE')
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    counts = []
+    def _read():
+      counts.append(job_manager.lock(read_only=True).query(Job).count())
+      job_manager.unlock()
+    reader = threading.Thread(target=_read)
+    reader.daemon = True
+    reader.start()
+    reader.join(10)
+    alive = reader.is_alive()
+    writer.execute('ROLLBACK')
+    writer.close()
+    reader.join()
+    self.assertFalse(alive)
+    self.assertEqual(counts, [1])
+
+
+  def test06_filter(self):
+    # Tests that jobs can be filtered by queue, memory and command line in the database
+    from gridtk.models import add_job
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_manager.submit(['echo', 'hello world'])
+    session = job_manager.lock()
+    add_job(session, ['python', 'train_100%.py', '--epochs', '10'], memfree='8G', hvmem='8G', env=['A=B'], context={'PATH' : '/bin'})
+    job = add_job(session, ['python', 'test.py'], memfree='4G')
+    job.queue_name = 'q1d'
+    session.commit()
+
+    self.assertEqual([j.unique for j in job_manager.get_jobs(queues=['local'])], [1, 2])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(queues=['q1d', 'q1w'])], [3])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(memory='8G')], [2])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(command='python')], [2, 3])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(command='train_100%.py --epochs')], [2])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(command='train_1000')], [])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(command='hello world')], [1])
+    self.assertEqual([j.unique for j in job_manager.get_jobs(queues=['local'], command='python')], [2])
+
+    # only the arguments needed for re-submission are stored
+    self.assertEqual(job_manager.get_jobs([2])[0].get_arguments(), {'memfree' : '8G', 'hvmem' : '8G', 'env' : ['A=B'], 'queue' : 'local'})
+    job_manager.unlock()
+
+
+  def test07_large_array(self):
+    # Tests that array jobs with many tasks are stored as ranges and only tasks with additional information are stored as rows
+    from gridtk.models import ArrayJob
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    start = time.time()
+    job_id = job_manager.submit(['echo'], array=(1,1000000,2))
+    self.assertTrue(time.time() - start < 10)
+
+    session = job_manager.lock()
+    self.assertEqual(session.query(ArrayJob).count(), 0)
+    job = job_manager.get_jobs((job_id,))[0]
+    job.queue()
+    self.assertEqual(job.array_state, '{"queued":[[1,999999]]}')
+    job.execute(99999, 'node')
+    job.execute(3, 'node')
+    session.commit()
+    self.assertEqual([(a.id, a.status, a.machine_name) for a in session.query(ArrayJob).order_by(ArrayJob.id)], [(3, 'executing', 'node'), (99999, 'executing', 'node')])
+    self.assertEqual(job.array_state, '{"queued":[[1,1],[5,99997],[100001,999999]]}')
+
+    # finished tasks are stored as rows only if they failed
+    job.finish(0, 99999)
+    job.finish(2, 3)
+    session.commit()
+    self.assertEqual([(a.id, a.status, a.result, a.machine_name) for a in session.query(ArrayJob)], [(3, 'failure', 2, 'node')])
+    self.assertEqual(job.array_state, '{"queued":[[1,1],[5,99997],[100001,999999]],"success":[[99999,99999]]}')
+    self.assertEqual(job.status, 'executing')
+    self.assertEqual(len(job.array_ids(('queued',))), 499998)
+    self.assertEqual(job.get_array_task(99999).status, 'success')
+    self.assertEqual(job.get_array_task(3).result, 2)
+    self.assertEqual(job.get_array_task(4), None)
+
+    # resubmission resets all tasks
+    job.submit()
+    session.commit()
+    self.assertEqual(session.query(ArrayJob).count(), 0)
+    self.assertEqual(job.array_state, '{"submitted":[[1,999999]]}')
+    job_manager.unlock()
+
+    # run a small array job completely
+    job_id = job_manager.submit(['echo'], array=(1,5,1))
+    session = job_manager.lock()
+    job = job_manager.get_jobs((job_id,))[0]
+    job.queue()
+    for array_id in (2, 1, 5, 3, 4):
+      job.execute(array_id, 'node')
+      job.finish(0 if array_id != 5 else 3, array_id)
+    self.assertEqual(job.status, 'failure')
+    self.assertEqual(job.result, 3)
+    self.assertEqual([(a.id, a.status, a.result) for a in job.array_tasks()], [(1, 'success', 0), (2, 'success', 0), (3, 'success', 0), (4, 'success', 0), (5, 'failure', 3)])
+    self.assertEqual(job.array_state, '{"success":[[1,4]]}')
+    job_manager.unlock()
+
+
+  def test08_startup(self):
+    # Tests that the command line does not import the database layer or other expensive modules when they are not needed
+    import sys
+    code = "import sys\nfrom gridtk.script import jman\ntry:\n  jman.main(['jman', '%s'])\nexcept SystemExit:\n  pass\nsys.stderr.write(' '.join(sorted(sys.modules)))"
+    for option in ('--version', '--help'):
+      process = subprocess.Popen([sys.executable, '-c', code % option], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+      output, modules = process.communicate()
+      modules = modules.decode().split()
+      self.assertTrue(b'GridTk' in output or b'usage' in output)
+      for module in ('sqlalchemy', 'pkg_resources', 'distutils', 'gridtk.models', 'gridtk.manager', 'gridtk.local', 'gridtk.sge'):
+        self.assertFalse(module in modules, "The module '%s' was imported by 'jman %s'" % (module, option))
+
+
+  def test09_setshell_cache(self):
+    # Tests that the environment of SETSHELL contexts is cached and reused
+    from gridtk import setshell
+    # create a fake SETSHELL installation, which counts how often it is called
+    base_dir = os.path.join(self.temp_dir, 'setshell')
+    os.makedirs(os.path.join(base_dir, 'setshell', 'bin'))
+    counter = os.path.join(self.temp_dir, 'counter')
+    dosetshell = os.path.join(base_dir, 'setshell', 'bin', 'dosetshell')
+    with open(dosetshell, 'w') as f:
+      f.write('#!/bin/bash\necho >> %s\nsource=$(mktemp)\necho "export GRIDTK_TEST_CONTEXT=$3" > $source\necho $source\n' % counter)
+    os.chmod(dosetshell, 0o755)
+
+    old_environ = dict(os.environ)
+    try:
+      os.environ.update(BASEDIRSETSHELL=base_dir, GRIDTK_CACHE_DIR=os.path.join(self.temp_dir, 'cache'), JOB_ID='1')
+      os.environ.pop('GRIDTK_SETSHELL_CACHE_TTL', None)
+      calls = lambda: len(open(counter).readlines())
+
+      self.assertEqual(setshell.environ('grid')['GRIDTK_TEST_CONTEXT'], 'grid')
+      self.assertEqual(calls(), 1)
+      # the second call uses the cache, but job specific variables are not taken from the cache
+      os.environ['JOB_ID'] = '2'
+      env = setshell.environ('grid')
+      self.assertEqual(calls(), 1)
+      self.assertEqual(env['GRIDTK_TEST_CONTEXT'], 'grid')
+      self.assertEqual(env['JOB_ID'], '2')
+      # other contexts are cached separately
+      self.assertEqual(setshell.environ('other')['GRIDTK_TEST_CONTEXT'], 'other')
+      self.assertEqual(calls(), 2)
+
+      # invalidate the cache explicitly, by changing the inputs, by disabling it and by the time-out
+      setshell.clear_cache('grid')
+      setshell.environ('grid')
+      self.assertEqual(calls(), 3)
+      os.environ['PATH'] += os.pathsep + self.temp_dir
+      setshell.environ('grid')
+      self.assertEqual(calls(), 4)
+      setshell.environ('grid', use_cache=False)
+      self.assertEqual(calls(), 5)
+      os.environ['GRIDTK_SETSHELL_CACHE_TTL'] = '0'
+      setshell.environ('grid')
+      self.assertEqual(calls(), 6)
+      self.assertEqual(setshell.environ('other')['GRIDTK_TEST_CONTEXT'], 'other')
+      self.assertEqual(calls(), 7)
+    finally:
+      os.environ.clear()
+      os.environ.update(old_environ)
+
+
+  def _fake_sge(self):
+    # creates fake SGE utilities, which use their process id as grid id; returns the directory that contains them
+    bin_dir = os.path.join(self.temp_dir, 'bin')
+    os.makedirs(bin_dir)
+    scripts = {
+      'qsub' : '#!/bin/bash\nname=none\nhold=\nwhile [ $# -gt 0 ]; do case "$1" in -N) name=$2; shift;; -hold_jid) hold=$2; shift;; esac; shift; done\nsleep 0.1\nif [ -x %(dir)s/qsub_hook ]; then %(dir)s/qsub_hook; fi\necho $name > %(dir)s/$$\necho "$$ $name $hold" >> %(dir)s/qsub.log\necho $$\n',
+      'qstat' : '#!/bin/bash\nif [ "$1" = "-j" ] && grep -qw $2 %(dir)s/finished 2>/dev/null; then echo "Following jobs do not exist: $2"; exit; fi\nif [ "$1" = "-j" ]; then echo "job_number:  $2"; echo "job_name:  $(cat %(dir)s/$2)"; exit; fi\necho $2 >> %(dir)s/qstat.log\necho "<job_info><queue_info>"\nfor id in $(cat %(dir)s/running.$2 %(dir)s/running 2>/dev/null); do echo "<job_list state=\\"running\\"><JB_job_number>$id</JB_job_number><JB_name>x</JB_name><state>r</state></job_list>"; done\necho "</queue_info></job_info>"\n',
+      'qdel' : '#!/bin/bash\necho $1 >> %(dir)s/qdel.log\n',
+    }
+    for name, script in scripts.items():
+      with open(os.path.join(bin_dir, name), 'w') as f:
+        f.write(script % {'dir' : self.temp_dir})
+      os.chmod(os.path.join(bin_dir, name), 0o755)
+    return bin_dir
+
+
+  def test10_qsub_pipeline(self):
+    # Tests that jobs are submitted to the SGE grid in parallel, in the order of their dependencies
+    import sys
+    import gridtk.sge
+    bin_dir = self._fake_sge()
+
+    def submitted():
+      with open(os.path.join(self.temp_dir, 'qsub.log')) as f:
+        return dict((line.split()[1], (int(line.split()[0]), line.split()[2:])) for line in f)
+
+    old_path = os.environ['PATH']
+    try:
+      os.environ['PATH'] = bin_dir + os.pathsep + old_path
+      job_manager = gridtk.sge.JobManagerSGE(database=self.database, qsub_parallel=4, qsub_rate=0)
+      job_manager.submit_many([
+        {'key' : 'a', 'command_line' : ['echo', 'a'], 'name' : 'a'},
+        {'key' : 'b', 'command_line' : ['echo', 'b'], 'name' : 'b', 'dependencies' : ['a']},
+        {'key' : 'c', 'command_line' : ['echo', 'c'], 'name' : 'c', 'dependencies' : ['a']},
+        {'key' : 'd', 'command_line' : ['echo', 'd'], 'name' : 'd', 'dependencies' : ['b', 'c']},
+        {'command_line' : ['echo', 'e'], 'name' : 'e'},
+      ])
+
+      # check that the grid ids of the dependencies have been used
+      grid = submitted()
+      self.assertEqual(sorted(grid), ['a', 'b', 'c', 'd', 'e'])
+      self.assertEqual(grid['b'][1], [str(grid['a'][0])])
+      self.assertEqual(grid['c'][1], [str(grid['a'][0])])
+      self.assertEqual(grid['d'][1], [','.join(str(i) for i in sorted((grid['b'][0], grid['c'][0])))])
+      self.assertEqual(grid['e'][1], [])
+
+      session = job_manager.lock()
+      jobs = dict((job.name, job) for job in session.query(Job))
+      self.assertEqual(dict((name, job.id) for name, job in jobs.items()), dict((name, grid[name][0]) for name in grid))
+      self.assertEqual(sorted(name for name, job in jobs.items() if job.status == 'queued'), ['a', 'e'])
+      for job in jobs.values():
+        job.finish(1)
+      session.commit()
+      job_manager.unlock()
+
+      # re-submit all jobs, where job 'a' is still running in the grid
+      with open(os.path.join(self.temp_dir, 'running'), 'w') as f:
+        f.write(str(grid['a'][0]))
+      os.remove(os.path.join(self.temp_dir, 'qsub.log'))
+      job_manager.resubmit()
+      with open(os.path.join(self.temp_dir, 'qdel.log')) as f:
+        self.assertEqual(f.read().split(), [str(grid['a'][0])])
+      regrid = submitted()
+      self.assertEqual(sorted(regrid), ['a', 'b', 'c', 'd', 'e'])
+      self.assertNotEqual(regrid['a'][0], grid['a'][0])
+      self.assertEqual(regrid['b'][1], [str(regrid['a'][0])])
+      self.assertEqual(regrid['d'][1], [','.join(str(i) for i in sorted((regrid['b'][0], regrid['c'][0])))])
+
+      # jobs that cannot be deleted from the grid are reported
+      import logging
+      messages = []
+      handler = logging.Handler()
+      handler.emit = lambda record: messages.append(record.getMessage())
+      def _qdel(grid_id):
+        raise OSError("qdel failed")
+      job_manager._qdel = _qdel
+      with open(os.path.join(self.temp_dir, 'running'), 'w') as f:
+        f.write(str(regrid['e'][0]))
+      level = gridtk.tools.logger.level
+      gridtk.tools.logger.addHandler(handler)
+      gridtk.tools.logger.setLevel(logging.WARNING)
+      try:
+        job_manager.resubmit(job_ids=[5], running_jobs=True)
+      finally:
+        gridtk.tools.logger.removeHandler(handler)
+        gridtk.tools.logger.setLevel(level)
+      self.assertTrue("Could not delete job '%d' from the grid: qdel failed" % regrid['e'][0] in messages)
+
+      # the database is not locked while the jobs are submitted, and each job is stored as soon as it was submitted
+      hook = os.path.join(self.temp_dir, 'qsub_hook')
+      with open(hook, 'w') as f:
+        f.write("#!%s\nimport sqlite3\n" % sys.executable)
+        f.write("connection = sqlite3.connect(%r, timeout=0, isolation_level=None)\n" % self.database)
+        f.write("queued = sorted(name for (name,) in connection.execute('SELECT name FROM \"Job\" WHERE status = \\'queued\\''))\n")
+        f.write("try:\n  connection.execute('BEGIN IMMEDIATE')\n  connection.execute('ROLLBACK')\n  locked = False\nexcept sqlite3.OperationalError:\n  locked = True\n")
+        f.write("open(%r, 'a').write('%%s %%s\\n' %% (locked, ','.join(queued)))\n" % os.path.join(self.temp_dir, 'hook.log'))
+      os.chmod(hook, 0o755)
+      job_manager = gridtk.sge.JobManagerSGE(database=self.database, qsub_parallel=1, qsub_rate=0)
+      job_manager.delete(None)
+      job_manager.submit_many([{'command_line' : ['echo', name], 'name' : name} for name in ('x', 'y', 'z')])
+      with open(os.path.join(self.temp_dir, 'hook.log')) as f:
+        self.assertEqual(f.read().splitlines(), ['False ', 'False x', 'False x,y'])
+    finally:
+      os.environ['PATH'] = old_path
+
+    # the rate limiter is shared between threads
+    limiter = gridtk.sge._RateLimiter(20)
+    start = time.time()
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(3)
+    pool.map(lambda i: limiter.wait(), range(6))
+    pool.close()
+    self.assertTrue(time.time() - start >= 0.24)
+
+
+  def test11_grid_snapshot(self):
+    # Tests that the status of the grid is shared between processes through the snapshot file
+    import gridtk.sge
+    bin_dir = self._fake_sge()
+    qstat_calls = lambda: len(open(os.path.join(self.temp_dir, 'qstat.log')).readlines())
+
+    old_path = os.environ['PATH']
+    try:
+      os.environ['PATH'] = bin_dir + os.pathsep + old_path
+      job_manager = gridtk.sge.JobManagerSGE(database=self.database, qsub_rate=0)
+      job_manager.submit(['echo', 'a'], name='a')
+      job_manager.submit(['echo', 'b'], name='b')
+      session = job_manager.lock()
+      grid_ids = [job.id for job in session.query(Job).order_by(Job.unique)]
+      job_manager.unlock()
+      with open(os.path.join(self.temp_dir, 'running'), 'w') as f:
+        f.write(str(grid_ids[0]))
+      with open(os.path.join(self.temp_dir, 'finished'), 'w') as f:
+        f.write(str(grid_ids[1]))
+
+      # the poller writes the snapshot file, which is used by the consumers
+      job_manager.poll(min_interval=0.01, max_interval=0.02, polls=2)
+      self.assertEqual(qstat_calls(), 2)
+      self.assertEqual(sorted(job_manager.grid_snapshot(max_age=60)), [grid_ids[0]])
+      job_manager.communicate(max_age=60)
+      self.assertEqual(qstat_calls(), 2)
+      session = job_manager.lock()
+      self.assertEqual([job.status for job in session.query(Job).order_by(Job.unique)], ['queued', 'failure'])
+      job_manager.unlock()
+
+      # the snapshot can be read by everybody who can read the database, and is shared with other users (who are identified by LOGNAME)
+      import stat, sys
+      self.assertEqual(stat.S_IMODE(os.stat(job_manager.snapshot_file()).st_mode), stat.S_IMODE(os.stat(self.database).st_mode) & 0o666)
+      code = "import gridtk.sge; print(sorted(gridtk.sge.JobManagerSGE(database=%r).grid_snapshot(max_age=60)))" % self.database
+      environment = dict(os.environ, LOGNAME='somebody_else', USER='somebody_else')
+      output = subprocess.check_output([sys.executable, '-c', code], env=environment)
+      self.assertEqual(output.decode().strip(), str([grid_ids[0]]))
+      self.assertEqual(qstat_calls(), 2)
+
+      # outdated snapshots (and snapshots of other users) are not used
+      time.sleep(0.1)
+      self.assertEqual(sorted(job_manager.grid_snapshot(max_age=0.05)), [grid_ids[0]])
+      self.assertEqual(qstat_calls(), 3)
+      gridtk.tools.write_qstat_snapshot(job_manager.snapshot_file(), {}, user='somebody else')
+      self.assertEqual(sorted(job_manager.grid_snapshot(max_age=60)), [grid_ids[0]])
+      self.assertEqual(qstat_calls(), 4)
+
+      # jobs that other users submitted are deleted when they re-submit them, although they are not part of the snapshot of the owner of the database
+      with open(os.path.join(self.temp_dir, 'running.somebody_else'), 'w') as f:
+        f.write("%d\n" % grid_ids[1])
+      code = "import gridtk.sge; gridtk.sge.JobManagerSGE(database=%r, qsub_rate=0).resubmit(job_ids=[2])" % self.database
+      subprocess.check_call([sys.executable, '-c', code], env=environment)
+      with open(os.path.join(self.temp_dir, 'qdel.log')) as f:
+        self.assertEqual(f.read().split(), [str(grid_ids[1])])
+    finally:
+      os.environ['PATH'] = old_path
+
+
+  def test12_list_paging(self):
+    # Tests that the jobs are filtered, sorted and paged in the database when listing them
+    import six
+    from gridtk.models import add_jobs
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    session = job_manager.lock()
+    add_jobs(session, [{'command_line' : ['echo', str(i)], 'name' : 'job%d' % (i % 3) if i % 5 else None, 'array' : (1,2,1) if i == 995 else None} for i in range(1, 1001)])
+    for job in session.query(Job):
+      job.status = 'failure' if job.unique % 10 == 0 else 'success'
+    # an executing array job, whose tasks have all finished, one of them with an error
+    array_job = session.query(Job).filter(Job.unique == 995).one()
+    array_job.execute(None)
+    array_job.set_array_task(1, 'failure', 1)
+    array_job.set_array_task(2, 'success', 0)
+    session.commit()
+    job_manager.unlock()
+
+    def listed(**kwargs):
+      stdout = sys.stdout
+      sys.stdout = output = six.StringIO()
+      try:
+        job_manager.list(ids_only=True, **kwargs)
+      finally:
+        sys.stdout = stdout
+      return [int(i) for i in output.getvalue().split()]
+
+    import sys
+    self.assertEqual(listed(job_ids=None, status=['failure'], reverse=True, limit=3), [1000, 995, 990])
+    self.assertEqual(listed(job_ids=None, status=['failure'], reverse=True, limit=3, offset=2), [990, 980, 970])
+    self.assertEqual(listed(job_ids=None, status=['success'], limit=2, offset=10), [12, 13])
+    self.assertEqual(listed(job_ids=list(range(100, 111)) + [3, 1000, 1003], names=['job1'], order_by='name'), [103, 106, 109])
+    self.assertEqual(listed(job_ids=None, names=['job2'], order_by='status', reverse=True, limit=2), [998, 992])
+    self.assertEqual(listed(job_ids=[]), [])
+    # jobs without names can be listed as well
+    job_manager.list(job_ids=[5], status=['success'], offset=0)
+
+
+  def test13_query_count(self):
+    # Tests that the number of database queries does not grow with the number of jobs
+    import six
+    import sqlalchemy.event
+    import gridtk.manager
+    from gridtk.models import add_jobs
+
+    def queries(job_manager, function):
+      statements = []
+      listener = lambda conn, cursor, statement, *args: statements.append(statement)
+      sqlalchemy.event.listen(job_manager._engine, 'before_cursor_execute', listener)
+      stdout = sys.stdout
+      sys.stdout = six.StringIO()
+      try:
+        function()
+      finally:
+        sys.stdout = stdout
+        sqlalchemy.event.remove(job_manager._engine, 'before_cursor_execute', listener)
+      return len([s for s in statements if s.lstrip().upper().startswith(('SELECT', 'DELETE', 'UPDATE'))])
+
+    import sys
+    counts = {}
+    for eager_loading in gridtk.manager.EAGER_LOADING:
+      for count in (5, 50):
+        database = os.path.join(self.temp_dir, '%s_%d.sql3' % (eager_loading, count))
+        job_manager = gridtk.local.JobManagerLocal(database=database, eager_loading=eager_loading)
+        session = job_manager.lock()
+        specs = [{'key' : '0', 'command_line' : ['echo']}]
+        specs += [{'key' : str(i), 'command_line' : ['echo', str(i)], 'array' : (1,3,1), 'dependencies' : [str(i-1)]} for i in range(1, count)]
+        add_jobs(session, specs)
+        # some array tasks are stored as rows
+        for job in session.query(Job).filter(Job.unique > 1):
+          job.set_array_task(2, 'failure', 1, 'host')
+        session.commit()
+        job_manager.unlock()
+
+        counts[(eager_loading, count)] = (
+          queries(job_manager, lambda: job_manager.list(None, print_array_jobs=True, print_dependencies=True)),
+          queries(job_manager, lambda: job_manager.report()),
+          queries(job_manager, lambda: job_manager.delete(None)),
+        )
+        self.assertEqual(job_manager.lock().query(Job).count(), 0)
+        job_manager.unlock()
+      if eager_loading != 'lazy':
+        self.assertEqual(counts[(eager_loading, 5)], counts[(eager_loading, 50)])
+    job_manager.lock()
+    self.assertRaises(ValueError, job_manager.get_jobs, eager_loading='unknown')
+    job_manager.unlock()
+
+
+  def test14_report_logs(self):
+    # Tests that log files are streamed in order and that only the requested lines are read
+    import io, sys
+    import six
+    import gridtk.logs
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_manager.submit(['echo'], name='small', log_dir=self.log_dir)
+    job_manager.submit(['echo'], name='large', log_dir=self.log_dir, array=(1,2,1))
+    session = job_manager.lock()
+    jobs = list(session.query(Job).order_by(Job.unique))
+    os.makedirs(self.log_dir)
+    contents = {jobs[0].std_out_file() : "line 1\nline 2\nline 3\n\n", jobs[0].std_err_file() : ""}
+    for array_id in (1, 2):
+      contents[jobs[1].get_array_task(array_id).std_out_file()] = "".join("task %d line %d ä\n" % (array_id, i) for i in range(1000))
+    job_manager.unlock()
+    for filename, content in contents.items():
+      with io.open(filename, 'w', encoding='utf-8') as f:
+        f.write(six.text_type(content))
+
+    def reported(**kwargs):
+      stdout = sys.stdout
+      sys.stdout = output = six.StringIO()
+      try:
+        job_manager.report(**kwargs)
+      finally:
+        sys.stdout = stdout
+      return output.getvalue()
+
+    # small files are read in advance, large files are streamed in chunks
+    for small_file_size, chunk_size in ((1 << 20, 1 << 16), (100, 7)):
+      gridtk.logs.SMALL_FILE_SIZE, gridtk.logs.CHUNK_SIZE = small_file_size, chunk_size
+      try:
+        output = reported()
+        self.assertTrue(output.index("line 1\nline 2\nline 3\n" + "-"*20) < output.index("Array Job 1 :\ntask 1 line 0 ä\n") < output.index("task 1 line 999 ä\n" + "-"*20) < output.index("Array Job 2 :"))
+        self.assertEqual(output.count("\n" + "-"*40 + "\n"), 0)
+        output = reported(job_ids=[2], array_ids=[2], tail=2)
+        self.assertTrue(output.endswith("Array Job 2 :\ntask 2 line 998 ä\ntask 2 line 999 ä\n" + "-"*20 + "\n"))
+        output = reported(job_ids=[1], head=2)
+        self.assertTrue(output.endswith("line 1\nline 2\n" + "-"*20 + "\n" + "-"*60 + "\n"))
+        self.assertEqual(reported(job_ids=[1], tail=0).count("line"), 0)
+
+        # the contents are copied to files directly
+        with io.open(os.path.join(self.temp_dir, 'report.txt'), 'w+', encoding='utf-8') as f:
+          gridtk.logs.print_logs([u"header", (jobs[0].std_out_file(), u"==="), (jobs[0].std_err_file(), u"###"), (jobs[1].get_array_task(1).std_out_file(), u"***"), u"footer"], tail=2, stream=f)
+          f.seek(0)
+          self.assertEqual(f.read(), u"header\nline 2\nline 3\n===\ntask 1 line 998 ä\ntask 1 line 999 ä\n***\nfooter\n")
+      finally:
+        gridtk.logs.SMALL_FILE_SIZE, gridtk.logs.CHUNK_SIZE = 1 << 20, 1 << 16
+
+    # only a limited number of log files is read ahead of the printed ones
+    from multiprocessing.pool import ThreadPool
+    calls = []
+    pool = ThreadPool(2)
+    try:
+      results = gridtk.logs._read_ahead(pool, calls.append, range(100), 4)
+      self.assertEqual(next(results), None)
+      time.sleep(0.2)
+      self.assertEqual(len(calls), 5)
+      self.assertEqual(len(list(results)), 99)
+      self.assertEqual(sorted(calls), list(range(100)))
+    finally:
+      pool.terminate(); pool.join()
+
+
+  def test15_follow_logs(self):
+    # Tests that growing log files are followed, and that new log files are added
+    import io, sys, threading
+    import six
+    import gridtk.logs
+    os.makedirs(self.log_dir)
+    first, second = os.path.join(self.log_dir, 'first.o1'), os.path.join(self.log_dir, 'second.o2')
+    with open(first, 'w') as f:
+      f.write("line 1\nline 2\n")
+    state = {'files' : [first], 'running' : True}
+    output = io.open(os.path.join(self.temp_dir, 'follow.txt'), 'w+', encoding='utf-8')
+    thread = threading.Thread(target=gridtk.logs.follow_logs, args=(lambda: (list(state['files']), state['running']),), kwargs={'interval' : 0.05, 'tail' : 1, 'stream' : output})
+    thread.start()
+
+    def written():
+      output.flush()
+      with open(output.name) as f:
+        return f.read()
+
+    def wait_for(text):
+      for i in range(100):
+        if written().endswith(text):
+          return
+        time.sleep(0.05)
+      self.fail("'%s' was not written, got '%s'" % (text, written()))
+
+    try:
+      wait_for("==> %s <==\nline 2\n" % first)
+      with open(first, 'a') as f:
+        f.write("line 3\n")
+      wait_for("line 2\nline 3\n")
+      # new files are followed from the start
+      with open(second, 'w') as f:
+        f.write("other 1\n")
+      state['files'].append(second)
+      wait_for("==> %s <==\nother 1\n" % second)
+      with open(first, 'a') as f:
+        f.write("line 4\n")
+      wait_for("==> %s <==\nline 4\n" % first)
+      # the last changes are written before stopping
+      with open(second, 'a') as f:
+        f.write("other 2\n")
+      state['running'] = False
+      thread.join(5)
+      self.assertFalse(thread.is_alive())
+      self.assertTrue(written().endswith("==> %s <==\nother 2\n" % second))
+      self.assertEqual(written().count("line 1"), 0)
+    finally:
+      state['running'] = False
+      thread.join()
+      output.close()
+
+    # finished jobs are reported completely, and following stops immediately
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_manager.submit(['echo'], name='first', log_dir=self.log_dir, array=(1,2,1))
+    session = job_manager.lock()
+    job = session.query(Job).one()
+    job.id = 1
+    for array_id in (1, 2):
+      job.execute(array_id)
+      job.finish(0, array_id)
+    session.commit()
+    task_file = job.get_array_task(1).std_out_file()
+    job_manager.unlock()
+    with open(task_file, 'w') as f:
+      f.write("task 1\n")
+    stdout = sys.stdout
+    sys.stdout = captured = six.StringIO()
+    try:
+      job_manager.report(follow=True, interval=0.01, output=True, error=False)
+    finally:
+      sys.stdout = stdout
+    self.assertEqual(captured.getvalue(), "\n==> %s <==\ntask 1\n" % task_file)
+
+
+  def test16_compressed_logs(self):
+    # Tests that the logs of finished jobs are compressed, and that compressed logs are read and deleted transparently
+    import io, sys, itertools
+    import six
+    import gridtk.logs
+    job_manager = gridtk.local.JobManagerLocal(database=self.database, compress_logs='gzip')
+    job_manager.submit([sys.executable, '-c', 'for i in range(1000): print("line %d" % i)'], name='job', log_dir=self.log_dir)
+    job_manager.submit([sys.executable, '-c', 'import os; print("task " + os.environ["SGE_TASK_ID"])'], name='array', log_dir=self.log_dir, array=(1,2,1))
+    job_manager.run_scheduler(parallel_jobs=2, die_when_finished=True)
+    session = job_manager.lock(read_only=True)
+    jobs = list(session.query(Job).order_by(Job.unique))
+    self.assertEqual([job.status for job in jobs], ['success', 'success'])
+    out_file, err_file = jobs[0].std_out_file(), jobs[0].std_err_file()
+    task_file = jobs[1].get_array_task(2).std_out_file()
+    job_manager.unlock()
+    # empty log files are not compressed
+    self.assertEqual(sorted(os.listdir(self.log_dir)), sorted(os.path.basename(f) for f in (out_file + '.gz', err_file, task_file + '.gz', jobs[1].get_array_task(1).std_out_file() + '.gz', jobs[1].get_array_task(1).std_err_file(), jobs[1].get_array_task(2).std_err_file())))
+
+    def reported(**kwargs):
+      stdout = sys.stdout
+      sys.stdout = output = six.StringIO()
+      try:
+        job_manager.report(**kwargs)
+      finally:
+        sys.stdout = stdout
+      return output.getvalue()
+
+    for small_file_size in (1 << 20, 16):
+      gridtk.logs.SMALL_FILE_SIZE = small_file_size
+      try:
+        output = reported()
+        self.assertTrue(output.index("line 0\nline 1\n") < output.index("line 999\n" + "-"*20) < output.index("Array Job 2 :\ntask 2\n" + "-"*20))
+        self.assertTrue(reported(job_ids=[1], tail=2).endswith("line 998\nline 999\n" + "-"*20 + "\n" + "-"*60 + "\n"))
+        self.assertTrue(reported(job_ids=[1], head=1).endswith("line 0\n" + "-"*20 + "\n" + "-"*60 + "\n"))
+      finally:
+        gridtk.logs.SMALL_FILE_SIZE = 1 << 20
+
+    # the same lines are selected from compressed and uncompressed files
+    content = b"a\n  b  \n\n c\n\n\t\nd \n\n\n"
+    for method, head, tail in itertools.product(('gzip', 'xz'), (None, 0, 1, 2, 3, 4, 10), (None, 0, 1, 2, 3, 4, 10)):
+      plain, compressed = os.path.join(self.temp_dir, 'plain.log'), os.path.join(self.temp_dir, 'compressed.log')
+      for filename in (plain, compressed):
+        with open(filename, 'wb') as f:
+          f.write(content)
+      self.assertEqual(gridtk.logs.compress_log(compressed, method), compressed + gridtk.logs.COMPRESSION[method])
+      outputs = []
+      for filename in (plain, compressed):
+        with io.open(os.path.join(self.temp_dir, 'report.txt'), 'w+', encoding='utf-8') as f:
+          gridtk.logs.print_logs([(filename, u"---")], head=head, tail=tail, stream=f)
+          f.seek(0)
+          outputs.append(f.read())
+      self.assertEqual(outputs[0], outputs[1])
+      os.remove(compressed + gridtk.logs.COMPRESSION[method])
+
+    # compressed log files are deleted with their jobs
+    job_manager.delete(job_ids=None, delete_log_dir=True)
+    self.assertFalse(os.path.exists(self.log_dir))
+
+
+  def test17_grep_logs(self):
+    # Tests that the log files are searched in parallel, and that unchanged files are not searched again
+    import sys
+    import six
+    import gridtk.logs
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_manager.submit(['echo'], name='single', log_dir=self.log_dir)
+    job_manager.submit(['echo'], name='array', log_dir=self.log_dir, array=(1,4,1))
+    session = job_manager.lock()
+    jobs = list(session.query(Job).order_by(Job.unique))
+    for array_id in (1, 2, 3, 4):
+      jobs[1].execute(array_id)
+      jobs[1].finish(1 if array_id % 2 else 0, array_id)
+    session.commit()
+    os.makedirs(self.log_dir)
+    contents = {jobs[0].std_out_file() : "no error here\n", jobs[0].std_err_file() : "Traceback\nValueError: x\n"}
+    for array_id in (1, 2, 3, 4):
+      contents[jobs[1].get_array_task(array_id).std_out_file()] = "step %d\n" % array_id * 1000
+      contents[jobs[1].get_array_task(array_id).std_err_file()] = "Traceback\nValueError: task %d\n" % array_id if array_id % 2 else ""
+    job_manager.unlock()
+    for filename, content in contents.items():
+      with open(filename, 'w') as f:
+        f.write(content)
+    gridtk.logs.compress_log(jobs[1].get_array_task(3).std_err_file(), 'gzip')
+
+    def grep(pattern, **kwargs):
+      stdout = sys.stdout
+      sys.stdout = output = six.StringIO()
+      try:
+        return job_manager.grep(pattern, **kwargs)
+      finally:
+        sys.stdout = stdout
+
+    self.assertEqual(grep('valueerror', ignore_case=True, processes=2), [(1, None, 0, 1), (2, 1, 0, 1), (2, 3, 0, 1)])
+    self.assertEqual(grep('^step [24]$', processes=2), [(2, 2, 1000, 0), (2, 4, 1000, 0)])
+    self.assertEqual(grep('Traceback', status=('failure',), error=False), [])
+    self.assertEqual(grep('Traceback', status=('failure',)), [(2, 1, 0, 1), (2, 3, 0, 1)])
+    self.assertEqual(grep('task 3', job_ids=[2], array_ids=[2, 3], fixed_strings=True), [(2, 3, 0, 1)])
+    self.assertEqual(grep('error', fixed_strings=True, name='single'), [(1, None, 1, 0)])
+
+    # with the index, only the files that changed are searched again
+    searched = []
+    grep_file = gridtk.logs._grep_file
+    def _grep_file(arguments):
+      searched.append(arguments[0])
+      return grep_file(arguments)
+    gridtk.logs._grep_file = _grep_file
+    try:
+      self.assertEqual(len(grep('ValueError', processes=1, use_index=True)), 3)
+      self.assertEqual(len(searched), 10)
+      del searched[:]
+      with open(jobs[1].get_array_task(2).std_err_file(), 'w') as f:
+        f.write("ValueError: again\n")
+      self.assertEqual(grep('ValueError', processes=1, use_index=True), [(1, None, 0, 1), (2, 1, 0, 1), (2, 2, 0, 1), (2, 3, 0, 1)])
+      self.assertEqual(searched, [jobs[1].get_array_task(2).std_err_file()])
+      # other patterns are searched again, the line counts are kept in the index
+      self.assertEqual(len(grep('step', processes=1, use_index=True)), 4)
+      self.assertEqual(len(searched), 11)
+      index = gridtk.logs.read_log_index(job_manager.log_index_file())
+      self.assertEqual(index[os.path.abspath(jobs[1].get_array_task(1).std_out_file())]['lines'], 1000)
+      # entries of removed log files are dropped from the index
+      os.remove(jobs[1].get_array_task(1).std_out_file())
+      self.assertEqual(len(grep('step', processes=1, use_index=True)), 3)
+      index = gridtk.logs.read_log_index(job_manager.log_index_file())
+      self.assertFalse(os.path.abspath(jobs[1].get_array_task(1).std_out_file()) in index)
+      self.assertTrue(os.path.abspath(jobs[1].get_array_task(2).std_out_file()) in index)
+      self.assertEqual(len(index), 9)
+    finally:
+      gridtk.logs._grep_file = grep_file
+
+    self.assertRaises(ValueError, grep, '(')
+
+
+  def test18_bulk_delete(self):
+    # Tests that jobs, array tasks, dependencies and log files are deleted in bulk
+    import gridtk.logs
+    from gridtk.models import ArrayJob, JobDependence
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    job_manager.submit(['echo'], name='array', log_dir=self.log_dir, array=(1,6,1))
+    job_manager.submit(['echo'], name='waiting', log_dir=self.log_dir, dependencies=[1])
+    job_manager.submit(['echo'], name='other', log_dir=self.log_dir)
+    session = job_manager.lock()
+    jobs = list(session.query(Job).order_by(Job.unique))
+    for array_id in (1, 2, 3, 4):
+      jobs[0].execute(array_id)
+      jobs[0].finish(1 if array_id % 2 else 0, array_id)
+    jobs[0].refresh()
+    session.commit()
+    self.assertEqual(jobs[0].status, 'executing')
+    os.makedirs(self.log_dir)
+    log_files = dict((array_id, (jobs[0].get_array_task(array_id).std_out_file(), jobs[0].get_array_task(array_id).std_err_file())) for array_id in range(1, 7))
+    log_files[None] = (jobs[1].std_out_file(), jobs[1].std_err_file())
+    job_manager.unlock()
+    for files in log_files.values():
+      for filename in files:
+        with open(filename, 'w') as f:
+          f.write("log\n")
+    gridtk.logs.compress_log(log_files[1][0])
+    gridtk.logs.compress_log(log_files[2][1], 'xz')
+
+    # only the failed tasks and their (compressed) log files are removed
+    job_manager.delete(job_ids=[1], status=('failure',), delete_log_dir=True)
+    session = job_manager.lock()
+    job = session.query(Job).filter(Job.unique == 1).one()
+    self.assertEqual([task.id for task in job.array_tasks()], [2, 4, 5, 6])
+    self.assertEqual(session.query(ArrayJob).filter(ArrayJob.status == 'failure').count(), 0)
+    job_manager.unlock()
+    self.assertEqual(sorted(os.listdir(self.log_dir)), sorted([os.path.basename(f) for array_id, files in log_files.items() if array_id not in (1, 3) for f in files if f != log_files[2][1]] + [os.path.basename(log_files[2][1]) + '.xz']))
+
+    # deleting jobs removes the dependencies; the log directory is kept until it is empty
+    job_manager.delete(job_ids=[1], delete_log_dir=True)
+    session = job_manager.lock()
+    self.assertEqual([job.unique for job in session.query(Job).order_by(Job.unique)], [2, 3])
+    self.assertEqual(session.query(ArrayJob).count(), 0)
+    self.assertEqual(session.query(JobDependence).count(), 0)
+    job_manager.unlock()
+    self.assertEqual(sorted(os.listdir(self.log_dir)), sorted(os.path.basename(f) for f in log_files[None]))
+    job_manager.delete(job_ids=None, delete_log_dir=True)
+    self.assertFalse(os.path.exists(self.log_dir))
+
+
+  def test19_failure_propagation(self):
+    # Tests that all jobs that depend on a failed job are found by a single query, and that they are reset at once
+    import sqlalchemy
+    from gridtk.models import add_jobs, ArrayJob
+    def statements(job_manager, function):
+      executed = []
+      listener = lambda conn, cursor, statement, *args: executed.append(statement)
+      sqlalchemy.event.listen(job_manager._engine, 'before_cursor_execute', listener)
+      try:
+        result = function()
+      finally:
+        sqlalchemy.event.remove(job_manager._engine, 'before_cursor_execute', listener)
+      return result, len([s for s in executed if s.lstrip().upper().startswith(('SELECT', 'WITH', 'UPDATE', 'DELETE'))])
+
+    counts = {}
+    for depth in (5, 50):
+      database = os.path.join(self.temp_dir, 'chain_%d.sql3' % depth)
+      job_manager = gridtk.local.JobManagerLocal(database=database)
+      session = job_manager.lock()
+      # a chain of array jobs, where each job also depends on the first job, and a job in another queue
+      specs = [{'key' : '0', 'command_line' : ['echo'], 'stop_on_failure' : True}]
+      specs += [{'key' : str(i), 'command_line' : ['echo', str(i)], 'array' : (1,5,2), 'dependencies' : [str(i-1), '0']} for i in range(1, depth)]
+      specs += [{'key' : 'grid', 'command_line' : ['echo'], 'dependencies' : ['1'], 'queue' : 'q1d'}, {'key' : 'other', 'command_line' : ['echo']}]
+      add_jobs(session, specs)
+      jobs = list(session.query(Job).order_by(Job.unique))
+      for job in jobs:
+        job.queue(queue_name='q1d' if job.unique == depth + 1 else 'local')
+      jobs[2].execute(3, 'host')
+      jobs[2].finish(1, 3)
+      jobs[0].execute(None, 'host')
+      jobs[0].finish(1, None)
+      session.commit()
+      self.assertEqual(session.query(ArrayJob).count(), 1)
+
+      self.assertEqual(job_manager._dependent_job_ids(jobs[0]), set(range(2, depth + 2)))
+      self.assertEqual(job_manager._dependent_job_ids(jobs[depth - 1]), set())
+      stopped, counts[depth] = statements(job_manager, lambda: job_manager._stop_dependent_jobs(jobs[0]))
+      session.commit()
+      self.assertEqual(stopped, list(range(2, depth + 1)))
+      jobs = list(session.query(Job).order_by(Job.unique))
+      self.assertEqual(set(job.status for job in jobs[1:depth]), set(['submitted']))
+      self.assertEqual([job.status for job in jobs[depth:]], ['waiting', 'queued'])
+      self.assertEqual([task.id for task in jobs[2].array_tasks(('submitted',))], [1, 3, 5])
+      self.assertEqual(session.query(ArrayJob).count(), 0)
+      self.assertTrue(all(job.id == job.unique and job.result is None for job in jobs[1:depth]))
+      self.assertTrue(all(job.start_time is None and job.finish_time is None for job in jobs[1:depth]))
+      job_manager.unlock()
+    self.assertEqual(counts[5], counts[50])
+
+    # the array tasks are not touched when only jobs without array are stopped
+    job_manager = gridtk.local.JobManagerLocal(database=os.path.join(self.temp_dir, 'plain.sql3'))
+    session = job_manager.lock()
+    add_jobs(session, [{'key' : 'a', 'command_line' : ['echo']}, {'command_line' : ['echo'], 'dependencies' : ['a']}])
+    jobs = list(session.query(Job).order_by(Job.unique))
+    for job in jobs:
+      job.queue()
+    executed = []
+    listener = lambda conn, cursor, statement, *args: executed.append(statement)
+    sqlalchemy.event.listen(job_manager._engine, 'before_cursor_execute', listener)
+    try:
+      self.assertEqual(job_manager._stop_dependent_jobs(jobs[0]), [2])
+    finally:
+      sqlalchemy.event.remove(job_manager._engine, 'before_cursor_execute', listener)
+    self.assertFalse(any('ArrayJob' in statement for statement in executed))
+    session.commit()
+    self.assertEqual((jobs[1].status, jobs[1].array_state), ('submitted', None))
+    job_manager.unlock()
+
+
+  def test20_dependency_graph(self):
+    # Tests that cyclic dependencies are rejected, and that the levels and the critical path of the dependency graph are computed
+    import six
+    from gridtk.models import add_jobs
+    from gridtk.graph import JobGraph, JobNode, find_cycle
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    session = job_manager.lock()
+    # integral dependencies may refer to later jobs of the same batch, which can form a cycle
+    self.assertRaises(ValueError, add_jobs, session, [{'command_line' : ['echo'], 'dependencies' : [2]}, {'command_line' : ['echo'], 'dependencies' : [3]}, {'command_line' : ['echo'], 'dependencies' : [1]}])
+    self.assertEqual(session.query(Job).count(), 0)
+    # a diamond, where the right branch takes longer
+    add_jobs(session, [
+      {'key' : 'a', 'command_line' : ['echo'], 'name' : 'prepare'},
+      {'key' : 'b', 'command_line' : ['echo'], 'name' : 'left', 'dependencies' : ['a']},
+      {'key' : 'c', 'command_line' : ['echo'], 'name' : 'right', 'dependencies' : ['a']},
+      {'key' : 'd', 'command_line' : ['echo'], 'name' : 'collect', 'dependencies' : ['b', 'c']},
+      {'command_line' : ['echo'], 'name' : 'right'},
+    ])
+    jobs = list(session.query(Job).order_by(Job.unique))
+    for job, (start, finish) in zip(jobs, ((0., 10.), (10., 20.), (None, None), (None, None), (0., 100.))):
+      job.queue()
+      if start is not None:
+        job.execute(None, 'host')
+        job.finish(0, None)
+        job.start_time, job.finish_time = start, finish
+    session.commit()
+    job_manager.unlock()
+
+    graph = job_manager.dependency_graph()
+    self.assertEqual(graph.levels(), {1 : 0, 2 : 1, 3 : 1, 4 : 2, 5 : 0})
+    runtimes, estimated = graph.runtimes()
+    self.assertEqual(runtimes, {1 : 10., 2 : 10., 3 : 100., 4 : 40., 5 : 100.})
+    self.assertEqual(estimated, set((3, 4)))
+    output = six.StringIO()
+    self.assertEqual(job_manager.graph(stream=output), (150., [1, 3, 4]))
+    self.assertTrue("Critical path: 3 jobs, 0:02:30" in output.getvalue())
+    output = six.StringIO()
+    job_manager.graph(job_ids=[1, 2, 4], format='dot', default_runtime=5., stream=output)
+    self.assertTrue('1 -> 2 [penwidth=3, color=red];' in output.getvalue())
+    self.assertFalse(' 3 ' in output.getvalue())
+
+    # the algorithms do not recurse, so that long chains and large graphs are handled
+    n = 100000
+    graph = JobGraph([JobNode(i, 'job', 'queued', None, None) for i in range(n)], [(i, i - 1) for i in range(1, n)] + [(i, i // 2) for i in range(1, n)])
+    self.assertEqual(graph.levels()[n - 1], n - 1)
+    self.assertEqual(graph.critical_path(graph.runtimes()[0]), (float(n), list(range(n))))
+    self.assertEqual(find_cycle([(1, 2), (2, 3), (3, 4), (4, 2)]), [2, 3, 4, 2])
+    self.assertEqual(find_cycle([(1, 2), (2, 3)]), None)
+
+
+  def test21_scheduling_order(self):
+    # Tests that the local scheduler starts the jobs with the highest priority first, and otherwise the jobs on the longest chain
+    import sys
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    command = [sys.executable, '-c', 'pass']
+    a = job_manager.submit(command, name='a')
+    b = job_manager.submit(command, name='b', priority=5)
+    c = job_manager.submit(command, name='c')
+    d = job_manager.submit(command, name='d', dependencies=[c])
+    e = job_manager.submit(command, name='e', dependencies=[d])
+    # the priority of a job is inherited by the jobs that it waits for
+    x = job_manager.submit(command, name='x')
+    y = job_manager.submit(command, name='y', dependencies=[x], priority=10)
+    self.assertEqual(job_manager.run_scheduler(parallel_jobs=1, die_when_finished=True), [])
+
+    session = job_manager.lock(read_only=True)
+    jobs = sorted(session.query(Job), key=lambda job: job.start_time)
+    self.assertEqual([job.unique for job in jobs], [x, y, b, c, d, a, e])
+    self.assertTrue(all(job.start_time <= job.finish_time for job in jobs))
+    # only the runtimes of the jobs with the requested names are estimated
+    runtimes, default = job_manager._estimated_runtimes(['a', 'b', 'unknown'])
+    self.assertEqual(sorted(runtimes), ['a', 'b'])
+    self.assertAlmostEqual(default, sum(runtimes.values()) / 2)
+    # a job that is added to the scheduler again keeps its runtime estimate
+    graph = gridtk.local._JobGraph()
+    graph.add(jobs[0], 50.)
+    graph.add(jobs[0])
+    self.assertEqual(graph._runtime[jobs[0].unique], 50.)
+    job_manager.unlock()
+
+
+  def test22_resource_budget(self):
+    # Tests that the local scheduler only runs jobs together whose requested slots and memory fit into the budget
+    import sys
+    from gridtk.tools import parse_memory, parse_slots
+    self.assertEqual([parse_memory(m) for m in ('8G', '512M', '2k', '1.5g', 100)], [8 << 30, 512 << 20, 2000, 1500000000, 100])
+    self.assertRaises(ValueError, parse_memory, '8GB')
+    self.assertEqual([parse_slots(p) for p in ('pe_mth 4', 'pe_mth 2-8', 'pe_exclusive* 1-')], [4, 2, 1])
+
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    command = [sys.executable, '-c', 'import time; time.sleep(0.2)']
+    a = job_manager.submit(command, name='a', memfree='8G', pe_opt='pe_mth 2')
+    b = job_manager.submit(command, name='b', memfree='4G')
+    c = job_manager.submit(command, name='c', hvmem='1G', pe_opt='pe_mth 2')
+    d = job_manager.submit(command, name='d', memfree='20G')
+    job_manager.lock(read_only=True)
+    self.assertEqual([job.requested_resources() for job in job_manager.get_jobs([a, c])], [(2, 8 << 30), (2, 2 << 30)])
+    job_manager.unlock()
+    self.assertEqual(job_manager.run_scheduler(parallel_jobs=4, die_when_finished=True, slots=4, memory='10G'), [])
+
+    session = job_manager.lock(read_only=True)
+    jobs = dict((job.unique, job) for job in session.query(Job))
+    # a and b do not fit together into the memory, and c is not started before b; d exceeds the budget and runs alone
+    self.assertTrue(jobs[b].start_time >= jobs[a].finish_time)
+    self.assertTrue(jobs[c].start_time >= jobs[a].finish_time)
+    self.assertTrue(jobs[c].start_time < jobs[b].finish_time and jobs[b].start_time < jobs[c].finish_time)
+    self.assertTrue(jobs[d].start_time >= max(jobs[b].finish_time, jobs[c].finish_time))
+    job_manager.unlock()
+
+
+  def test23_scheduler_sync(self):
+    # Tests that the scheduler re-reads the database only after changes by other processes, not after its own changes
+    import sys
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    for i in range(10):
+      job_manager.submit([sys.executable, '-c', 'pass'], name='job')
+    # this job submits another job while the scheduler is running
+    code = "import sys, gridtk.local; gridtk.local.JobManagerLocal(database=%r).submit([sys.executable, '-c', 'pass'], name='late')" % self.database
+    job_manager.submit([sys.executable, '-c', code], name='submitter')
+    updates = []
+    update_graph = job_manager._update_graph
+    job_manager._update_graph = lambda *args: (updates.append(args), update_graph(*args))
+    self.assertEqual(job_manager.run_scheduler(parallel_jobs=2, die_when_finished=True), [])
+    self.assertTrue(len(updates) <= 3, len(updates))
+
+    session = job_manager.lock(read_only=True)
+    self.assertEqual(sorted(job.name for job in session.query(Job) if job.status == 'success'), ['job'] * 10 + ['late', 'submitter'])
+    job_manager.unlock()
+
+    # jobs that are submitted while the scheduler locks the database are not mistaken for its own changes
+    os.remove(self.database)
+    job_manager = gridtk.local.JobManagerLocal(database=self.database)
+    marker = os.path.join(self.temp_dir, 'finished')
+    job_manager.submit(['touch', marker], name='first')
+    job_manager.submit([sys.executable, '-c', 'import time; time.sleep(1)'], name='second')
+    import threading
+    submitter = threading.Thread(target=lambda: gridtk.local.JobManagerLocal(database=self.database).submit([sys.executable, '-c', 'pass'], name='late'))
+    database_state = job_manager._database_state
+    def _database_state():
+      # submit the job in another connection right after the scheduler read the state of the locked database when the first job finished
+      state = database_state()
+      if hasattr(job_manager, 'session') and os.path.exists(marker) and submitter.ident is None:
+        submitter.start()
+        submitter.join(0.5)
+      return state
+    job_manager._database_state = _database_state
+    self.assertEqual(job_manager.run_scheduler(parallel_jobs=2, die_when_finished=True), [])
+    submitter.join()
+
+    session = job_manager.lock(read_only=True)
+    self.assertEqual(sorted(job.name for job in session.query(Job) if job.status == 'success'), ['first', 'late', 'second'])
+    job_manager.unlock()
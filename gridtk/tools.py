@@ -13,43 +13,9 @@ import hashlib
 import random
 
 
-# sqlalchemy migration; copied from Bob
-try:
-  from sqlalchemy import Enum
-except ImportError:
-  from sqlalchemy import types
-
-  class Enum(types.TypeDecorator):
-    impl = types.Unicode
-
-    def __init__(self, *values):
-      """Emulates an Enum type.
-      values:
-      A list of valid values for this column
-      """
-
-      if values is None or len(values) is 0:
-          raise AssertionError('Enum requires a list of values')
-      self.values = values[:]
-
-      # The length of the string/unicode column should be the longest string
-      # in values
-      size = max([len(v) for v in values if v is not None])
-      super(Enum, self).__init__(size)
-
-    def process_bind_param(self, value, dialect):
-      if value not in self.values:
-          raise AssertionError('"%s" not in Enum.values' % value)
-      return value
-
-    def process_result_value(self, value, dialect):
-      return value
-
-try:
-  from sqlalchemy.orm import relationship
-except ImportError:
-  from sqlalchemy.orm import relation as relationship
-
+# The possible statuses of jobs and array jobs;
+# this is defined here (and not in the models) so that the command line can be set up without loading the database layer
+Status = ('submitted', 'queued', 'waiting', 'executing', 'success', 'failure')
 
 
 # initialize the logging system
@@ -84,6 +50,33 @@ def makedirs_safe(fulldir):
     else: raise
 
 
+NETWORK_FILE_SYSTEMS = ('nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'ncpfs', 'afs', 'lustre', 'gpfs', 'glusterfs', 'fuse.glusterfs', 'ceph', 'fuse.sshfs', 'beegfs', 'panfs')
+
+def filesystem_type(path):
+  """Returns the type of the file system (e.g. 'ext4' or 'nfs') that the given path is located on.
+  If the type cannot be determined (e.g. on non-Linux systems), None is returned."""
+
+  # find the deepest existing directory
+  path = os.path.realpath(path)
+  while not os.path.exists(path):
+    path = os.path.dirname(path)
+
+  try:
+    with open('/proc/mounts') as mounts:
+      entries = [line.split() for line in mounts]
+  except IOError:
+    return None
+
+  # find the mount point with the longest common prefix
+  best, fstype = '', None
+  for entry in entries:
+    if len(entry) < 3: continue
+    mount_point = entry[1].replace('\\040', ' ')
+    if (path == mount_point or path.startswith(mount_point.rstrip('/') + '/')) and len(mount_point) >= len(best):
+      best, fstype = mount_point, entry[2]
+  return fstype
+
+
 def str_(name):
   """Return the string representation of the given 'name'.
   If it is a bytes object, it will be converted into str.
@@ -255,6 +248,21 @@ def qsub(command, queue=None, cwd=True, name=None, deps=[], stdout='',
   jobid = str_(sexec(context, scmd))
   return int(jobid.split('.',1)[0])
 
+def parse_memory(memory):
+  """Returns the number of bytes of the given memory requirement, as it is given to the SGE grid (e.g. '8G').
+  As in the grid, the upper case units K, M and G are powers of 1024, while the lower case units k, m and g are powers of 1000; numbers without a unit are bytes."""
+  match = re.match(r'^\s*(\d+(?:\.\d*)?)\s*([kKmMgGtT]?)\s*$', str(memory))
+  if match is None:
+    raise ValueError("Could not interpret the memory requirement '%s'" % memory)
+  unit = match.group(2)
+  exponent = ' kmgt'.index(unit.lower() or ' ')
+  return int(float(match.group(1)) * (1024 if unit.isupper() else 1000) ** exponent)
+
+def parse_slots(pe_opt):
+  """Returns the (minimum) number of slots that is requested by the given parallel environment option of the SGE grid (e.g. 'pe_mth 4')."""
+  match = re.search(r'(\d+)[\d,\-]*\s*$', pe_opt)
+  return int(match.group(1)) if match is not None else 1
+
 def make_shell(shell, command):
   """Returns a single command given a shell and a command to be qsub'ed
 
@@ -306,6 +314,130 @@ def qstat(jobid, context='grid'):
 
   return retval
 
+def parse_qstat_xml(source):
+  """Parses the XML output of ``qstat -xml`` incrementally.
+
+  Keyword parameters:
+
+  source
+    A file name or a file-like object (opened in binary mode) containing the
+    XML output of qstat
+
+  Returns a dictionary that maps each grid job id (integer) to a dictionary
+  with the job properties 'job_number', 'job_name', 'state', 'queue_name' and
+  'tasks'; the latter is the list of task strings that qstat listed for array
+  jobs (empty for non-array jobs)
+  """
+
+  from xml.etree.ElementTree import iterparse
+
+  retval = {}
+  for event, element in iterparse(source, events=('end',)):
+    if element.tag != 'job_list':
+      continue
+
+    job_id = int(element.findtext('JB_job_number'))
+    if job_id not in retval:
+      retval[job_id] = {
+        'job_number' : str(job_id),
+        'job_name' : element.findtext('JB_name'),
+        'state' : element.findtext('state'),
+        'queue_name' : element.findtext('queue_name') or None,
+        'tasks' : [],
+      }
+    elif element.get('state') == 'running':
+      # running tasks of array jobs carry more precise information
+      retval[job_id]['state'] = element.findtext('state')
+      retval[job_id]['queue_name'] = element.findtext('queue_name') or None
+
+    tasks = element.findtext('tasks')
+    if tasks:
+      retval[job_id]['tasks'].append(tasks)
+
+    # free the memory of the already processed job
+    element.clear()
+
+  return retval
+
+def qstat_snapshot(user=None, context='grid'):
+  """Queries the status of all jobs of the given user with a single qstat call.
+
+  Keyword parameters:
+
+  user
+    The name of the user whose jobs should be listed; if not given, the
+    current user is selected
+
+  context
+    The setshell context in which we should try a 'qstat'. Normally you don't
+    need to change the default. This variable can also be set to a context
+    dictionary in which case we just setup using that context instead of
+    probing for a new one, what can be fast.
+
+  Returns a dictionary of job properties indexed by grid job id, see
+  :py:func:`parse_qstat_xml`
+  """
+
+  if user is None:
+    import getpass
+    user = getpass.getuser()
+
+  scmd = ['qstat', '-u', user, '-xml']
+
+  logger.debug("Qstat command '%s'", ' '.join(scmd))
+
+  from io import BytesIO
+  from .setshell import sexec
+  data = sexec(context, scmd)
+  if not isinstance(data, bytes):
+    data = data.encode('utf8')
+
+  return parse_qstat_xml(BytesIO(data))
+
+def write_qstat_snapshot(filename, snapshot, user=None, mode=None):
+  """Writes the result of :py:func:`qstat_snapshot` to the given file, together
+  with the current time and user, so that it can be shared between processes.
+  The file is replaced atomically, so that it can be read at any time.
+  If given, the permissions of the file are set to ``mode``, e.g., so that
+  other users can read it (by default, only the writer can read it).
+  """
+
+  import json, time, tempfile
+  if user is None:
+    import getpass
+    user = getpass.getuser()
+
+  directory = os.path.dirname(os.path.abspath(filename))
+  fd, temp_file = tempfile.mkstemp(dir=directory, prefix='.qstat')
+  with os.fdopen(fd, 'w') as f:
+    json.dump({'time' : time.time(), 'user' : user, 'jobs' : snapshot}, f)
+  if mode is not None:
+    os.chmod(temp_file, mode)
+  os.rename(temp_file, filename)
+
+def read_qstat_snapshot(filename, max_age, user=None):
+  """Reads the snapshot written by :py:func:`write_qstat_snapshot`.
+
+  Returns the dictionary of job properties indexed by grid job id, or None if
+  the file does not exist, was written for another user, or is older than
+  max_age seconds
+  """
+
+  import json, time
+  if user is None:
+    import getpass
+    user = getpass.getuser()
+
+  try:
+    with open(filename) as f:
+      data = json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+
+  if data.get('user') != user or time.time() - data.get('time', 0) > max_age:
+    return None
+  return dict((int(job_id), properties) for job_id, properties in data['jobs'].items())
+
 def qdel(jobid, context='grid'):
   """Halts a given job.
 